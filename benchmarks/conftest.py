@@ -0,0 +1,44 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import glob
+import os
+
+import pytest
+
+import trojmiastopl.utils
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def load_fixtures(kind):
+    """ Loads recorded pages
+
+    :param kind: "search" or "offer"
+    :type kind: str
+    :return: File name and page body pairs, sorted by name
+    :rtype: list
+    """
+    fixtures = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, kind, "*.html"))):
+        with open(path, "rb") as fixture_file:
+            fixtures.append((os.path.basename(path), fixture_file.read()))
+    return fixtures
+
+
+@pytest.fixture(scope="session")
+def search_pages():
+    return [markup for _, markup in load_fixtures("search")]
+
+
+@pytest.fixture(scope="session")
+def offer_pages():
+    return [markup for _, markup in load_fixtures("offer")]
+
+
+@pytest.fixture(params=trojmiastopl.utils.PARSER_BACKENDS)
+def backend(request):
+    trojmiastopl.utils.set_parser_backend(request.param)
+    if trojmiastopl.utils.get_parser_backend() != request.param:
+        pytest.skip("{0} is not installed".format(request.param))
+    yield request.param
+    trojmiastopl.utils.set_parser_backend("html.parser")
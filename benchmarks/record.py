@@ -0,0 +1,61 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" Records search and offer pages from trojmiasto.pl as benchmark fixtures
+
+python benchmarks/record.py nieruchomosci-mam-do-wynajecia Gdańsk --pages 2 --offers 20
+"""
+import argparse
+import logging
+import os
+
+from trojmiastopl.category import parse_available_offers
+from trojmiastopl.utils import get_content_for_url, get_offer_id, get_url
+
+log = logging.getLogger(__file__)
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def save_fixture(kind, name, body):
+    directory = os.path.join(FIXTURES_DIR, kind)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(os.path.join(directory, "{0}.html".format(name)), "wb") as fixture_file:
+        fixture_file.write(body)
+
+
+def record(category, region=None, pages=1, offers=10, prefix="search"):
+    """ Saves first pages of search results and offers found on them
+
+    :param category: Search category
+    :param region: Search region
+    :param pages: Number of search pages to save
+    :param offers: Maximum number of offers to save
+    :param prefix: File name prefix of search pages
+    :type category: str
+    :type region: str
+    :type pages: int
+    :type offers: int
+    :type prefix: str
+    """
+    url = get_url(category, region)
+    offer_urls = []
+    for page in range(pages):
+        body = get_content_for_url("{0}?strona={1}".format(url, page)).content
+        save_fixture("search", "{0}-{1}".format(prefix, page), body)
+        offer_urls.extend(parse_available_offers(body))
+    for offer_url in offer_urls[:offers]:
+        save_fixture("offer", get_offer_id(offer_url), get_content_for_url(offer_url).content)
+        log.info("Recorded {0}".format(offer_url))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("category")
+    parser.add_argument("region", nargs="?")
+    parser.add_argument("--pages", type=int, default=1)
+    parser.add_argument("--offers", type=int, default=10)
+    parser.add_argument("--prefix", default="search")
+    args = parser.parse_args()
+    record(args.category, args.region, args.pages, args.offers, args.prefix)
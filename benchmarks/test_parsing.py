@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import sys
+
+import pytest
+from bs4 import BeautifulSoup
+
+import trojmiastopl.category
+import trojmiastopl.listing
+import trojmiastopl.offer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+if sys.version_info < (3, 3):
+    from mock import mock
+else:
+    from unittest import mock
+
+pytest.importorskip("pytest_benchmark")
+
+OFFER_URL = "https://ogloszenia.trojmiasto.pl/nieruchomosci-mam-do-wynajecia/mieszkanie-ogl{0}.html"
+
+
+def get_peak_memory(function):
+    """ Runs function once and returns peak memory allocated by it in KiB, None if tracemalloc is not available """
+    if tracemalloc is None:
+        return
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+
+def run_benchmark(benchmark, function, pages):
+    """ Times parsing of every page and stores throughput and peak memory in benchmark extra info """
+    def parse_pages():
+        for page in pages:
+            function(page)
+
+    benchmark(parse_pages)
+    benchmark.extra_info["pages"] = len(pages)
+    if benchmark.stats is not None:
+        benchmark.extra_info["pages_per_second"] = round(len(pages) / benchmark.stats.stats.mean, 1)
+    benchmark.extra_info["peak_memory_kib"] = get_peak_memory(parse_pages)
+
+
+@pytest.fixture(scope="module")
+def sidebars(offer_pages):
+    return [str(BeautifulSoup(markup, "html.parser").find(id="sidebar")) for markup in offer_pages]
+
+
+def test_parse_offer(benchmark, backend, offer_pages):
+    # Every page gets its own url, so parse_offer is measured without network, straight from recorded responses
+    responses = {
+        OFFER_URL.format(i): mock.Mock(content=markup, status_code=200) for i, markup in enumerate(offer_pages)
+    }
+    with mock.patch("trojmiastopl.offer.get_content_for_url", side_effect=lambda url, *args, **kwargs: responses[url]):
+        assert all(trojmiastopl.offer.parse_offer(url) for url in responses)
+        run_benchmark(benchmark, trojmiastopl.offer.parse_offer, sorted(responses))
+
+
+def test_parse_available_offers(benchmark, backend, search_pages):
+    assert all(trojmiastopl.category.parse_available_offers(markup) for markup in search_pages)
+    run_benchmark(benchmark, trojmiastopl.category.parse_available_offers, search_pages)
+
+
+def test_get_page_count(benchmark, backend, search_pages):
+    run_benchmark(benchmark, trojmiastopl.category.get_page_count, search_pages)
+
+
+def test_parse_listing_page(benchmark, search_pages):
+    assert all(trojmiastopl.listing.parse_listing_page(markup)["listings"] for markup in search_pages)
+    run_benchmark(benchmark, trojmiastopl.listing.parse_listing_page, search_pages)
+
+
+def test_parse_region(benchmark, backend, sidebars):
+    assert all(trojmiastopl.offer.parse_region(markup) for markup in sidebars)
+    run_benchmark(benchmark, trojmiastopl.offer.parse_region, sidebars)
+
+
+def test_parse_flat_data(benchmark, backend, sidebars):
+    run_benchmark(benchmark, trojmiastopl.offer.parse_flat_data, sidebars)
@@ -2,9 +2,9 @@
 # -*- coding: utf-8 -*-
 
 import logging
+from itertools import islice
 
-from trojmiastopl.category import get_category
-from trojmiastopl.offer import parse_offer
+from trojmiastopl.category import iter_offers
 
 log = logging.getLogger(__file__)
 
@@ -14,7 +14,6 @@ if __name__ == '__main__':
         "data_wprow": "3d",
         "cena[]": (2000, None)
     }
-    parsed_urls = get_category("nieruchomosci-mam-do-wynajecia", "Gdańsk", **search_filters)[:3]
-    for element in (parse_offer(url) for url in parsed_urls if url):
+    for element in islice(iter_offers("nieruchomosci-mam-do-wynajecia", "Gdańsk", **search_filters), 3):
         print()
         print(element)
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-from distutils.core import setup
+from setuptools import setup
 
 setup(
     name='pytrojmiastopl',
@@ -10,4 +10,7 @@ setup(
     author_email='mail@limebrains.com',
     url='https://github.com/limebrains/pytrojmiastopl',
     packages=['trojmiastopl'],
+    extras_require={
+        'async': ['aiohttp'],
+    },
 )
\ No newline at end of file
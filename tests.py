@@ -1,14 +1,31 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 import sys
+from collections import OrderedDict
 
 import pytest
+import requests
 from bs4 import BeautifulSoup
 
 import trojmiastopl
+import trojmiastopl.amenities
+import trojmiastopl.archive
+import trojmiastopl.batch
+import trojmiastopl.cache
 import trojmiastopl.utils
 import trojmiastopl.category
+import trojmiastopl.changes
+import trojmiastopl.export
+import trojmiastopl.incremental
+import trojmiastopl.listing
+import trojmiastopl.metrics
+import trojmiastopl.mockserver
+import trojmiastopl.models
 import trojmiastopl.offer
+import trojmiastopl.pipeline
+import trojmiastopl.ratelimit
+import trojmiastopl.replay
+import trojmiastopl.store
 
 if sys.version_info < (3, 3):
     from mock import mock
@@ -46,11 +63,64 @@ def test_get_url(category, region, filters):
                "http://trojmiasto.pl/ogloszenia/nieruchomosci-mam-do-wynajecia/ai,300_,dw,1d,s,Gdansk.html"
 
 
+def test_build_url_for_payload():
+    category = "nieruchomosci-mam-do-wynajecia"
+    payload = trojmiastopl.utils.get_search_payload(
+        category, u"Gdańsk", offer_type="Mieszkanie", data_wprow="3d", **{"cena[]": (2500, None)}
+    )
+    assert trojmiastopl.utils.build_url_for_payload(category, payload) == SEARCH_URL
+    assert trojmiastopl.utils.build_url_for_payload(category, payload + (("kaucja[]", 1),)) is None
+
+
+@pytest.mark.parametrize("category,region,filters", [
+    ("nieruchomosci-mam-do-wynajecia", "Gdansk", {"data_wprow": "1d", "cena[]": (300, None)}),
+])
+def test_get_url_cache(category, region, filters, tmpdir):
+    url_cache = trojmiastopl.cache.UrlCache(str(tmpdir.join("urls.json")))
+    with mock.patch("trojmiastopl.utils._url_cache", url_cache):
+        with mock.patch("trojmiastopl.utils.get_url_for_filters") as get_url_for_filters:
+            get_url_for_filters.return_value = SEARCH_URL
+            assert trojmiastopl.utils.get_url(category, region, **filters) == SEARCH_URL
+            assert trojmiastopl.utils.get_url(category, region, **filters) == SEARCH_URL
+            assert get_url_for_filters.call_count == 1
+    payload = trojmiastopl.utils.get_search_payload(category, region, **filters)
+    search_url = trojmiastopl.utils.SEARCH_URL
+    assert trojmiastopl.cache.UrlCache(url_cache.path).get(tuple(reversed(payload)), search_url) == SEARCH_URL
+    assert trojmiastopl.cache.UrlCache(url_cache.path).get(payload, "http://127.0.0.1:8000/szukaj/") is None
+    assert trojmiastopl.cache.UrlCache(url_cache.path, ttl=-1).get(payload, search_url) is None
+
+
+def test_url_cache_shared(tmpdir):
+    path = str(tmpdir.join("urls.json"))
+    first, second = trojmiastopl.cache.UrlCache(path), trojmiastopl.cache.UrlCache(path)
+    assert first.get((("a", "1"),)) is None and second.get((("b", "2"),)) is None
+    first.set((("a", "1"),), "a.html")
+    second.set((("b", "2"),), "b.html")
+    assert second.get((("a", "1"),)) == "a.html"
+    assert trojmiastopl.cache.UrlCache(path).get((("a", "1"),)) == "a.html"
+    assert trojmiastopl.cache.UrlCache(path).get((("b", "2"),)) == "b.html"
+
+
 @pytest.mark.parametrize("test_url", [OFFER_URL])
 def test_get_conntent_for_url(test_url):
     assert trojmiastopl.utils.get_content_for_url(test_url)
 
 
+def test_create_session():
+    session = trojmiastopl.utils.create_session(pool_size=5, retries=2)
+    adapter = session.get_adapter(OFFER_URL)
+    assert adapter._pool_maxsize == 5
+    assert adapter.max_retries.total == 2
+    assert 429 in adapter.max_retries.status_forcelist
+
+
+def test_get_content_for_url_session():
+    session = mock.Mock()
+    trojmiastopl.utils.get_content_for_url(OFFER_URL, session)
+    assert session.get.call_args[1]["timeout"] == trojmiastopl.utils.TIMEOUT
+    session.get.return_value.raise_for_status.assert_called_once_with()
+
+
 @pytest.mark.parametrize("page_count", [response.content])
 def test_get_page_count(page_count):
     assert trojmiastopl.category.get_page_count(page_count) <= 3
@@ -131,6 +201,39 @@ def test_parse_offer(offer_url):
     assert isinstance(trojmiastopl.offer.parse_offer(offer_url), dict)
 
 
+def test_parse_offer_markup(response_parser):
+    test = trojmiastopl.offer.parse_offer_markup(response_parser, OFFER_URL)
+    assert test["offer_id"] == "60714359"
+    assert test["surface"] == 35.0
+    assert test["url"] == OFFER_URL
+
+
+def test_parse_offer_markup_not_available():
+    assert trojmiastopl.offer.parse_offer_markup("<html><body></body></html>") is None
+
+
+@pytest.mark.parametrize("backend", trojmiastopl.utils.PARSER_BACKENDS)
+def test_parser_backends(backend, response_parser):
+    expected_offer = trojmiastopl.offer.parse_offer_markup(response_parser, OFFER_URL)
+    expected_offers = trojmiastopl.category.parse_available_offers(response.content)
+    with mock.patch("trojmiastopl.utils.PARSER_BACKEND", trojmiastopl.utils.PARSER_BACKEND):
+        trojmiastopl.utils.set_parser_backend(backend)
+        assert trojmiastopl.offer.parse_offer_markup(response_parser, OFFER_URL) == expected_offer
+        assert trojmiastopl.category.parse_available_offers(response.content) == expected_offers
+        assert trojmiastopl.category.get_page_count(response.content) <= 3
+
+
+def test_set_parser_backend():
+    with pytest.raises(ValueError):
+        trojmiastopl.utils.set_parser_backend("html5lib")
+    with mock.patch("trojmiastopl.utils.PARSER_BACKEND", trojmiastopl.utils.PARSER_BACKEND):
+        with mock.patch("trojmiastopl.utils.lxml", None), mock.patch("trojmiastopl.utils.log") as log:
+            trojmiastopl.utils.set_parser_backend("lxml")
+            assert trojmiastopl.utils.get_parser_backend() == "html.parser"
+            assert trojmiastopl.utils.get_soup("<p></p>").find("p") is not None
+        assert log.warning.call_count == 1
+
+
 def test_parse_flat_data(sidebar_parser):
     test = trojmiastopl.offer.parse_flat_data(sidebar_parser)
     assert test["pietro"] == 4
@@ -164,3 +267,549 @@ def test_get_category(category, region, filters):
                 get_content_for_url.return_value = response
                 get_url.return_value = trojmiastopl.utils.get_url
                 trojmiastopl.category.get_category(category, region, **filters)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8), reason="requires Python3.8")
+def test_aget_category():
+    aio = pytest.importorskip("trojmiastopl.aio")
+    fetcher = mock.Mock(get=mock.AsyncMock(return_value=response.content), executor=None)
+    with mock.patch("trojmiastopl.aio.aget_url", mock.AsyncMock(return_value=SEARCH_URL)):
+        offers = aio.asyncio.run(aio.aget_category("nieruchomosci-mam-do-wynajecia", "Gdansk", fetcher))
+    page_count = trojmiastopl.category.get_page_count(response.content)
+    assert fetcher.get.call_count == page_count
+    assert len(offers) == page_count * len(trojmiastopl.category.parse_available_offers(response.content))
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8), reason="requires Python3.8")
+def test_aget_url_cache(tmpdir):
+    aio = pytest.importorskip("trojmiastopl.aio")
+    fetcher = mock.Mock(post=mock.AsyncMock(return_value=b""), executor=None)
+    filters = {"data_wprow": "1d", "cena[]": (300, None)}
+    url_cache = trojmiastopl.cache.UrlCache(str(tmpdir.join("urls.json")))
+    with mock.patch("trojmiastopl.utils._url_cache", url_cache):
+        with mock.patch("trojmiastopl.utils.parse_url_for_filters", return_value=SEARCH_URL):
+            for _ in range(2):
+                url = aio.asyncio.run(aio.aget_url("nieruchomosci-mam-do-wynajecia", "Gdansk", fetcher, **filters))
+                assert url == SEARCH_URL
+        with mock.patch("trojmiastopl.utils.get_url_for_filters") as get_url_for_filters:
+            assert trojmiastopl.utils.get_url("nieruchomosci-mam-do-wynajecia", "Gdansk", **filters) == SEARCH_URL
+            assert not get_url_for_filters.called
+    assert fetcher.post.call_count == 1
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8), reason="requires Python3.8")
+def test_aparse_offer(response_parser):
+    aio = pytest.importorskip("trojmiastopl.aio")
+    fetcher = mock.Mock(get=mock.AsyncMock(return_value=response_parser), executor=None)
+    offer = aio.asyncio.run(aio.aparse_offer(OFFER_URL, fetcher))
+    assert offer == trojmiastopl.offer.parse_offer_markup(response_parser, OFFER_URL)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8), reason="requires Python3.8")
+def test_acrawl_bounded():
+    aio = pytest.importorskip("trojmiastopl.aio")
+    fetcher = mock.Mock(concurrency=2)
+    running = []
+
+    async def aparse_offer(url, fetcher):
+        running.append(url)
+        assert len(running) <= fetcher.concurrency
+        await aio.asyncio.sleep(0)
+        running.remove(url)
+        return None if url == "a-ogl3.html" else {"url": url}
+
+    async def crawl():
+        return [offer async for offer in aio.acrawl("nieruchomosci-mam-do-wynajecia", "Gdansk", fetcher)]
+
+    urls = ["a-ogl{0}.html".format(i) for i in range(6)] + [None]
+    with mock.patch("trojmiastopl.aio.aget_category", mock.AsyncMock(return_value=urls)):
+        with mock.patch("trojmiastopl.aio.aparse_offer", aparse_offer):
+            offers = aio.asyncio.run(crawl())
+    assert sorted(offer["url"] for offer in offers) == [url for url in urls if url and url != "a-ogl3.html"]
+
+
+@pytest.mark.parametrize("category,region,filters", [
+    ("nieruchomosci-mam-do-wynajecia", "Gdansk", {"data_wprow": "1d", "cena[]": (300, None)}),
+])
+def test_iter_category(category, region, filters):
+    with mock.patch("trojmiastopl.category.get_url") as get_url:
+        with mock.patch("trojmiastopl.category.get_content_for_url") as get_content_for_url:
+            get_url.return_value = SEARCH_URL
+            get_content_for_url.return_value = response
+            offers = trojmiastopl.category.iter_category(category, region, **filters)
+            assert next(offers) == trojmiastopl.category.parse_available_offers(response.content)[0]
+
+
+@pytest.mark.parametrize("category,region,filters", [
+    ("nieruchomosci-mam-do-wynajecia", "Gdansk", {"data_wprow": "1d", "cena[]": (300, None)}),
+])
+def test_iter_offers(category, region, filters):
+    with mock.patch("trojmiastopl.category.iter_category") as iter_category:
+        with mock.patch("trojmiastopl.category.parse_offer") as parse_offer:
+            iter_category.return_value = iter([OFFER_URL, OFFER_URL])
+            parse_offer.side_effect = [None, {"url": OFFER_URL}]
+            assert list(trojmiastopl.category.iter_offers(category, region, **filters)) == [{"url": OFFER_URL}]
+
+
+def test_parse_result_page():
+    result_page = trojmiastopl.category.parse_result_page(response.content)
+    assert result_page["page_count"] == trojmiastopl.category.get_page_count(response.content)
+    assert result_page["offers"] == trojmiastopl.category.parse_available_offers(response.content)
+    assert result_page["offer_count"] == len(result_page["offers"])
+
+
+def test_parse_listing_page():
+    markup = u"""<html><body><span class="results-count">Znaleziono 1 234 ogłoszenia</span>
+<div class="ogl-item"><div class="ogl-head"><a href="a-ogl1.html"><h2> Kawalerka
+Oliwa</h2></a></div><span class="ogl-price">1 600 zł</span><span class="ogl-surface">28,5 m<sup>2</sup></span>
+<span class="ogl-location">Gdańsk, Oliwa</span><p>unclosed</div>
+<div class="ogl-item"><div class="ogl-head"><a href="b-ogl2.html">Bez tytułu</a></div></div>
+<script>var pages = "99";</script><div class="navi-pages"><a>1</a> <a>2</a> <a>3</a></div></body></html>"""
+    result_page = trojmiastopl.listing.parse_listing_page(markup.encode("utf-8"))
+    assert result_page["page_count"] == 3
+    assert result_page["offers"] == ["a-ogl1.html", "b-ogl2.html"]
+    assert result_page["result_count"] == 1234
+    assert result_page["listings"] == [
+        {"url": "a-ogl1.html", "title": u"Kawalerka Oliwa", "price": 1600, "surface": 28.5,
+         "location": u"Gdańsk, Oliwa"},
+        {"url": "b-ogl2.html", "title": None, "price": None, "surface": None, "location": None},
+    ]
+
+
+@pytest.mark.parametrize("category,region,filters", [
+    ("nieruchomosci-mam-do-wynajecia", "Gdansk", {"data_wprow": "1d", "cena[]": (300, None)}),
+])
+def test_iter_result_pages(category, region, filters):
+    session = mock.Mock()
+    with mock.patch("trojmiastopl.category.get_url") as get_url:
+        with mock.patch("trojmiastopl.category.get_content_for_url") as get_content_for_url:
+            get_url.return_value = SEARCH_URL
+            get_content_for_url.return_value = response
+            pages = list(trojmiastopl.category.iter_result_pages(category, region, session, **filters))
+            assert get_url.call_count == 1
+            assert get_url.call_args[0][2] is session
+            assert get_content_for_url.call_count == len(pages) == pages[0]["page_count"]
+            assert all(call[0][1] is session for call in get_content_for_url.call_args_list)
+            assert [result_page["page"] for result_page in pages] == list(range(len(pages)))
+
+
+def test_iter_listings():
+    markup = u"""<div class="ogl-item"><div class="ogl-head"><a href="a-ogl1.html"><h2>Kawalerka</h2></a></div>
+<span class="ogl-price">1 600 zł</span><span class="ogl-location">Gdańsk, Oliwa</span></div>
+<div class="ogl-item"><div class="ogl-head"><a href="b-ogl2.html"><h2>Dom</h2></a></div>
+<span class="ogl-location">Sopot</span></div><div class="navi-pages">1 2</div>""".encode("utf-8")
+    with mock.patch("trojmiastopl.category.get_url", return_value=SEARCH_URL):
+        with mock.patch("trojmiastopl.category.get_content_for_url") as get_content_for_url:
+            get_content_for_url.return_value = mock.Mock(content=markup)
+            offers = trojmiastopl.category.get_listings("nieruchomosci-mam-do-wynajecia", "Gdansk")
+    assert get_content_for_url.call_count == 2
+    assert len(offers) == 4
+    assert offers[0] == {"offer_id": "1", "url": "a-ogl1.html", "title": "Kawalerka", "price": 1600, "currency": "PLN",
+                         "surface": None, "city": u"Gdańsk", "district": "Oliwa"}
+    assert (offers[1]["city"], offers[1]["district"]) == ("Sopot", None)
+    with mock.patch("trojmiastopl.category.parse_offer") as parse_offer:
+        parse_offer.return_value = {"price": 1500, "rooms": 1}
+        enriched = trojmiastopl.category.enrich_offer(offers[0], fields=("price", "rooms"))
+        parse_offer.assert_called_once_with("a-ogl1.html", None, fields=("price", "rooms"))
+        assert (enriched["title"], enriched["price"], enriched["rooms"]) == ("Kawalerka", 1500, 1)
+        parse_offer.return_value = None
+        assert trojmiastopl.category.enrich_offer(offers[0]) is None
+
+
+def test_response_cache_eviction():
+    response_cache = trojmiastopl.cache.ResponseCache(max_bytes=10)
+    response_cache.set(SEARCH_URL, b"12345")
+    response_cache.set(OFFER_URL, b"12345")
+    assert response_cache.get(SEARCH_URL) == b"12345"
+    response_cache.set(SEARCH_URL + "?strona=1", b"12345")
+    assert response_cache.get(OFFER_URL) is None
+    assert response_cache.get(SEARCH_URL) == b"12345"
+    stats = response_cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["bytes"] == 10
+
+
+def test_response_cache_disk(tmpdir):
+    response_cache = trojmiastopl.cache.ResponseCache(path=str(tmpdir))
+    response_cache.set(OFFER_URL, b"offer")
+    response_cache.set(SEARCH_URL, b"search")
+    assert trojmiastopl.cache.ResponseCache(path=str(tmpdir)).get(OFFER_URL) == b"offer"
+    expired_search = trojmiastopl.cache.ResponseCache(path=str(tmpdir), ttls={"search": -1})
+    assert expired_search.get(SEARCH_URL) is None
+    assert expired_search.get(OFFER_URL) == b"offer"
+    assert expired_search.stats()["disk_hits"] == 1
+
+
+def test_get_content_for_url_cache():
+    session = mock.Mock()
+    session.get.return_value.content = b"offer"
+    with mock.patch("trojmiastopl.utils._response_cache", trojmiastopl.cache.ResponseCache()):
+        assert trojmiastopl.utils.get_content_for_url(OFFER_URL, session).content == b"offer"
+        assert trojmiastopl.utils.get_content_for_url(OFFER_URL, session).content == b"offer"
+        assert trojmiastopl.utils.get_response_cache().stats()["hits"] == 1
+    assert session.get.call_count == 1
+
+
+def test_parse_offer_not_modified(response_parser):
+    session = mock.Mock()
+    session.get.return_value.status_code = 200
+    session.get.return_value.content = response_parser
+    session.get.return_value.headers = {"ETag": '"1"', "Last-Modified": "Mon, 04 Sep 2017 00:00:00 GMT"}
+    with mock.patch("trojmiastopl.utils._response_cache", None):
+        with mock.patch("trojmiastopl.utils._revalidation_cache", trojmiastopl.cache.RevalidationCache()):
+            offer = trojmiastopl.offer.parse_offer(OFFER_URL, session)
+            assert "If-None-Match" not in session.get.call_args[1]["headers"]
+            session.get.return_value.status_code = 304
+            session.get.return_value.content = b""
+            assert trojmiastopl.offer.parse_offer(OFFER_URL, session) == offer
+            assert session.get.call_args[1]["headers"]["If-None-Match"] == '"1"'
+            assert session.get.call_args[1]["headers"]["If-Modified-Since"] == "Mon, 04 Sep 2017 00:00:00 GMT"
+
+
+def test_parse_offer_changed_after_partial_parse(response_parser):
+    session = mock.Mock()
+    session.get.return_value.status_code = 200
+    session.get.return_value.content = response_parser
+    session.get.return_value.headers = {"ETag": '"1"'}
+    with mock.patch("trojmiastopl.utils._response_cache", None):
+        with mock.patch("trojmiastopl.utils._revalidation_cache", trojmiastopl.cache.RevalidationCache()):
+            offer = trojmiastopl.offer.parse_offer(OFFER_URL, session)
+            session.get.return_value.headers = {"ETag": '"2"'}
+            trojmiastopl.offer.parse_offer(OFFER_URL, session, fields=["price"])
+            assert trojmiastopl.utils.get_revalidation_cache().get_result(OFFER_URL) is None
+            assert trojmiastopl.offer.parse_offer(OFFER_URL, session) == offer
+            assert "If-None-Match" not in session.get.call_args[1]["headers"]
+
+
+def test_revalidation_cache_max_entries():
+    revalidation_cache = trojmiastopl.cache.RevalidationCache(max_entries=1)
+    revalidation_cache.set_result(SEARCH_URL, {"price": 1})
+    revalidation_cache.set_result(OFFER_URL, {"price": 2})
+    assert revalidation_cache.get_result(SEARCH_URL) is None
+    assert revalidation_cache.get_result(OFFER_URL) == {"price": 2}
+
+
+def test_get_offer_id():
+    assert trojmiastopl.utils.get_offer_id(OFFER_URL) == "60714359"
+    assert trojmiastopl.utils.get_offer_id(SEARCH_URL) is None
+
+
+def test_iter_new_offers(tmpdir):
+    seen = trojmiastopl.incremental.SeenOffers(str(tmpdir.join("seen.json")))
+    seen.add("60714359", 1504483200)
+    new_url = OFFER_URL.replace("60714359", "60714360")
+    pages = [
+        {"page": 0, "offers": [new_url, OFFER_URL]},
+        {"page": 1, "offers": [OFFER_URL]},
+        {"page": 2, "offers": [new_url]},
+    ]
+    with mock.patch("trojmiastopl.incremental.iter_result_pages") as iter_result_pages:
+        with mock.patch("trojmiastopl.incremental.parse_offer") as parse_offer:
+            iter_result_pages.return_value = iter(pages)
+            parse_offer.return_value = {"date_added": 1504483200, "date_updated": None}
+            offers = list(trojmiastopl.incremental.iter_new_offers("nieruchomosci-mam-do-wynajecia", seen))
+            assert len(offers) == 1
+            parse_offer.assert_called_once_with(new_url)
+    assert "60714360" in trojmiastopl.incremental.SeenOffers(seen.path)
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+def test_parse_offers(ordered, response_parser):
+    urls = [OFFER_URL + "?{0}".format(i) for i in range(6)]
+    with mock.patch("trojmiastopl.pipeline.get_content_for_url") as get_content_for_url:
+        get_content_for_url.return_value.content = response_parser
+        offers = list(trojmiastopl.pipeline.parse_offers(urls, parse_workers=2, ordered=ordered, max_pending=2))
+    assert len(offers) == len(urls)
+    assert offers[0]["offer_id"] == "60714359"
+    if ordered:
+        assert [offer["url"] for offer in offers] == urls
+    else:
+        assert sorted(offer["url"] for offer in offers) == urls
+
+
+def test_offer_record(response_parser):
+    offer = trojmiastopl.offer.parse_offer_markup(response_parser, OFFER_URL)
+    record = trojmiastopl.models.Offer.from_dict(offer)
+    assert record.to_dict() == offer
+    assert not hasattr(record, "__dict__")
+    assert record.price_per_surface == offer["price/surface"]
+    for amenity in trojmiastopl.models.AMENITIES:
+        assert record.has(amenity) == offer["additional"][amenity]
+
+
+def test_pack_amenities():
+    flags = trojmiastopl.models.pack_amenities({"balcony": True, "garage": True, "kitchen": False})
+    assert flags == trojmiastopl.models.AMENITY_FLAGS["balcony"] | trojmiastopl.models.AMENITY_FLAGS["garage"]
+    unpacked = trojmiastopl.models.unpack_amenities(flags)
+    assert unpacked["balcony"] and unpacked["garage"] and not unpacked["kitchen"]
+    assert list(trojmiastopl.models.AMENITIES) == trojmiastopl.amenities.AMENITY_MATCHER.amenities
+
+
+def test_offer_batch(response_parser):
+    numpy = pytest.importorskip("numpy")
+    offer = trojmiastopl.offer.parse_offer_markup(response_parser, OFFER_URL)
+    batch = trojmiastopl.export.OfferBatch([offer, None, trojmiastopl.models.Offer.from_dict(offer)])
+    assert len(batch) == 2
+    columns = batch.to_numpy()
+    assert list(columns["surface"]) == [35.0, 35.0]
+    assert columns["amenities"].shape == (2, len(trojmiastopl.models.AMENITIES))
+    balcony = trojmiastopl.models.AMENITIES.index("balcony")
+    assert list(columns["amenities"][:, balcony]) == [offer["additional"]["balcony"]] * 2
+    assert numpy.isnan(columns["built_date"]).all()
+
+
+def test_offer_batch_parquet(response_parser, tmpdir):
+    pyarrow_parquet = pytest.importorskip("pyarrow.parquet")
+    offer = trojmiastopl.offer.parse_offer_markup(response_parser, OFFER_URL)
+    path = str(tmpdir.join("offers.parquet"))
+    trojmiastopl.export.OfferBatch([offer]).write_parquet(path)
+    table = pyarrow_parquet.read_table(path)
+    assert table.column("price").to_pylist() == [offer["price"]]
+    assert table.column("built_date").to_pylist() == [None]
+
+
+@pytest.mark.parametrize("text,expected", [
+    (u"balkon, winda", {"balcony", "elevator"}),
+    (u"BALKON, Winda", {"balcony", "elevator"}),
+    (u"garaz, ogrodek, kablowka", {"garage", "garden", "cable_tv"}),
+    (u"", set()),
+])
+def test_amenity_matcher(text, expected):
+    assert trojmiastopl.amenities.AMENITY_MATCHER.match(text) == expected
+
+
+def test_amenity_matcher_add():
+    matcher = trojmiastopl.amenities.AmenityMatcher(trojmiastopl.amenities.AMENITY_KEYWORDS)
+    matcher.add("air_conditioning", u"klimatyzacja")
+    assert matcher.match_many([u"Klimatyzacja, taras", u"piwnica"]) == [{"air_conditioning", "terrace"}, {"basement"}]
+    assert matcher.match_dict(u"taras")["air_conditioning"] is False
+    assert "air_conditioning" not in trojmiastopl.amenities.AMENITY_MATCHER.amenities
+
+
+def test_amenity_matcher_overlapping():
+    matcher = trojmiastopl.amenities.AmenityMatcher(OrderedDict([
+        ("kitchen", (u"kuchnia",)),
+        ("summer_kitchen", (u"kuchnia letnia",)),
+        ("garden", (u"ogród",)),
+        ("garden_view", (u"widok na ogród",)),
+    ]))
+    assert matcher.match(u"Kuchnia letnia, widok na ogrod") == {"kitchen", "summer_kitchen", "garden", "garden_view"}
+    assert matcher.match(u"kuchnia") == {"kitchen"}
+
+
+def test_set_base_url():
+    with mock.patch.multiple("trojmiastopl.utils", BASE_URL=trojmiastopl.utils.BASE_URL,
+                             SEARCH_URL=trojmiastopl.utils.SEARCH_URL):
+        trojmiastopl.utils.set_base_url("http://127.0.0.1:8000/")
+        assert trojmiastopl.utils.SEARCH_URL == "http://127.0.0.1:8000/szukaj/"
+        assert trojmiastopl.utils.get_url("nieruchomosci-mam-do-wynajecia") == \
+            "http://127.0.0.1:8000/nieruchomosci-mam-do-wynajecia/"
+
+
+def test_mockserver():
+    with mock.patch.multiple("trojmiastopl.utils", BASE_URL=trojmiastopl.utils.BASE_URL,
+                             SEARCH_URL=trojmiastopl.utils.SEARCH_URL, _url_cache=None), \
+            trojmiastopl.mockserver.MockServer(offer_count=95, offers_per_page=10) as server:
+        trojmiastopl.utils.set_base_url(server.url)
+        offers = trojmiastopl.category.get_category("nieruchomosci-mam-do-wynajecia", "Gdańsk", data_wprow="3d")
+        assert len(set(offers)) == 95
+        offer = trojmiastopl.offer.parse_offer(offers[0])
+        assert offer["offer_id"] == trojmiastopl.utils.get_offer_id(offers[0])
+        assert server.stats() == {"search": 1, "results": 10, "offer": 1, "errors": 0}
+
+
+def test_metrics_disabled():
+    assert not trojmiastopl.metrics.is_enabled()
+    assert trojmiastopl.metrics.start() is None
+
+
+def test_metrics_registry(response_parser):
+    registry = trojmiastopl.metrics.MetricsRegistry()
+    trojmiastopl.metrics.add_hook(registry)
+    try:
+        trojmiastopl.offer.parse_offer_markup(response_parser, OFFER_URL)
+    finally:
+        trojmiastopl.metrics.remove_hook(registry)
+    assert registry.get_counter("offers_total") == 1
+    assert registry.get_counter("pages_total", page="offer") == 1
+    assert registry.get_timing("extract_seconds", extractor="region")["count"] == 1
+    tree_seconds = registry.get_timing("extract_seconds", extractor="tree")["sum"]
+    assert registry.get_timing("parse_seconds")["sum"] >= tree_seconds
+    exported = registry.to_prometheus()
+    assert "# TYPE trojmiastopl_offers_total counter\ntrojmiastopl_offers_total 1\n" in exported
+    assert 'trojmiastopl_extract_seconds_count{extractor="flat_data"} 1' in exported
+
+
+@pytest.mark.parametrize("dogstatsd,expected", [
+    (False, "trojmiastopl.fetch_seconds.200.offer:250.000|ms"),
+    (True, "trojmiastopl.fetch_seconds:250.000|ms|#status:200,url_class:offer"),
+])
+def test_statsd_hook(dogstatsd, expected):
+    hook = trojmiastopl.metrics.StatsdHook(dogstatsd=dogstatsd)
+    assert hook.format("timing", "fetch_seconds", 0.25, {"url_class": "offer", "status": 200}) == expected
+    assert hook.format("counter", "offers_total", 3, {}) == "trojmiastopl.offers_total:3|c"
+    hook.close()
+
+
+@pytest.mark.parametrize("url,method,expected", [
+    (trojmiastopl.utils.SEARCH_URL, "POST", "search"),
+    (SEARCH_URL, "GET", "listing"),
+    (OFFER_URL, "GET", "offer"),
+])
+def test_get_endpoint(url, method, expected):
+    assert trojmiastopl.ratelimit.get_endpoint(url, method) == expected
+
+
+def test_token_bucket():
+    bucket = trojmiastopl.ratelimit.TokenBucket(2, burst=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.5, abs=0.05)
+    assert bucket.reserve() == pytest.approx(1.0, abs=0.05)
+
+
+def test_adaptive_token_bucket():
+    bucket = trojmiastopl.ratelimit.AdaptiveTokenBucket(4, min_rate=1, max_rate=4.2, cooldown=60)
+    bucket.update(429)
+    bucket.update(503)
+    assert bucket.rate == 2
+    bucket.update(200, latency=0.1)
+    assert bucket.rate == pytest.approx(2.1)
+    bucket.update(429, retry_after=10)
+    assert bucket.rate == pytest.approx(2.1)
+    assert bucket.reserve() == pytest.approx(10 + 1 / 2.1, abs=0.05)
+    for _ in range(30):
+        bucket.update(200, latency=0.1)
+    assert bucket.rate == 4.2
+
+
+def test_rate_limiter():
+    with pytest.raises(ValueError):
+        trojmiastopl.ratelimit.RateLimiter(listings=(1, 1, 1))
+    limiter = trojmiastopl.ratelimit.RateLimiter(global_rate=(10, 1, 10), offer=(5, 1, 5))
+    limiter.update("offer", 429)
+    assert limiter.rates() == {"global": 5, "search": 1, "listing": 2, "offer": 2.5}
+
+
+def test_lazy_offer(response_parser):
+    offer = trojmiastopl.offer.LazyOffer(response_parser, OFFER_URL)
+    assert offer["price/surface"] == round(offer["price"] / offer["surface"])
+    assert sorted(offer._extracted) == ["flat_data", "surface"]
+    assert offer.is_available
+    assert dict(offer) == trojmiastopl.offer.parse_offer_markup(response_parser, OFFER_URL)
+    with pytest.raises(KeyError):
+        offer["unknown"]
+
+
+def test_parse_offer_markup_fields(response_parser):
+    expected = trojmiastopl.offer.parse_offer_markup(response_parser, OFFER_URL)
+    fields = ("offer_id", "price", "surface")
+    assert trojmiastopl.offer.parse_offer_markup(response_parser, OFFER_URL, fields) == {
+        field: expected[field] for field in fields
+    }
+
+
+def test_batch_crawl():
+    listings = {
+        "Gdańsk": ["https://ogloszenia.trojmiasto.pl/a-ogl1.html", "https://ogloszenia.trojmiasto.pl/b-ogl2.html"],
+        "Sopot": ["https://ogloszenia.trojmiasto.pl/b-ogl2.html?x", "https://ogloszenia.trojmiasto.pl/c-ogl3.html"],
+    }
+    jobs = [("nieruchomosci", "Gdańsk", None), ("nieruchomosci", "Sopot", {}), ("nieruchomosci", "Gdańsk", {})]
+    parse_offers = lambda urls, *args, **kwargs: ({"url": url} for url in urls)
+    with mock.patch("trojmiastopl.batch.iter_category", side_effect=lambda category, region: listings[region]), \
+            mock.patch("trojmiastopl.batch.parse_offers", side_effect=parse_offers):
+        crawl = trojmiastopl.batch.BatchCrawl(jobs)
+        results = crawl.run()
+    assert [[trojmiastopl.utils.get_offer_id(offer["url"]) for offer in offers] for offers in results] == [
+        ["1", "2"], ["2", "3"], ["1", "2"]
+    ]
+    assert results[0][1] is results[1][0]
+    assert crawl.stats() == {"jobs": 3, "searches": 2, "offer_urls": 6, "unique_offers": 3, "parsed": 3}
+
+
+def test_offer_store():
+    offers = [
+        {"offer_id": "1", "url": "a-ogl1.html", "city": "Gdańsk", "rooms": 2, "price": 2500, "deposit": 2500,
+         "date_updated": 10, "additional": {"balcony": True}},
+        {"offer_id": "2", "url": "b-ogl2.html", "city": "Gdańsk", "rooms": 4, "price": 2800, "date_updated": 10,
+         "additional": {}},
+        {"offer_id": "3", "url": "c-ogl3.html", "city": "Sopot", "rooms": 3, "price": 2000, "date_updated": 10},
+    ]
+    with trojmiastopl.store.OfferStore() as store:
+        assert store.add_from(offers + [None], batch_size=2) == 3
+        assert len(store) == 3 and "2" in store
+        assert store.get("1") == offers[0]
+        assert store.upsert(offers[0]) is False
+        assert store.upsert(dict(offers[0], price=2300, date_updated=20)) is True
+        assert [entry["price"] for entry in store.history("1")] == [2500, 2300]
+        found = store.query(city="Gdańsk", rooms=(2, 3), price=(None, 3000))
+        assert [offer["offer_id"] for offer in found] == ["1"]
+        assert [offer["offer_id"] for offer in store.query(order_by="-price", limit=2)] == ["2", "1"]
+        assert [offer["offer_id"] for offer in store.query(amenities=["balcony"])] == ["1"]
+        with pytest.raises(ValueError):
+            store.query(colour="red")
+
+
+def test_change_detector():
+    url = "https://ogloszenia.trojmiasto.pl/a-ogl1.html"
+    offer = {"url": url, "price": 2500, "deposit": 2500, "description": "Mieszkanie", "images": ["1.jpg"]}
+    detector = trojmiastopl.changes.ChangeDetector()
+    assert detector.detect(url, offer).kind == trojmiastopl.changes.NEW
+    assert detector.detect(url, dict(offer, description=" Mieszkanie\n", title="x")) is None
+    change = detector.detect(url, dict(offer, price=2300))
+    assert (change.kind, change.key, change.old_price, change.offer["price"]) == ("price_changed", "1", 2500, 2300)
+    assert detector.detect(url, dict(offer, price=2300, images=["1.jpg", "2.jpg"])).kind == "updated"
+    assert detector.detect(url, None).kind == trojmiastopl.changes.REMOVED
+    assert detector.detect(url, None) is None
+    assert len(detector) == 0
+
+
+def test_iter_changes_request_error():
+    detector = trojmiastopl.changes.ChangeDetector()
+    urls = ["https://ogloszenia.trojmiasto.pl/a-ogl{0}.html".format(i) for i in range(3)]
+    for url in urls:
+        detector.detect(url, {"url": url, "price": 2500})
+
+    def parse_offer(url):
+        if url == urls[2]:
+            raise requests.ConnectionError()
+        raise requests.HTTPError(response=mock.Mock(status_code=410 if url == urls[0] else 503))
+
+    with mock.patch("trojmiastopl.changes.parse_offer", parse_offer):
+        changes = list(trojmiastopl.changes.iter_changes(urls, detector))
+    assert [(change.kind, change.url) for change in changes] == [(trojmiastopl.changes.REMOVED, urls[0])]
+    assert len(detector) == 2
+
+
+def test_page_archive(tmpdir, response_parser):
+    path = str(tmpdir.join("archive"))
+    with trojmiastopl.archive.PageArchive(path, "w", segment_max_bytes=1) as archive:
+        archive.write(SEARCH_URL, response.content, fetched=1)
+        archive.write(OFFER_URL, response_parser, fetched=2)
+        archive.write(OFFER_URL, response_parser, fetched=3)
+    tmpdir.join("archive", "index.tsv").write("")
+    tmpdir.join("archive", "000002.seg").write(b"TPA1", mode="ab")
+    archive = trojmiastopl.archive.PageArchive(path)
+    assert len(archive) == 3 and len(tmpdir.join("archive").listdir()) == 5
+    assert tmpdir.join("archive", "index.tsv").read() == "" and tmpdir.join("archive", "000002.seg").size() > 4
+    with pytest.raises(IOError):
+        archive.write(OFFER_URL, response_parser)
+    with trojmiastopl.archive.PageArchive(path, "w") as writer:
+        assert len(writer) == 3 and len(tmpdir.join("archive", "index.tsv").readlines()) == 3
+        with pytest.raises(IOError):
+            trojmiastopl.archive.PageArchive(path, "w")
+    assert archive.get(OFFER_URL) == response_parser
+    assert [page[1] for page in archive.iter_pages("offer", since=2, latest=True)] == [3]
+    offers = list(trojmiastopl.replay.replay_offers(archive, until=3))
+    assert offers == [trojmiastopl.offer.parse_offer_markup(response_parser, OFFER_URL)]
+    result_pages = list(trojmiastopl.replay.replay_result_pages(archive))
+    assert result_pages[0]["offers"] == trojmiastopl.category.parse_available_offers(response.content)
+
+
+def test_replay_offers_skips_failed(tmpdir):
+    with trojmiastopl.archive.PageArchive(str(tmpdir), "w") as archive:
+        archive.write(OFFER_URL, b"broken")
+        archive.write(OFFER_URL, b"offer")
+        parse = mock.Mock(side_effect=[ValueError("broken"), {"url": OFFER_URL}])
+        with mock.patch("trojmiastopl.replay.parse_offer_markup_with_backend", parse):
+            assert list(trojmiastopl.replay.replay_offers(archive)) == [{"url": OFFER_URL}]
@@ -14,4 +14,4 @@ if (2, 7) <= sys.version_info < (3, 6):
     logger = logging.getLogger('trojmiastopl')
     logging.basicConfig(level=logging.DEBUG)
 
-BASE_URL = 'http://ogloszenia.trojmiasto.pl'
+BASE_URL = os.environ.get('TROJMIASTOPL_BASE_URL', 'http://ogloszenia.trojmiasto.pl').rstrip('/')
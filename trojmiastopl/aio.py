@@ -0,0 +1,255 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import time
+from urllib.parse import urlsplit
+
+from scrapper_helpers.utils import get_random_user_agent
+
+try:
+    import aiohttp
+except ImportError:
+    raise ImportError("trojmiastopl.aio requires aiohttp, install it with: pip install pytrojmiastopl[async]")
+
+from trojmiastopl import metrics, utils
+from trojmiastopl.cache import get_url_class
+from trojmiastopl.category import parse_available_offers, parse_result_page
+from trojmiastopl.offer import parse_offer_markup
+from trojmiastopl.ratelimit import get_endpoint, get_retry_after
+
+log = logging.getLogger(__file__)
+
+CONCURRENCY = 10
+HOST_CONCURRENCY = 4
+HOST_DELAY = 0.25
+TIMEOUT = 30
+
+
+async def _run_in_executor(fetcher, func, *args):
+    # Parsing is CPU-bound, running it in executor keeps event loop serving other requests
+    return await asyncio.get_running_loop().run_in_executor(fetcher.executor, func, *args)
+
+
+class AsyncFetcher(object):
+    """ Shared aiohttp session with bounded concurrency and per-host politeness
+
+    Requests are limited globally by concurrency, every host gets at most host_concurrency open connections
+    and consecutive requests to the same host are started at least host_delay seconds apart. If rate limiting is
+    enabled (see :meth:`utils.configure_rate_limit`), requests also wait for the limiter shared with threads.
+    Pages are parsed in executor, default thread pool of event loop if not given, so parsing doesn't block
+    requests in flight.
+
+    :Example:
+
+    async with AsyncFetcher(concurrency=20) as fetcher:
+        offers = [offer async for offer in acrawl("nieruchomosci-mam-do-wynajecia", "Gdańsk", fetcher)]
+    """
+
+    def __init__(self, concurrency=CONCURRENCY, host_concurrency=HOST_CONCURRENCY, host_delay=HOST_DELAY,
+                 timeout=TIMEOUT, executor=None):
+        self.concurrency = concurrency
+        self.executor = executor
+        self.host_concurrency = host_concurrency
+        self.host_delay = host_delay
+        self.timeout = timeout
+        self._session = None
+        self._semaphore = None
+        self._host_locks = {}
+        self._host_last_request = {}
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.host_concurrency)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+
+    async def _wait_for_host(self, url):
+        host = urlsplit(url).netloc
+        lock = self._host_locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            delay = self._host_last_request.get(host, 0) + self.host_delay - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._host_last_request[host] = time.monotonic()
+
+    async def request(self, method, url, data=None):
+        """ Sends request and returns response body
+
+        :param method: HTTP method
+        :param url: Website url
+        :param data: Form data
+        :type method: str
+        :type url: str
+        :type data: tuple, None
+        :return: Response body
+        :rtype: bytes
+
+        :except: aiohttp.ClientResponseError for 4xx and 5xx responses
+        """
+        async with self._semaphore:
+            await self._wait_for_host(url)
+            rate_limiter = utils.get_rate_limiter()
+            if rate_limiter is not None:
+                endpoint = get_endpoint(url, method)
+                delay = rate_limiter.reserve(endpoint)
+                if delay:
+                    await asyncio.sleep(delay)
+            log.debug(url)
+            headers = {'User-Agent': get_random_user_agent()}
+            started = metrics.clock()
+            async with self._session.request(method, url, data=data, headers=headers) as response:
+                latency = metrics.clock() - started
+                if rate_limiter is not None:
+                    rate_limiter.update(endpoint, response.status, latency, get_retry_after(response.headers))
+                if metrics.is_enabled():
+                    metrics.timing("fetch_seconds", latency, url_class=get_url_class(url), status=response.status)
+                response.raise_for_status()
+                body = await response.read()
+            if metrics.is_enabled():
+                metrics.count("fetch_bytes_total", len(body), url_class=get_url_class(url))
+            return body
+
+    async def get(self, url):
+        body = await self.request("GET", url)
+        archive = utils.get_archive()
+        if archive is not None:
+            archive.write(url, body)
+        return body
+
+    async def post(self, url, data):
+        return await self.request("POST", url, data)
+
+
+async def aget_url(category, region=None, fetcher=None, **filters):
+    """ Creates url for given parameters. See :meth:`utils.get_url` for reference
+
+    Shares url cache and offline urls with :meth:`utils.get_url`, search engine is asked only for unknown payloads.
+
+    :param category: Search category
+    :param region: Search region
+    :param fetcher: Fetcher to use, new one is created if not given
+    :param filters: See :meth:`category.get_category` for reference
+    :type category: str
+    :type region: str
+    :type fetcher: AsyncFetcher
+    :type filters: dict
+    :return: Url for given parameters
+    :rtype: str
+    """
+    if not filters:
+        return utils.get_url(category, region)
+    if fetcher is None:
+        async with AsyncFetcher() as fetcher:
+            return await aget_url(category, region, fetcher, **filters)
+    payload = utils.get_search_payload(category, region, **filters)
+    known_url = utils.get_known_url(category, payload)
+    if known_url is not None:
+        return known_url
+    markup = await fetcher.post(utils.SEARCH_URL, [(k, str(v)) for k, v in payload])
+    url = await _run_in_executor(fetcher, utils.parse_url_for_filters, markup)
+    utils.get_url_cache().set(payload, url, utils.SEARCH_URL)
+    return url
+
+
+async def aget_category(category, region=None, fetcher=None, **filters):
+    """ Parses available offer urls from given category from every page, fetching pages concurrently
+
+    :param category: Search category
+    :param region: Search region
+    :param fetcher: Fetcher to use, new one is created if not given
+    :param filters: See :meth:`category.get_category` for reference
+    :type category: str
+    :type region: str
+    :type fetcher: AsyncFetcher
+    :type filters: dict
+    :return: List of all offers for given parameters
+    :rtype: list
+    """
+    if fetcher is None:
+        async with AsyncFetcher() as fetcher:
+            return await aget_category(category, region, fetcher, **filters)
+    url = await aget_url(category, region, fetcher, **filters)
+    result_page = await _run_in_executor(fetcher, parse_result_page, await fetcher.get(url))
+
+    async def get_offers(page):
+        markup = await fetcher.get(url + "?strona={0}".format(page))
+        return await _run_in_executor(fetcher, parse_available_offers, markup)
+
+    pages = await asyncio.gather(*[get_offers(page) for page in range(1, result_page["page_count"])])
+    parsed_urls = result_page["offers"]
+    for offers in pages:
+        parsed_urls.extend(offers)
+    log.info("Loaded {0} offers".format(str(len(parsed_urls))))
+    return parsed_urls
+
+
+async def aparse_offer(url, fetcher=None):
+    """ Parses data from offer page url
+
+    :param url: Url of current offer page
+    :param fetcher: Fetcher to use, new one is created if not given
+    :type url: str
+    :type fetcher: AsyncFetcher
+    :return: Dictionary with all offer details or None if offer is not available anymore
+    :rtype: dict, None
+    """
+    if fetcher is None:
+        async with AsyncFetcher() as fetcher:
+            return await aparse_offer(url, fetcher)
+    return await _run_in_executor(fetcher, parse_offer_markup, await fetcher.get(url), url)
+
+
+async def acrawl(category, region=None, fetcher=None, **filters):
+    """ Yields details of every offer in given category as soon as they are parsed
+
+    Offers are yielded in order of completion, not in order of search results. Offers which are not
+    available anymore are skipped. At most fetcher concurrency offers are fetched and parsed at once.
+
+    :param category: Search category
+    :param region: Search region
+    :param fetcher: Fetcher to use, new one is created if not given
+    :param filters: See :meth:`category.get_category` for reference
+    :type category: str
+    :type region: str
+    :type fetcher: AsyncFetcher
+    :type filters: dict
+    :return: Async generator of offer dictionaries
+    """
+    if fetcher is None:
+        async with AsyncFetcher() as fetcher:
+            async for offer in acrawl(category, region, fetcher, **filters):
+                yield offer
+        return
+    urls = iter([url for url in await aget_category(category, region, fetcher, **filters) if url])
+    results = asyncio.Queue(fetcher.concurrency)
+
+    async def work():
+        # Workers share urls iterator, so every url is taken by exactly one of them
+        try:
+            for url in urls:
+                offer = await aparse_offer(url, fetcher)
+                if offer is not None:
+                    await results.put(offer)
+        except Exception as e:
+            await results.put(e)
+        await results.put(None)
+
+    workers = [asyncio.ensure_future(work()) for _ in range(fetcher.concurrency)]
+    running = len(workers)
+    try:
+        while running:
+            result = await results.get()
+            if result is None:
+                running -= 1
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                yield result
+    finally:
+        for worker in workers:
+            worker.cancel()
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import re
+import threading
+from collections import OrderedDict
+
+# Amenity name and keywords found in "Dodatkowe informacje" section of offer page. Keywords are matched
+# as substrings, ignoring case and polish diacritics. Order defines bits of models.AMENITY_FLAGS, so new amenities
+# have to be appended to keep already stored flags valid.
+AMENITY_KEYWORDS = OrderedDict([
+    ("balcony", (u"balkon", u"loggia")),
+    ("kitchen", (u"kuchnia",)),
+    ("terrace", (u"taras",)),
+    ("internet", (u"internet", u"wi-fi", u"wifi")),
+    ("elevator", (u"winda",)),
+    ("car_parking", (u"parkingowe",)),
+    ("disabled_facilities", (u"podjazd",)),
+    ("mezzanine", (u"antresola",)),
+    ("basement", (u"piwnica",)),
+    ("duplex_apartment", (u"dwupoziomowe",)),
+    ("garden", (u"ogródek",)),
+    ("garage", (u"garaż",)),
+    ("cable_tv", (u"kablówka", u"telewizja kablowa")),
+])
+
+
+FOLD_TABLE = {ord(char): folded for char, folded in zip(u"ąćęłńóśźż", u"acelnoszz")}
+
+
+def fold_text(text):
+    """ Lowercases text and removes polish diacritics
+
+    :param text: Text
+    :type text: str
+    :return: Folded text
+    :rtype: str
+    """
+    return text.lower().translate(FOLD_TABLE)
+
+
+def _build_trie_pattern(keywords):
+    # Keywords sharing prefixes are merged into one branch, e.g. k(?:ablowka|uchnia), so matching cost
+    # depends on length of text rather than on number of keywords
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[u""] = True
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        is_end = u"" in node
+        if not branches:
+            return u""
+        if len(branches) == 1 and not is_end:
+            return branches[0]
+        return u"(?:{0}){1}".format(u"|".join(branches), u"?" if is_end else u"")
+
+    return build(trie) or u"(?!)"
+
+
+class AmenityMatcher(object):
+    """ Detects every amenity in text in one pass
+
+    All keywords are compiled into one trie-shaped regular expression, so adding keywords doesn't add scans
+    of text. Like separate substring checks, it finds keywords overlapping or contained in longer keywords of
+    other amenities too.
+
+    :Example:
+
+    matcher = AmenityMatcher(AMENITY_KEYWORDS)
+    matcher.add("air_conditioning", u"klimatyzacja")
+    matcher.match(u"Balkon, KLIMATYZACJA")  # {"balcony", "air_conditioning"}
+    """
+
+    def __init__(self, keywords=None):
+        self._keywords = OrderedDict()
+        self._amenities = []
+        self._pattern = None
+        self._hits = None
+        self._lock = threading.Lock()
+        for amenity, amenity_keywords in (keywords or {}).items():
+            self.add(amenity, *amenity_keywords)
+
+    @property
+    def amenities(self):
+        """ Names of amenities in order they were added """
+        return list(self._amenities)
+
+    def add(self, amenity, *keywords):
+        """ Adds keywords for amenity
+
+        :param amenity: Amenity name, can be new one
+        :param keywords: Keywords or synonyms
+        :type amenity: str
+        :type keywords: str
+        """
+        with self._lock:
+            if amenity not in self._amenities:
+                self._amenities.append(amenity)
+            for keyword in keywords:
+                self._keywords[fold_text(keyword)] = amenity
+            self._pattern = None
+
+    def _get_pattern(self):
+        with self._lock:
+            if self._pattern is None:
+                # Lookahead matches at every position, finding longest keyword starting there. Shorter keywords
+                # starting at the same position are its prefixes, so every keyword maps to amenities of all its
+                # prefixes.
+                keywords = self._keywords
+                self._hits = {
+                    keyword: frozenset(amenity for prefix, amenity in keywords.items() if keyword.startswith(prefix))
+                    for keyword in keywords
+                }
+                self._pattern = re.compile(u"(?=({0}))".format(_build_trie_pattern(keywords)))
+            return self._pattern, self._hits
+
+    def match(self, text):
+        """ Finds amenities mentioned in text
+
+        :param text: Text
+        :type text: str
+        :return: Names of found amenities
+        :rtype: set
+        """
+        pattern, hits = self._get_pattern()
+        return set().union(*[hits[keyword] for keyword in pattern.findall(fold_text(text))])
+
+    def match_many(self, texts):
+        """ Finds amenities mentioned in every text
+
+        :param texts: Texts
+        :type texts: iterable
+        :return: Names of found amenities for each text
+        :rtype: list
+        """
+        pattern, hits = self._get_pattern()
+        return [set().union(*[hits[keyword] for keyword in pattern.findall(fold_text(text))]) for text in texts]
+
+    def match_dict(self, text):
+        """ Checks every amenity against text
+
+        :param text: Text
+        :type text: str
+        :return: Amenity name to bool
+        :rtype: dict
+        """
+        found = self.match(text)
+        return {amenity: amenity in found for amenity in self._amenities}
+
+
+AMENITY_MATCHER = AmenityMatcher(AMENITY_KEYWORDS)
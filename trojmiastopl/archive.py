@@ -0,0 +1,282 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from trojmiastopl.cache import get_url_class
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger(__file__)
+
+SEGMENT_MAX_BYTES = 256 * 1024 * 1024
+COMPRESSION_LEVEL = 6
+INDEX_FILE = "index.tsv"
+LOCK_FILE = "writer.lock"
+SEGMENT_FILE = "{0:06d}.seg"
+
+# Record: magic, fetch timestamp, url length, compressed body length, followed by url and compressed body
+RECORD_MAGIC = b"TPA1"
+RECORD_HEADER = struct.Struct("<4sdII")
+
+
+class PageArchive(object):
+    """ Append-only archive of raw pages for reparsing without network access
+
+    Bodies are zlib compressed and appended to segment files of at most segment_max_bytes, every record is listed
+    in index file with its segment, offset, fetch time and url. Pages are read back through mmap,
+    see :meth:`iter_pages`, and reparsed with functions from :mod:`trojmiastopl.replay`.
+
+    Archive has a single writer, opened with mode "w", which holds a lock file (on platforms with fcntl) for as long
+    as it is open. Only the writer recovers records written after index was last updated (e.g. when process was
+    killed) and truncates incomplete ones. Archives opened with mode "r" never modify files, so they can be read
+    while crawler is still writing - they see pages archived before they were opened.
+
+    :Example:
+
+    utils.configure_archive("/var/lib/trojmiastopl/archive")
+    for url, fetched, body in PageArchive("/var/lib/trojmiastopl/archive").iter_pages("offer"):
+        print(url, len(body))
+    """
+
+    def __init__(self, path, mode="r", segment_max_bytes=SEGMENT_MAX_BYTES, level=COMPRESSION_LEVEL):
+        """
+        :param path: Archive directory, created by writer if it doesn't exist
+        :param mode: "r" to read only, "w" to append pages
+        :param segment_max_bytes: Size after which new segment file is started
+        :param level: zlib compression level
+        :type path: str
+        :type mode: str
+        :type segment_max_bytes: int
+        :type level: int
+
+        :except: IOError if reader's archive doesn't exist or another writer has archive open.
+        """
+        if mode not in ("r", "w"):
+            raise ValueError("Unknown archive mode: {0}".format(mode))
+        self.path = path
+        self.mode = mode
+        self.segment_max_bytes = segment_max_bytes
+        self.level = level
+        self._entries = []
+        self._latest = {}
+        self._file = None
+        self._segment = 0
+        self._lock = threading.Lock()
+        self._lock_file = None
+        if mode == "w":
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self._lock_writer()
+        elif not os.path.isdir(path):
+            raise IOError("Archive {0} doesn't exist".format(path))
+        self._load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, url):
+        return url in self._latest
+
+    @property
+    def writable(self):
+        """ Whether pages can be appended, only in "w" mode """
+        return self.mode == "w"
+
+    def _lock_writer(self):
+        self._lock_file = open(os.path.join(self.path, LOCK_FILE), "a")
+        if fcntl is None:
+            return
+        try:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            self._lock_file.close()
+            self._lock_file = None
+            raise IOError("Archive {0} is already open for writing".format(self.path))
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, SEGMENT_FILE.format(segment))
+
+    def _add_entry(self, entry):
+        self._latest[entry[3]] = len(self._entries)
+        self._entries.append(entry)
+
+    def _load(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, "r+b" if self.writable else "rb") as index_file:
+                lines = index_file.read().split(b"\n")
+                if lines[-1] and self.writable:
+                    # Line cut off by interrupted write, its record is recovered from segment below
+                    index_file.truncate(index_file.tell() - len(lines[-1]))
+            for line in lines[:-1]:
+                segment, offset, fetched, url = line.decode("utf-8").split("\t", 3)
+                self._add_entry((int(segment), int(offset), float(fetched), url))
+        segments = sorted(int(name.split(".")[0]) for name in os.listdir(self.path) if name.endswith(".seg"))
+        if not segments:
+            return
+        # Recover records missing from index, starting after last indexed one
+        start_segment, start_offset = segments[0], 0
+        if self._entries:
+            start_segment, start_offset = self._entries[-1][:2]
+            start_offset = self._next_offset(start_segment, start_offset)
+        recovered = 0
+        for segment in segments:
+            if segment < start_segment:
+                continue
+            # Readers only add complete records to memory, writer may be appending them right now
+            for entry in self._scan_segment(segment, start_offset if segment == start_segment else 0):
+                self._add_entry(entry)
+                if self.writable:
+                    self._write_index(entry)
+                    recovered += 1
+        if recovered:
+            log.warning("Recovered {0} archived pages missing from index".format(recovered))
+        self._segment = segments[-1]
+
+    def _next_offset(self, segment, offset):
+        with open(self._segment_path(segment), "rb") as segment_file:
+            segment_file.seek(offset)
+            _, _, url_length, body_length = RECORD_HEADER.unpack(segment_file.read(RECORD_HEADER.size))
+        return offset + RECORD_HEADER.size + url_length + body_length
+
+    def _scan_segment(self, segment, offset):
+        segment_path = self._segment_path(segment)
+        size = os.path.getsize(segment_path)
+        with open(segment_path, "rb") as segment_file:
+            segment_file.seek(offset)
+            while offset + RECORD_HEADER.size <= size:
+                magic, fetched, url_length, body_length = RECORD_HEADER.unpack(segment_file.read(RECORD_HEADER.size))
+                end = offset + RECORD_HEADER.size + url_length + body_length
+                if magic != RECORD_MAGIC or end > size:
+                    break
+                url = segment_file.read(url_length).decode("utf-8")
+                segment_file.seek(body_length, os.SEEK_CUR)
+                yield segment, offset, fetched, url
+                offset = end
+        if offset < size and self.writable:
+            log.warning("Truncating incomplete record at {0}:{1}".format(segment_path, offset))
+            with open(segment_path, "r+b") as segment_file:
+                segment_file.truncate(offset)
+
+    def _write_index(self, entry):
+        with open(os.path.join(self.path, INDEX_FILE), "ab") as index_file:
+            index_file.write(u"{0}\t{1}\t{2!r}\t{3}\n".format(*entry).encode("utf-8"))
+
+    def write(self, url, body, fetched=None):
+        """ Appends page to archive
+
+        :param url: Page url
+        :param body: Raw response body
+        :param fetched: Fetch timestamp, now if not given
+        :type url: str
+        :type body: bytes
+        :type fetched: float
+        """
+        if not self.writable:
+            raise IOError("Archive {0} is open read-only".format(self.path))
+        fetched = time.time() if fetched is None else fetched
+        encoded_url = url.encode("utf-8")
+        compressed = zlib.compress(body, self.level)
+        record = RECORD_HEADER.pack(RECORD_MAGIC, fetched, len(encoded_url), len(compressed)) + encoded_url + compressed
+        with self._lock:
+            if self._file is None:
+                self._file = open(self._segment_path(self._segment), "ab")
+            offset = self._file.tell()
+            if offset and offset + len(record) > self.segment_max_bytes:
+                self._file.close()
+                self._segment += 1
+                self._file = open(self._segment_path(self._segment), "ab")
+                offset = 0
+            self._file.write(record)
+            self._file.flush()
+            entry = (self._segment, offset, fetched, url)
+            self._write_index(entry)
+            self._add_entry(entry)
+
+    def get(self, url):
+        """ Returns latest archived body of url
+
+        :param url: Page url
+        :type url: str
+        :return: Raw body or None if url is not archived
+        :rtype: bytes, None
+        """
+        with self._lock:
+            position = self._latest.get(url)
+            if position is None:
+                return
+            segment, offset, _, _ = self._entries[position]
+        with open(self._segment_path(segment), "rb") as segment_file:
+            segment_file.seek(offset)
+            _, _, url_length, body_length = RECORD_HEADER.unpack(segment_file.read(RECORD_HEADER.size))
+            segment_file.seek(url_length, os.SEEK_CUR)
+            return zlib.decompress(segment_file.read(body_length))
+
+    def iter_pages(self, url_class=None, since=None, until=None, latest=False):
+        """ Yields archived pages in order they were written
+
+        Segments are memory mapped and bodies are decompressed straight from mapped memory.
+
+        :param url_class: "offer" or "search" to yield only given pages, see :meth:`cache.get_url_class`
+        :param since: Yield pages fetched at or after this timestamp
+        :param until: Yield pages fetched before this timestamp
+        :param latest: Yield only latest archived version of every url
+        :type url_class: str
+        :type since: float
+        :type until: float
+        :type latest: bool
+        :return: Generator of (url, fetch timestamp, raw body) tuples
+        :rtype: generator
+        """
+        with self._lock:
+            entries = list(self._entries)
+            latest_positions = set(self._latest.values()) if latest else None
+        mapped, view, mapped_segment = None, None, None
+        try:
+            for position, (segment, offset, fetched, url) in enumerate(entries):
+                if latest_positions is not None and position not in latest_positions:
+                    continue
+                if since is not None and fetched < since or until is not None and fetched >= until:
+                    continue
+                if url_class is not None and get_url_class(url) != url_class:
+                    continue
+                if segment != mapped_segment:
+                    if mapped is not None:
+                        view.release()
+                        mapped.close()
+                    with open(self._segment_path(segment), "rb") as segment_file:
+                        mapped = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+                    view, mapped_segment = memoryview(mapped), segment
+                _, _, url_length, body_length = RECORD_HEADER.unpack_from(mapped, offset)
+                start = offset + RECORD_HEADER.size + url_length
+                yield url, fetched, zlib.decompress(view[start:start + body_length])
+        finally:
+            if mapped is not None:
+                view.release()
+                mapped.close()
+
+    def close(self):
+        """ Closes segment file open for writing and releases writer lock """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
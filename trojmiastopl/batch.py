@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from trojmiastopl.category import iter_category
+from trojmiastopl.incremental import get_offer_key
+from trojmiastopl.pipeline import FETCH_WORKERS, MAX_PENDING, parse_offers
+
+log = logging.getLogger(__file__)
+
+LISTING_WORKERS = 4
+
+
+def _get_job_key(job):
+    category, region, filters = job
+    return category, region, tuple(sorted((k, repr(v)) for k, v in (filters or {}).items()))
+
+
+def _list_job(job):
+    category, region, filters = job
+    return list(iter_category(category, region, **(filters or {})))
+
+
+class BatchCrawl(object):
+    """ Crawls many searches at once, fetching and parsing every offer only once
+
+    Searches (jobs) are (category, region, filters) tuples. Their result pages are loaded concurrently, offer urls
+    are deduplicated across jobs by offer id and every unique offer goes through one shared fetch and parse pipeline
+    (see :meth:`pipeline.parse_offers`). Results are fanned back out to every job which found the offer.
+
+    :Example:
+
+    crawl = BatchCrawl([
+        ("nieruchomosci-mam-do-wynajecia", "Gdańsk", {"cena[]": (None, 2500)}),
+        ("nieruchomosci-mam-do-wynajecia", "Gdańsk", {"data_wprow": "3d"}),
+        ("nieruchomosci-mam-do-wynajecia", "Sopot", {}),
+    ])
+    for job, offers in zip(crawl.jobs, crawl.run()):
+        print(job, len(offers))
+    print(crawl.stats())
+    """
+
+    def __init__(self, jobs, listing_workers=LISTING_WORKERS, fetch_workers=FETCH_WORKERS, parse_workers=None,
+                 max_pending=MAX_PENDING):
+        """
+        :param jobs: Searches as (category, region, filters) tuples, region and filters can be None
+        :param listing_workers: Number of searches whose result pages are loaded at once
+        :param fetch_workers: Number of offer download threads
+        :param parse_workers: Number of parsing processes, number of cores if not given
+        :param max_pending: Maximum number of offers being fetched or parsed at once
+        :type jobs: list
+        :type listing_workers: int
+        :type fetch_workers: int
+        :type parse_workers: int
+        :type max_pending: int
+        """
+        self.jobs = [tuple(job) for job in jobs]
+        self.listing_workers = listing_workers
+        self.fetch_workers = fetch_workers
+        self.parse_workers = parse_workers
+        self.max_pending = max_pending
+        self._job_keys = [OrderedDict() for _ in self.jobs]
+        self._urls = {}
+        self._lock = threading.Lock()
+        self._stats = {"jobs": len(self.jobs), "searches": 0, "offer_urls": 0, "unique_offers": 0, "parsed": 0}
+
+    def _iter_unique_urls(self):
+        searches = {}
+        for index, job in enumerate(self.jobs):
+            searches.setdefault(_get_job_key(job), []).append(index)
+        self._stats["searches"] = len(searches)
+        with ThreadPoolExecutor(self.listing_workers) as pool:
+            futures = {pool.submit(_list_job, self.jobs[indexes[0]]): indexes for indexes in searches.values()}
+            for future in as_completed(futures):
+                try:
+                    urls = future.result()
+                except Exception as e:
+                    log.warning("Search {0} failed: {1}".format(self.jobs[futures[future][0]], e))
+                    continue
+                for url in urls:
+                    key = get_offer_key(url)
+                    with self._lock:
+                        self._stats["offer_urls"] += len(futures[future])
+                        for index in futures[future]:
+                            self._job_keys[index][key] = True
+                        if key in self._urls:
+                            continue
+                        self._urls[key] = url
+                        self._stats["unique_offers"] += 1
+                    yield url
+
+    def run(self):
+        """ Runs crawl
+
+        :return: Offers found by every job, in order of jobs. The same offer dictionary is shared by every job
+        which found it. Offers which are not available anymore or failed are skipped.
+        :rtype: list
+        """
+        offers = {}
+        for offer in parse_offers(self._iter_unique_urls(), self.fetch_workers, self.parse_workers,
+                                  max_pending=self.max_pending):
+            offers[get_offer_key(offer["url"])] = offer
+            self._stats["parsed"] += 1
+        log.info("Parsed {parsed} unique offers of {offer_urls} found by {jobs} jobs".format(**self._stats))
+        return [[offers[key] for key in keys if key in offers] for keys in self._job_keys]
+
+    def stats(self):
+        """ Returns crawl statistics
+
+        :return: Number of jobs, distinct searches, offer urls found by all jobs, unique offers and parsed offers
+        :rtype: dict
+        """
+        with self._lock:
+            return dict(self._stats)
+
+
+def crawl_batch(jobs, **options):
+    """ Crawls many searches, fetching and parsing every offer only once. See :class:`BatchCrawl`
+
+    :param jobs: Searches as (category, region, filters) tuples
+    :param options: See :class:`BatchCrawl`
+    :type jobs: list
+    :return: Offers found by every job, in order of jobs
+    :rtype: list
+    """
+    return BatchCrawl(jobs, **options).run()
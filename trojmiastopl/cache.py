@@ -0,0 +1,373 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import copy
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+log = logging.getLogger(__file__)
+
+URL_CACHE_TTL = 24 * 60 * 60
+
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RESPONSE_CACHE_TTLS = {
+    "search": 10 * 60,  # search result pages change often
+    "offer": 24 * 60 * 60,
+}
+
+REVALIDATION_MAX_ENTRIES = 100000
+
+OFFER_URL_PATTERN = re.compile(r'ogl\d+\.html')
+
+
+def normalize_payload(payload):
+    """ Creates hashable key for search payload, independent of order of filters
+
+    Values of the same key keep their order, so ranges (from, to) are not mixed up.
+
+    :param payload: Tuple of tuples containing POST key and argument
+    :type payload: tuple
+    :return: Normalized payload
+    :rtype: tuple
+    """
+    return tuple((str(k), str(v)) for k, v in sorted(payload, key=lambda item: str(item[0])))
+
+
+class UrlCache(object):
+    """ TTL-bounded cache of urls resolved by trojmiasto.pl search engine
+
+    Keys are search engine url and normalized search payload, so urls of other servers (e.g. mock server) are not
+    mixed up. If path is given, cache is persisted as json file, so it survives process restarts and can be shared
+    between workers - entries saved by other processes are read back and merged before every save.
+    """
+
+    def __init__(self, path=None, ttl=URL_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def _read(self):
+        if self.path is None or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as cache_file:
+                return json.load(cache_file)
+        except ValueError as e:
+            log.warning("Invalid url cache {0}: {1}".format(self.path, e))
+            return {}
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = self._read()
+
+    def _merge(self, entries):
+        now = time.time()
+        for key, entry in entries.items():
+            if now - entry[1] <= self.ttl and (key not in self._entries or self._entries[key][1] < entry[1]):
+                self._entries[key] = entry
+
+    def _save(self, merge=True):
+        if self.path is None:
+            return
+        if merge:
+            self._merge(self._read())
+        temp_path = "{0}.{1}.tmp".format(self.path, os.getpid())
+        with open(temp_path, "w") as cache_file:
+            json.dump(self._entries, cache_file)
+        getattr(os, "replace", os.rename)(temp_path, self.path)
+
+    @staticmethod
+    def _key(payload, search_url):
+        return json.dumps([search_url, normalize_payload(payload)])
+
+    def get(self, payload, search_url=None):
+        """ Returns cached url for payload
+
+        :param payload: Tuple of tuples containing POST key and argument
+        :param search_url: Search engine url payload was sent to
+        :type payload: tuple
+        :type search_url: str
+        :return: Url or None if it's not cached or expired
+        :rtype: str, None
+        """
+        with self._lock:
+            self._load()
+            key = self._key(payload, search_url)
+            if key not in self._entries and self.path is not None:
+                # Other workers may have resolved it since file was loaded
+                self._merge(self._read())
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            url, created = entry
+            if time.time() - created > self.ttl:
+                return
+            return url
+
+    def set(self, payload, url, search_url=None):
+        """ Stores url for payload
+
+        :param payload: Tuple of tuples containing POST key and argument
+        :param url: Url generated by trojmiasto.pl search engine
+        :param search_url: Search engine url payload was sent to
+        :type payload: tuple
+        :type url: str
+        :type search_url: str
+        """
+        with self._lock:
+            self._load()
+            now = time.time()
+            self._entries = {
+                key: entry for key, entry in self._entries.items() if now - entry[1] <= self.ttl
+            }
+            self._entries[self._key(payload, search_url)] = (url, now)
+            self._save()
+
+    def clear(self):
+        """ Removes all cached urls """
+        with self._lock:
+            self._entries = {}
+            self._save(merge=False)
+
+
+def get_url_class(url):
+    """ Classifies url for cache expiration purposes
+
+    :param url: Website url
+    :type url: str
+    :return: "offer" for offer pages, "search" for everything else
+    :rtype: str
+    """
+    if OFFER_URL_PATTERN.search(url):
+        return "offer"
+    return "search"
+
+
+class ResponseCache(object):
+    """ Size-bounded cache of response bodies
+
+    Bodies are kept in memory in least recently used order, up to max_bytes in total. If path is given,
+    bodies are also stored in that directory compressed with zlib, so they survive process restarts.
+    Entries expire after time given in ttls for class of their url, see :meth:`get_url_class`.
+    """
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_MAX_BYTES, path=None, ttls=None):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.ttls = dict(RESPONSE_CACHE_TTLS, **(ttls or {}))
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+        if path is not None and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file_path(self, url):
+        return os.path.join(self.path, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".z")
+
+    def _is_expired(self, url, stored):
+        return time.time() - stored > self.ttls[get_url_class(url)]
+
+    def _remember(self, url, body, stored):
+        self._forget(url)
+        if len(body) > self.max_bytes:
+            return
+        self._entries[url] = (body, stored)
+        self._size += len(body)
+        while self._size > self.max_bytes:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+            self._stats["evictions"] += 1
+
+    def _forget(self, url):
+        entry = self._entries.pop(url, None)
+        if entry is not None:
+            self._size -= len(entry[0])
+
+    def _read_disk(self, url):
+        if self.path is None:
+            return
+        file_path = self._file_path(url)
+        try:
+            stored = os.path.getmtime(file_path)
+            if self._is_expired(url, stored):
+                os.remove(file_path)
+                return
+            with open(file_path, "rb") as cache_file:
+                return zlib.decompress(cache_file.read()), stored
+        except (OSError, IOError, zlib.error):
+            return
+
+    def _write_disk(self, url, body):
+        if self.path is None:
+            return
+        file_path = self._file_path(url)
+        temp_path = "{0}.{1}.tmp".format(file_path, os.getpid())
+        with open(temp_path, "wb") as cache_file:
+            cache_file.write(zlib.compress(body))
+        getattr(os, "replace", os.rename)(temp_path, file_path)
+
+    def get(self, url):
+        """ Returns cached body for url
+
+        :param url: Website url
+        :type url: str
+        :return: Response body or None if it's not cached or expired
+        :rtype: bytes, None
+        """
+        with self._lock:
+            entry = self._entries.pop(url, None)
+            if entry is not None:
+                self._size -= len(entry[0])
+                if not self._is_expired(url, entry[1]):
+                    self._remember(url, *entry)
+                    self._stats["hits"] += 1
+                    self._stats["memory_hits"] += 1
+                    return entry[0]
+            entry = self._read_disk(url)
+            if entry is None:
+                self._stats["misses"] += 1
+                return
+            self._remember(url, *entry)
+            self._stats["hits"] += 1
+            self._stats["disk_hits"] += 1
+            return entry[0]
+
+    def set(self, url, body):
+        """ Stores response body for url
+
+        :param url: Website url
+        :param body: Response body
+        :type url: str
+        :type body: bytes
+        """
+        with self._lock:
+            self._remember(url, body, time.time())
+            self._write_disk(url, body)
+
+    def delete(self, url):
+        """ Removes url from cache
+
+        :param url: Website url
+        :type url: str
+        """
+        with self._lock:
+            self._forget(url)
+            if self.path is not None and os.path.exists(self._file_path(url)):
+                os.remove(self._file_path(url))
+
+    def purge(self):
+        """ Removes expired bodies from disk """
+        if self.path is None:
+            return
+        now = time.time()
+        max_ttl = max(self.ttls.values())
+        for name in os.listdir(self.path):
+            file_path = os.path.join(self.path, name)
+            if now - os.path.getmtime(file_path) > max_ttl:
+                os.remove(file_path)
+
+    def stats(self):
+        """ Returns cache statistics
+
+        :return: Number of hits (in memory and on disk), misses, evictions, entries and bytes kept in memory
+        :rtype: dict
+        """
+        with self._lock:
+            stats = dict(self._stats, entries=len(self._entries), bytes=self._size)
+        requests_count = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = float(stats["hits"]) / requests_count if requests_count else 0.0
+        return stats
+
+
+class RevalidationCache(object):
+    """ Validators (ETag, Last-Modified) and last parsed result of recently fetched urls
+
+    Used for conditional requests - when server answers 304 Not Modified, last parsed result is reused.
+    Keeps at most max_entries urls, least recently used are dropped first.
+    """
+
+    def __init__(self, max_entries=REVALIDATION_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, url):
+        entry = self._entries.pop(url, None)
+        if entry is not None:
+            self._entries[url] = entry
+        return entry
+
+    def _set(self, url, **values):
+        entry = self._get(url) or {"etag": None, "last_modified": None, "result": None}
+        entry.update(values)
+        self._entries[url] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get_headers(self, url):
+        """ Returns conditional request headers for url
+
+        :param url: Website url
+        :type url: str
+        :return: If-None-Match and If-Modified-Since headers, empty if there are no validators
+        :rtype: dict
+        """
+        with self._lock:
+            entry = self._get(url) or {}
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def update(self, url, response):
+        """ Stores validators from response
+
+        Last parsed result is dropped when validators change, because it describes older version of page. Otherwise
+        fetch which doesn't store a result (e.g. parsing only some fields) would make the next conditional request
+        answer 304 for stale result.
+
+        :param url: Website url
+        :param response: Response for url
+        :type url: str
+        :type response: requests.Response
+        """
+        etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+        if etag or last_modified:
+            with self._lock:
+                entry = self._get(url)
+                if entry is not None and (entry["etag"], entry["last_modified"]) != (etag, last_modified):
+                    self._set(url, etag=etag, last_modified=last_modified, result=None)
+                else:
+                    self._set(url, etag=etag, last_modified=last_modified)
+
+    def get_result(self, url):
+        """ Returns copy of last parsed result for url
+
+        :param url: Website url
+        :type url: str
+        :return: Last parsed result or None
+        """
+        with self._lock:
+            entry = self._get(url) or {}
+        return copy.deepcopy(entry.get("result"))
+
+    def set_result(self, url, result):
+        """ Stores copy of parsed result for url
+
+        :param url: Website url
+        :param result: Parsed result
+        :type url: str
+        """
+        with self._lock:
+            self._set(url, result=copy.deepcopy(result))
@@ -2,18 +2,65 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import re
 from re import findall
 
 import requests
-from bs4 import BeautifulSoup
-from scrapper_helpers.utils import flatten
+from bs4 import Tag
 
-from trojmiastopl.utils import get_content_for_url, get_url
+from trojmiastopl import metrics
+from trojmiastopl.listing import RESULT_COUNT_PATTERN, parse_listing_page
+from trojmiastopl.offer import parse_offer
+from trojmiastopl.utils import (
+    get_content_for_url, get_offer_id, get_parser_backend, get_selector_tree, get_soup, get_url
+)
 
 log = logging.getLogger(__file__)
 logging.basicConfig(level=logging.DEBUG)
 
 
+def _get_search_tree(markup):
+    tree = get_selector_tree(markup)
+    if tree is not None:
+        return tree
+    return get_soup(markup)
+
+
+def _get_page_count(tree):
+    if isinstance(tree, Tag):
+        navi_pages = tree.find(class_="navi-pages")
+        text = navi_pages.text if navi_pages is not None else ""
+    else:
+        navi_pages = tree.css_first(".navi-pages")
+        text = navi_pages.text() if navi_pages is not None else ""
+    try:
+        return max(map(int, findall(r'\d+', text)))
+    except ValueError as e:
+        log.warning(e)
+        return 1
+
+
+def _get_offer_urls(tree):
+    if isinstance(tree, Tag):
+        offers = tree.find_all(class_='ogl-head')
+        return [(offer if offer.name == "a" else offer.find("a")).attrs["href"] for offer in offers if offer]
+    return [
+        (offer if offer.tag == "a" else offer.css_first("a")).attributes["href"]
+        for offer in tree.css(".ogl-head")
+    ]
+
+
+def _get_result_count(tree):
+    if isinstance(tree, Tag):
+        text = tree.get_text(" ")
+    else:
+        text = tree.body.text(separator=" ") if tree.body is not None else ""
+    match = RESULT_COUNT_PATTERN.search(text)
+    if match is None:
+        return
+    return int(re.sub(r'\D', '', match.group(1)))
+
+
 def get_page_count(markup):
     """ Reads total page number from trojmiasto.pl search page
 
@@ -24,37 +71,28 @@ def get_page_count(markup):
 
     :except: If no page number was found - there is just one page.
     """
-
-    html_parser = BeautifulSoup(markup, "html.parser")
-    try:
-        return max(map(int, findall(r'\d+', html_parser.find(class_="navi-pages").text)))
-    except ValueError as e:
-        log.warning(e)
-        return 1
+    if get_parser_backend() == "html.parser":
+        return parse_listing_page(markup)["page_count"]
+    return _get_page_count(_get_search_tree(markup))
 
 
-def get_page_count_for_filters(category, region=None, **filters):
+def get_page_count_for_filters(category, region=None, session=None, **filters):
     """ Reads total page number for given search filters
 
     :param category: Search category
     :param region: Search region
+    :param session: HTTP session, shared session is used if not given
     :param filters: See :meth category.get_category for reference
     :type category: str
     :type region: str
+    :type session: requests.Session
     :type filters: dict
     :return: Total page number
     :rtype: int
 
     :except: If no page number was found - there is just one page.
     """
-    url = get_url(category, region, **filters)
-    response = get_content_for_url(url)
-    html_parser = BeautifulSoup(response.content, "html.parser")
-    try:
-        return max(map(int, findall(r'\d+', html_parser.find(class_="navi-pages").text)))
-    except ValueError as e:
-        log.warning(e)
-        return 1
+    return get_result_page(get_url(category, region, session, **filters), session=session)["page_count"]
 
 
 def parse_offer_url(markup):
@@ -65,7 +103,7 @@ def parse_offer_url(markup):
     :return: Url with offer
     :rtype: str
     """
-    html_parser = BeautifulSoup(markup, "html.parser")
+    html_parser = get_soup(markup)
     url = html_parser.find('a').attrs['href']
     return url
 
@@ -78,17 +116,94 @@ def parse_available_offers(markup):
     :return: Links to offer on given search page
     :rtype: list
     """
-    html_parser = BeautifulSoup(markup, "html.parser")
-    offers = html_parser.find_all(class_='ogl-head')
-    parsed_offers = [parse_offer_url(str(offer)) for offer in offers if offer]
-    return parsed_offers
+    if get_parser_backend() == "html.parser":
+        return parse_listing_page(markup)["offers"]
+    return _get_offer_urls(_get_search_tree(markup))
+
 
+def parse_result_page(markup):
+    """ Parses page count, offer links and result count from one search page tree
 
-def get_category(category, region=None, **filters):
+    :param markup: Search page markup
+    :type markup: str
+    :return: Search page details: page_count, offers (links), offer_count (on this page) and
+    result_count (total number of results or None if page doesn't show it)
+    :rtype: dict
+    """
+    if get_parser_backend() == "html.parser":
+        result_page = parse_listing_page(markup)
+        del result_page["listings"]
+        return result_page
+    tree = _get_search_tree(markup)
+    offers = _get_offer_urls(tree)
+    return {
+        "page_count": _get_page_count(tree),
+        "offers": offers,
+        "offer_count": len(offers),
+        "result_count": _get_result_count(tree),
+    }
+
+
+def get_result_page(url, page=0, listings=False, session=None):
+    """ Loads and parses one search page
+
+    :param url: Search url, see :meth utils.get_url
+    :param page: Page number, counted from 0
+    :param listings: Read listing snippets of offers too, see :meth listing.parse_listing_page
+    :param session: HTTP session, shared session is used if not given
+    :type url: str
+    :type page: int
+    :type listings: bool
+    :type session: requests.Session
+    :return: Search page details, see :meth category.parse_result_page. Additionally contains url and page.
+    :rtype: dict
+    """
+    if page != 0:
+        url += "?strona={0}".format(page)
+    log.debug(url)
+    response = get_content_for_url(url, session)
+    log.info("Loaded page {0} of offers".format(page + 1))
+    started = metrics.start()
+    result_page = parse_listing_page(response.content) if listings else parse_result_page(response.content)
+    if started is not None:
+        metrics.stop(started, "parse_seconds", page="search")
+        metrics.count("pages_total", page="search")
+    result_page["url"] = url
+    result_page["page"] = page
+    return result_page
+
+
+def iter_result_pages(category, region=None, session=None, **filters):
+    """ Yields parsed search pages of given category, fetching every page exactly once
+
+    :param category: Search category
+    :param region: Search region
+    :param session: HTTP session, shared session is used if not given
+    :param filters: See :meth category.get_category for reference
+    :type category: str
+    :type region: str
+    :type session: requests.Session
+    :type filters: dict
+    :return: Generator of search page details, see :meth category.get_result_page
+    :rtype: generator
+    """
+    for result_page in _iter_result_pages(get_url(category, region, session, **filters), session=session):
+        yield result_page
+
+
+def _iter_result_pages(url, listings=False, session=None):
+    result_page = get_result_page(url, listings=listings, session=session)
+    yield result_page
+    for page in range(1, result_page["page_count"]):
+        yield get_result_page(url, page, listings, session)
+
+
+def get_category(category, region=None, session=None, **filters):
     """ Parses available offer urls from given category from every page
 
     :param category: Search category
     :param region: Search region
+    :param session: HTTP session, shared session is used if not given
     :param filters: Dictionary with additional filters. Following example dictionary contains every possible filter
     with examples of it's values.
 
@@ -110,50 +225,169 @@ def get_category(category, region=None, **filters):
 
     :type category: str
     :type region: str
+    :type session: requests.Session
     :type filters: dict
     :return: List of all offers for given parameters
     :rtype: list
     """
-    current_url = get_url(category, region, **filters)
-    url = current_url
-    parsed_urls, page = [], 0
-    response = get_content_for_url(url)
-    page_max = get_page_count(response.content)
-    while page < page_max:
-        if page != 0:
-            url = current_url + "?strona={0}".format(page)
-        log.debug(url)
-        response = get_content_for_url(url)
-        log.info("Loaded page {0} of offers".format(page + 1))
-        offers = parse_available_offers(response.content)
-        if offers is None:
-            break
-        parsed_urls.append(offers)
-        if page is None:
-            page = 1
-        page += 1
-    parsed_urls = list(flatten(parsed_urls))
+    parsed_urls = list(iter_category(category, region, session, **filters))
     log.info("Loaded {0} offers".format(str(len(parsed_urls))))
     return parsed_urls
 
 
-def get_offers_for_page(category, region, page, **filters):
+def iter_category(category, region=None, session=None, **filters):
+    """ Yields available offer urls from given category as soon as each page is parsed
+
+    :param category: Search category
+    :param region: Search region
+    :param session: HTTP session, shared session is used if not given
+    :param filters: See :meth category.get_category for reference
+    :type category: str
+    :type region: str
+    :type session: requests.Session
+    :type filters: dict
+    :return: Generator of offer urls for given parameters
+    :rtype: generator
+    """
+    for result_page in iter_result_pages(category, region, session, **filters):
+        for offer in result_page["offers"]:
+            yield offer
+
+
+def iter_offers(category, region=None, session=None, **filters):
+    """ Yields details of every offer from given category as soon as it is parsed
+
+    Offers which are not available anymore are skipped.
+
+    :param category: Search category
+    :param region: Search region
+    :param session: HTTP session, shared session is used if not given
+    :param filters: See :meth category.get_category for reference
+    :type category: str
+    :type region: str
+    :type session: requests.Session
+    :type filters: dict
+    :return: Generator of offer dictionaries, see :meth offer.parse_offer for reference
+    :rtype: generator
+    """
+    for url in iter_category(category, region, session, **filters):
+        if not url:
+            continue
+        offer = parse_offer(url, session)
+        if offer is not None:
+            yield offer
+
+
+def get_listing_offer(listing):
+    """ Converts listing snippet from search page to partial offer dictionary
+
+    :param listing: Listing snippet, see :meth listing.parse_listing_page
+    :type listing: dict
+    :return: Offer dictionary with offer_id, url, title, price, currency, surface, city and district keys,
+    named like in :meth offer.parse_offer
+    :rtype: dict
+    """
+    url = listing["url"]
+    location = [part.strip() for part in (listing["location"] or "").split(",", 1)]
+    return {
+        "offer_id": get_offer_id(url) if url else None,
+        "url": url,
+        "title": listing["title"],
+        "price": listing["price"],
+        "currency": "PLN",
+        "surface": listing["surface"],
+        "city": location[0] or None,
+        "district": location[1] if len(location) > 1 else None,
+    }
+
+
+def iter_listings(category, region=None, session=None, **filters):
+    """ Yields partial offers shown on search pages of given category, without loading offer pages
+
+    One request per search page instead of one per offer, see :meth category.get_listing_offer for available
+    fields. Use :meth category.enrich_offer to load details of chosen offers.
+
+    :param category: Search category
+    :param region: Search region
+    :param session: HTTP session, shared session is used if not given
+    :param filters: See :meth category.get_category for reference
+    :type category: str
+    :type region: str
+    :type session: requests.Session
+    :type filters: dict
+    :return: Generator of partial offer dictionaries
+    :rtype: generator
+    """
+    url = get_url(category, region, session, **filters)
+    for result_page in _iter_result_pages(url, listings=True, session=session):
+        for listing in result_page["listings"]:
+            yield get_listing_offer(listing)
+
+
+def get_listings(category, region=None, session=None, **filters):
+    """ Parses partial offers shown on every search page of given category, see :meth category.iter_listings
+
+    :Example:
+
+    cheap = [offer for offer in get_listings("nieruchomosci-mam-do-wynajecia", "Gdańsk") if offer["price"] < 2000]
+    details = [enrich_offer(offer) for offer in cheap]
+
+    :param category: Search category
+    :param region: Search region
+    :param session: HTTP session, shared session is used if not given
+    :param filters: See :meth category.get_category for reference
+    :type category: str
+    :type region: str
+    :type session: requests.Session
+    :type filters: dict
+    :return: List of partial offer dictionaries
+    :rtype: list
+    """
+    offers = list(iter_listings(category, region, session, **filters))
+    log.info("Loaded {0} offers".format(str(len(offers))))
+    return offers
+
+
+def enrich_offer(offer, fields=None, session=None):
+    """ Loads details of partial offer from its offer page
+
+    :param offer: Partial offer, see :meth category.iter_listings
+    :param fields: Names of fields to load, every field if not given, see :meth offer.parse_offer
+    :param session: HTTP session, shared session is used if not given
+    :type offer: dict
+    :type fields: list
+    :type session: requests.Session
+    :return: Offer dictionary with search page fields updated by offer page ones, None if offer is not available
+    anymore
+    :rtype: dict, None
+    """
+    details = parse_offer(offer["url"], session, fields=fields)
+    if details is None:
+        return
+    enriched = dict(offer)
+    enriched.update(details)
+    return enriched
+
+
+def get_offers_for_page(category, region, page, session=None, **filters):
     """ Parses offers for one specific page of given category with filters.
 
     :param category: Search category
     :param region: Search region
     :param page: Page number
+    :param session: HTTP session, shared session is used if not given
     :param filters: See :meth category.get_category for reference
     :type category: str
     :type region: str
     :type page: int
+    :type session: requests.Session
     :type filters: dict
     :return: List of all offers for given page and parameters
     :rtype: list
     """
     try:
-        url = get_url(category, region, **filters) + "?strona={0}".format(page)
-        response = get_content_for_url(url)
+        url = get_url(category, region, session, **filters) + "?strona={0}".format(page)
+        response = get_content_for_url(url, session)
     except requests.HTTPError as e:
         log.warning('Request failed. Error: {0}'.format(e))
         raise requests.HTTPError
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import namedtuple
+
+import requests
+
+from trojmiastopl.incremental import get_offer_key
+from trojmiastopl.offer import parse_offer
+
+log = logging.getLogger(__file__)
+
+NEW = "new"
+PRICE_CHANGED = "price_changed"
+UPDATED = "updated"
+REMOVED = "removed"
+
+# Offer page statuses meaning that offer was deleted
+GONE_STATUSES = (404, 410)
+
+# Offer fields covered by fingerprint, other fields (e.g. readable dates) don't count as a change
+FINGERPRINT_FIELDS = ("price", "deposit", "description", "images")
+
+OfferChange = namedtuple("OfferChange", ("kind", "key", "url", "offer", "old_price", "old_deposit"))
+OfferChange.__doc__ = """ Change of offer found by :class:`ChangeDetector`
+
+kind is one of NEW, PRICE_CHANGED, UPDATED and REMOVED, offer is None for removed offers. old_price and old_deposit
+are values from previous snapshot, None for new offers.
+"""
+
+
+def _normalize(value):
+    if value is None:
+        return u""
+    if isinstance(value, (list, tuple)):
+        return u"\n".join(_normalize(item) for item in value)
+    if not isinstance(value, type(u"")):
+        value = value.decode("utf-8") if isinstance(value, bytes) else u"{0}".format(value)
+    return u" ".join(value.split())
+
+
+def get_fingerprint(offer):
+    """ Returns compact hash of offer fields which matter for change detection
+
+    Whitespace in description is normalized, so reformatting alone doesn't count as a change.
+
+    :param offer: Offer details, see :meth:`offer.parse_offer`
+    :type offer: dict
+    :return: 16 hexadecimal characters
+    :rtype: str
+    """
+    normalized = u"\x1f".join(_normalize(offer.get(field)) for field in FINGERPRINT_FIELDS)
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:16]
+
+
+class ChangeDetector(object):
+    """ Persistent snapshot of offers emitting typed change events
+
+    Every offer is kept as its fingerprint (see :meth:`get_fingerprint`) with price and deposit, so unchanged
+    offers cost one hash comparison and changed ones can be told apart into price changes and other updates.
+    If path is given, snapshot is loaded from and saved to json file.
+
+    :Example:
+
+    detector = ChangeDetector("snapshot.json")
+    for change in iter_changes(iter_category("nieruchomosci-mam-do-wynajecia", "Gdańsk"), detector):
+        if change.kind == PRICE_CHANGED and change.offer["price"] < change.old_price:
+            alert(change.offer)
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._offers = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path) as snapshot_file:
+                self._offers = json.load(snapshot_file)
+
+    def __contains__(self, key):
+        return key in self._offers
+
+    def __len__(self):
+        return len(self._offers)
+
+    def detect(self, url, offer):
+        """ Compares offer with its snapshot and updates snapshot
+
+        :param url: Offer url
+        :param offer: Offer details or None if offer is not available anymore, see :meth:`offer.parse_offer`
+        :type url: str
+        :type offer: dict, None
+        :return: Change or None if offer didn't change (or is unavailable and wasn't known)
+        :rtype: OfferChange, None
+        """
+        key = get_offer_key(url)
+        if offer is None:
+            with self._lock:
+                previous = self._offers.pop(key, None)
+            if previous is None:
+                return
+            return OfferChange(REMOVED, key, url, None, previous[1], previous[2])
+        fingerprint = get_fingerprint(offer)
+        price, deposit = offer.get("price"), offer.get("deposit")
+        with self._lock:
+            previous = self._offers.get(key)
+            if previous is not None and previous[0] == fingerprint:
+                return
+            self._offers[key] = [fingerprint, price, deposit]
+        if previous is None:
+            return OfferChange(NEW, key, url, offer, None, None)
+        kind = PRICE_CHANGED if (previous[1], previous[2]) != (price, deposit) else UPDATED
+        return OfferChange(kind, key, url, offer, previous[1], previous[2])
+
+    def save(self):
+        """ Saves snapshot to json file, if path was given """
+        if self.path is None:
+            return
+        with self._lock:
+            temp_path = "{0}.{1}.tmp".format(self.path, os.getpid())
+            with open(temp_path, "w") as snapshot_file:
+                json.dump(self._offers, snapshot_file)
+            getattr(os, "replace", os.rename)(temp_path, self.path)
+
+
+def iter_changes(urls, detector):
+    """ Parses offers and yields their changes since last snapshot. Snapshot is saved when generator finishes
+    or is closed. Offers answering 404 or 410 are removed, offers failing with other request errors
+    (including connection errors and timeouts) are skipped and keep their snapshot.
+
+    :param urls: Offer urls, e.g. from :meth:`category.iter_category`
+    :param detector: Snapshot of offers, updated in place
+    :type urls: iterable
+    :type detector: ChangeDetector
+    :return: Generator of changes
+    :rtype: generator
+    """
+    try:
+        for url in urls:
+            if not url:
+                continue
+            try:
+                offer = parse_offer(url)
+            except requests.RequestException as e:
+                if e.response is None or e.response.status_code not in GONE_STATUSES:
+                    log.warning("Offer {0} failed: {1}".format(url, e))
+                    continue
+                offer = None
+            change = detector.detect(url, offer)
+            if change is not None:
+                yield change
+    finally:
+        detector.save()
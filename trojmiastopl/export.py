@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+from array import array
+
+from trojmiastopl.models import AMENITIES, Offer, pack_amenities
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+log = logging.getLogger(__file__)
+
+NAN = float("nan")
+
+# Numeric columns: name and whether values are integers
+NUMERIC_COLUMNS = (
+    ("price", True),
+    ("deposit", True),
+    ("surface", False),
+    ("floor", True),
+    ("floor_count", True),
+    ("rooms", True),
+    ("built_date", True),
+    ("date_added", True),
+    ("date_updated", True),
+)
+STRING_COLUMNS = ("offer_id", "url", "city", "district", "type")
+
+
+class OfferBatch(object):
+    """ Accumulates offers into typed columns for analytics
+
+    Numeric values are kept in float arrays (missing values as NaN), amenities as bit flags,
+    so memory use doesn't depend on number of dictionary keys.
+
+    :Example:
+
+    batch = OfferBatch()
+    batch.extend(iter_offers("nieruchomosci-mam-do-wynajecia", "Gdańsk"))
+    columns = batch.to_numpy()
+    price_per_m2 = columns["price"] / columns["surface"]
+    """
+
+    def __init__(self, offers=None):
+        self._numeric = {name: array("d") for name, _ in NUMERIC_COLUMNS}
+        self._strings = {name: [] for name in STRING_COLUMNS}
+        self._amenities = array("q")
+        if offers is not None:
+            self.extend(offers)
+
+    def __len__(self):
+        return len(self._amenities)
+
+    def append(self, offer):
+        """ Adds offer to batch
+
+        :param offer: Offer dictionary (see :meth:`offer.parse_offer`) or record
+        :type offer: dict, trojmiastopl.models.Offer
+        """
+        if isinstance(offer, Offer):
+            get = lambda name: getattr(offer, name)
+            amenities = offer.amenities
+        else:
+            get = offer.get
+            amenities = pack_amenities(offer.get("additional") or {})
+        for name, _ in NUMERIC_COLUMNS:
+            value = get(name)
+            self._numeric[name].append(float(value) if value is not None else NAN)
+        for name in STRING_COLUMNS:
+            self._strings[name].append(get(name))
+        self._amenities.append(amenities)
+
+    def extend(self, offers):
+        """ Adds offers to batch, skipping None (offers not available anymore)
+
+        :param offers: Offers, see :meth:`append`
+        :type offers: iterable
+        """
+        for offer in offers:
+            if offer is not None:
+                self.append(offer)
+
+    def to_numpy(self):
+        """ Returns columns as numpy arrays
+
+        :return: Column name to array. Numeric columns are float64 with NaN for missing values, string columns
+        are object arrays and "amenities" is bool matrix with one column per trojmiastopl.models.AMENITIES
+        :rtype: dict
+        """
+        if numpy is None:
+            raise ImportError("numpy is required, install it with pip install numpy")
+        columns = {name: numpy.frombuffer(values, dtype=numpy.float64).copy() for name, values in self._numeric.items()}
+        for name, values in self._strings.items():
+            columns[name] = numpy.array(values, dtype=object)
+        flags = numpy.frombuffer(self._amenities, dtype=numpy.int64)
+        columns["amenities"] = (flags[:, None] >> numpy.arange(len(AMENITIES))) & 1 == 1
+        return columns
+
+    def to_arrow(self):
+        """ Returns batch as Arrow table
+
+        Integer columns are int64, surface is float64, missing values are nulls. Every amenity is a bool column.
+
+        :rtype: pyarrow.Table
+        """
+        if pyarrow is None:
+            raise ImportError("pyarrow is required, install it with pip install pyarrow")
+        columns = {}
+        for name in STRING_COLUMNS:
+            columns[name] = pyarrow.array(self._strings[name], type=pyarrow.string())
+        for name, is_integer in NUMERIC_COLUMNS:
+            values = [None if value != value else value for value in self._numeric[name]]
+            columns[name] = pyarrow.array(values, type=pyarrow.float64())
+            if is_integer:
+                columns[name] = columns[name].cast(pyarrow.int64())
+        for i, name in enumerate(AMENITIES):
+            columns[name] = pyarrow.array([bool(flags >> i & 1) for flags in self._amenities], type=pyarrow.bool_())
+        return pyarrow.table(columns)
+
+    def write_parquet(self, path):
+        """ Writes batch to Parquet file
+
+        :param path: File path
+        :type path: str
+        """
+        table = self.to_arrow()
+        pyarrow.parquet.write_table(table, path)
+
+    def write_ipc(self, path):
+        """ Writes batch to Arrow IPC (Feather v2) file
+
+        :param path: File path
+        :type path: str
+        """
+        table = self.to_arrow()
+        with pyarrow.OSFile(path, "wb") as sink:
+            with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import threading
+
+from trojmiastopl.category import iter_result_pages
+from trojmiastopl.offer import parse_offer
+from trojmiastopl.utils import get_offer_id
+
+log = logging.getLogger(__file__)
+
+
+class SeenOffers(object):
+    """ Persistent set of already crawled offers with their last update timestamp
+
+    Offers are identified by offer id read from url (or by url if it doesn't contain id).
+    If path is given, set is loaded from and saved to json file.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._offers = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path) as seen_file:
+                self._offers = json.load(seen_file)
+
+    def __contains__(self, key):
+        return key in self._offers
+
+    def __len__(self):
+        return len(self._offers)
+
+    def get(self, key):
+        """ Returns last update timestamp of offer
+
+        :param key: Offer id or url
+        :type key: str
+        :return: Timestamp of last update or None if offer wasn't seen
+        :rtype: int, None
+        """
+        return self._offers.get(key)
+
+    def add(self, key, updated):
+        """ Marks offer as seen
+
+        :param key: Offer id or url
+        :param updated: Timestamp of last update of offer
+        :type key: str
+        :type updated: int
+        """
+        with self._lock:
+            self._offers[key] = updated
+
+    def save(self):
+        """ Saves set to json file, if path was given """
+        if self.path is None:
+            return
+        with self._lock:
+            temp_path = "{0}.{1}.tmp".format(self.path, os.getpid())
+            with open(temp_path, "w") as seen_file:
+                json.dump(self._offers, seen_file)
+            getattr(os, "replace", os.rename)(temp_path, self.path)
+
+
+def get_offer_key(url):
+    """ Returns key identifying offer in :class:`SeenOffers`
+
+    :param url: Offer url
+    :type url: str
+    :return: Offer id or url if it doesn't contain id
+    :rtype: str
+    """
+    return get_offer_id(url) or url
+
+
+def iter_new_offers(category, seen, region=None, check_updates=False, **filters):
+    """ Yields details of offers which were not seen before, or were updated since
+
+    Search results are sorted by date, so crawling stops at first search page containing only seen offers.
+    Seen offers on earlier pages are parsed again only with check_updates, and yielded if their date_updated
+    is newer than recorded one. Seen set is saved when generator finishes or is closed.
+
+    :param category: Search category
+    :param seen: Set of seen offers, updated in place
+    :param region: Search region
+    :param check_updates: Parse seen offers from pages with new offers to detect updates
+    :param filters: See :meth category.get_category for reference
+    :type category: str
+    :type seen: SeenOffers
+    :type region: str
+    :type check_updates: bool
+    :type filters: dict
+    :return: Generator of offer dictionaries, see :meth offer.parse_offer for reference
+    :rtype: generator
+    """
+    try:
+        for result_page in iter_result_pages(category, region, **filters):
+            urls = [url for url in result_page["offers"] if url]
+            new_urls = [url for url in urls if get_offer_key(url) not in seen]
+            if not new_urls:
+                log.info("Page {0} contains only seen offers".format(result_page["page"] + 1))
+                break
+            for url in (urls if check_updates else new_urls):
+                offer = parse_offer(url)
+                if offer is None:
+                    continue
+                key = get_offer_key(url)
+                updated = offer["date_updated"] or offer["date_added"]
+                last_updated = seen.get(key)
+                seen.add(key, updated)
+                if last_updated is None or updated > last_updated:
+                    yield offer
+    finally:
+        seen.save()
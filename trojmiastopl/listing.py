@@ -0,0 +1,209 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import re
+
+from bs4.dammit import UnicodeDammit
+
+try:
+    from html.parser import HTMLParser
+except ImportError:
+    from HTMLParser import HTMLParser
+
+log = logging.getLogger(__file__)
+
+RESULT_COUNT_PATTERN = re.compile(u"(\\d[\\d\\s]*)\\s+ogłosze(?:nie|nia|ń)", re.UNICODE)
+NUMBER_PATTERN = re.compile(r"\d+(?:[.,]\d+)?")
+
+VOID_ELEMENTS = frozenset((
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr",
+))
+# Text of these elements is not page text, like in BeautifulSoup get_text
+SKIPPED_ELEMENTS = frozenset(("script", "style", "template"))
+
+# Class of search page element: region name
+REGION_CLASSES = {
+    "ogl-item": "item",
+    "ogl-head": "head",
+    "ogl-price": "price",
+    "ogl-surface": "surface",
+    "ogl-location": "location",
+    "navi-pages": "navi",
+}
+SNIPPETS = ("title", "price", "surface", "location")
+
+
+def _normalize(texts):
+    return u" ".join(u"".join(texts).split())
+
+
+def _get_price(text):
+    digits = re.sub(r"\D", "", text)
+    return int(digits) if digits else None
+
+
+def _get_surface(text):
+    match = NUMBER_PATTERN.search(text)
+    return float(match.group(0).replace(",", ".")) if match else None
+
+
+class ListingParser(HTMLParser):
+    """ Streaming search page extractor
+
+    Reads page count, offer links, result count and listing snippets (title, price, surface and location shown
+    on search page) from parser events, without building a tree. Unclosed elements are closed when an enclosing
+    element ends, like tree builders do.
+    """
+
+    def __init__(self):
+        try:
+            HTMLParser.__init__(self, convert_charrefs=True)
+        except TypeError:
+            HTMLParser.__init__(self)
+        self.offers = []
+        self.listings = []
+        self._stack = []
+        # Region name: depth of element which opened it
+        self._regions = {}
+        self._texts = []
+        self._navi_texts = []
+        self._navi_done = False
+        self._head_link = False
+        self._listing = None
+        self._snippets = {}
+
+    def _open(self, region, depth):
+        self._regions[region] = depth
+        if region == "item":
+            self._listing = {"url": None}
+            self._snippets = {name: [] for name in SNIPPETS}
+        elif region == "head":
+            self._head_link = False
+
+    def _close(self, region):
+        del self._regions[region]
+        if region == "item":
+            listing = self._listing
+            listing["title"] = _normalize(self._snippets["title"]) or None
+            listing["price"] = _get_price(u"".join(self._snippets["price"]))
+            listing["surface"] = _get_surface(u"".join(self._snippets["surface"]))
+            listing["location"] = _normalize(self._snippets["location"]) or None
+            self.listings.append(listing)
+            self._listing = None
+        elif region == "navi":
+            self._navi_done = True
+
+    def handle_starttag(self, tag, attrs):
+        regions = self._regions
+        depth = len(self._stack)
+        if tag not in VOID_ELEMENTS:
+            self._stack.append(tag)
+        if tag in SKIPPED_ELEMENTS and "skip" not in regions:
+            regions["skip"] = depth
+        classes = ()
+        href = None
+        for name, value in attrs:
+            if name == "class" and value:
+                classes = value.split()
+            elif name == "href":
+                href = value
+        for class_name in classes:
+            region = REGION_CLASSES.get(class_name)
+            if region is None or region in regions or region == "navi" and self._navi_done:
+                continue
+            self._open(region, depth)
+        if tag == "a" and "head" in regions and not self._head_link:
+            self._head_link = True
+            regions["link"] = depth
+            self.offers.append(href)
+            if self._listing is not None and self._listing["url"] is None:
+                self._listing["url"] = href
+        elif tag == "h2" and "link" in regions and "title" not in regions:
+            regions["title"] = depth
+
+    def handle_endtag(self, tag):
+        stack = self._stack
+        if tag not in stack:
+            return
+        while stack.pop() != tag:
+            pass
+        depth = len(stack)
+        for region, start in list(self._regions.items()):
+            if start >= depth:
+                self._close(region)
+
+    def handle_data(self, data):
+        regions = self._regions
+        if "skip" in regions:
+            return
+        self._texts.append(data)
+        if "navi" in regions:
+            self._navi_texts.append(data)
+        if self._listing is not None:
+            for name in SNIPPETS:
+                if name in regions:
+                    self._snippets[name].append(data)
+
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape(u"&{0};".format(name)))
+
+    def handle_charref(self, name):
+        self.handle_data(self.unescape(u"&#{0};".format(name)))
+
+    def close(self):
+        HTMLParser.close(self)
+        for region in list(self._regions):
+            self._close(region)
+
+    def get_page_count(self):
+        """ Returns highest number in first page navigation, 1 if there is none
+
+        :rtype: int
+        """
+        try:
+            return max(map(int, re.findall(r"\d+", u"".join(self._navi_texts))))
+        except ValueError as e:
+            log.warning(e)
+            return 1
+
+    def get_result_count(self):
+        """ Returns total number of results or None if page doesn't show it
+
+        :rtype: int, None
+        """
+        match = RESULT_COUNT_PATTERN.search(u" ".join(self._texts))
+        if match is None:
+            return
+        return int(re.sub(r"\D", "", match.group(1)))
+
+
+def _decode(markup):
+    if not isinstance(markup, bytes):
+        return markup
+    try:
+        return markup.decode("utf-8")
+    except UnicodeDecodeError:
+        return UnicodeDammit(markup).unicode_markup
+
+
+def parse_listing_page(markup):
+    """ Parses search page in one streaming pass
+
+    :param markup: Search page markup
+    :type markup: str, bytes
+    :return: Search page details: page_count, offers (links), offer_count (on this page), result_count
+    (total number of results or None) and listings - dictionaries with url, title, price, surface and location
+    shown on search page for every offer
+    :rtype: dict
+    """
+    parser = ListingParser()
+    parser.feed(_decode(markup))
+    parser.close()
+    return {
+        "page_count": parser.get_page_count(),
+        "offers": parser.offers,
+        "offer_count": len(parser.offers),
+        "result_count": parser.get_result_count(),
+        "listings": parser.listings,
+    }
@@ -0,0 +1,304 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import socket
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+log = logging.getLogger(__file__)
+
+clock = getattr(time, "perf_counter", time.time)
+
+PROMETHEUS_PREFIX = "trojmiastopl_"
+STATSD_PREFIX = "trojmiastopl"
+
+# Metrics reported by the library. Names ending with _seconds are timings, other names are counters.
+METRICS = {
+    "fetch_seconds": "HTTP request latency, labels: url_class (search, offer), status",
+    "fetch_bytes_total": "Downloaded response body bytes, labels: url_class",
+    "cache_requests_total": "Response cache lookups, labels: result (hit, miss)",
+    "not_modified_total": "Offers not modified since last parse (304 responses)",
+    "parse_seconds": "Page parsing time including tree building, labels: page (search, offer)",
+    "extract_seconds": "Time of single field extractor on parsed offer page, labels: extractor",
+    "pages_total": "Parsed pages, labels: page (search, offer)",
+    "offers_total": "Parsed offers",
+}
+
+# Replaced, never modified in place, so it can be iterated while hooks are added in other threads
+_hooks = ()
+
+
+def add_hook(hook):
+    """ Registers callback receiving every measurement
+
+    Hook is called with kind ("counter" or "timing"), metric name (see METRICS), value (count or seconds)
+    and labels dictionary. It can be called from many threads at once.
+
+    :param hook: Callback, e.g. :class:`MetricsRegistry` or :class:`StatsdHook`
+    :type hook: callable
+    """
+    global _hooks
+    if hook not in _hooks:
+        _hooks += (hook,)
+
+
+def remove_hook(hook):
+    """ Unregisters callback, see :meth:`add_hook`
+
+    :param hook: Registered callback
+    :type hook: callable
+    """
+    global _hooks
+    _hooks = tuple(registered for registered in _hooks if registered is not hook)
+
+
+def is_enabled():
+    """ Checks if any hook is registered. Without hooks no measurement is taken.
+
+    :rtype: bool
+    """
+    return bool(_hooks)
+
+
+def count(name, value=1, **labels):
+    """ Reports counter increment to hooks
+
+    :param name: Metric name
+    :param value: Increment
+    :param labels: Metric labels
+    :type name: str
+    :type value: int
+    """
+    for hook in _hooks:
+        hook("counter", name, value, labels)
+
+
+def timing(name, seconds, **labels):
+    """ Reports measured time to hooks
+
+    :param name: Metric name
+    :param seconds: Measured time
+    :param labels: Metric labels
+    :type name: str
+    :type seconds: float
+    """
+    for hook in _hooks:
+        hook("timing", name, seconds, labels)
+
+
+def start():
+    """ Starts time measurement
+
+    :return: Start time or None if no hook is registered, pass it to :meth:`stop`
+    :rtype: float, None
+    """
+    if _hooks:
+        return clock()
+
+
+def stop(started, name, **labels):
+    """ Reports time elapsed since :meth:`start`, does nothing if measurement was not started
+
+    :param started: Value returned by :meth:`start`
+    :param name: Metric name
+    :param labels: Metric labels
+    :type started: float, None
+    :type name: str
+    """
+    if started is not None:
+        timing(name, clock() - started, **labels)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + "}"
+
+
+class MetricsRegistry(object):
+    """ Hook aggregating measurements in memory
+
+    Counters are summed and timings are kept as count, sum and maximum per metric and labels. Exported in
+    Prometheus text format with :meth:`to_prometheus` or :meth:`serve`.
+
+    :Example:
+
+    registry = MetricsRegistry()
+    add_hook(registry)
+    get_category("nieruchomosci-mam-do-wynajecia", "Gdańsk")
+    print(registry.rate("pages_total"), registry.to_prometheus())
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._timings = {}
+        self._lock = threading.Lock()
+        self.started = time.time()
+
+    def __call__(self, kind, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if kind == "counter":
+                self._counters[key] = self._counters.get(key, 0) + value
+            else:
+                timing_count, timing_sum, timing_max = self._timings.get(key, (0, 0.0, 0.0))
+                self._timings[key] = (timing_count + 1, timing_sum + value, max(timing_max, value))
+
+    def reset(self):
+        """ Removes all measurements """
+        with self._lock:
+            self._counters = {}
+            self._timings = {}
+            self.started = time.time()
+
+    def get_counter(self, name, **labels):
+        """ Returns counter value, summed over labels not given
+
+        :param name: Metric name
+        :param labels: Metric labels to filter by
+        :type name: str
+        :rtype: int
+        """
+        with self._lock:
+            return sum(value for key, value in self._counters.items() if self._matches(key, name, labels))
+
+    def get_timing(self, name, **labels):
+        """ Returns timing summary, aggregated over labels not given
+
+        :param name: Metric name
+        :param labels: Metric labels to filter by
+        :type name: str
+        :return: count, sum, mean and max of measured seconds
+        :rtype: dict
+        """
+        with self._lock:
+            values = [value for key, value in self._timings.items() if self._matches(key, name, labels)]
+        timing_count = sum(value[0] for value in values)
+        timing_sum = sum(value[1] for value in values)
+        return {
+            "count": timing_count,
+            "sum": timing_sum,
+            "mean": timing_sum / timing_count if timing_count else 0.0,
+            "max": max([value[2] for value in values] or [0.0]),
+        }
+
+    def rate(self, name, **labels):
+        """ Returns counter increments per second since registry was created or reset
+
+        :param name: Counter name, e.g. "pages_total" or "offers_total"
+        :param labels: Metric labels to filter by
+        :type name: str
+        :rtype: float
+        """
+        elapsed = time.time() - self.started
+        return self.get_counter(name, **labels) / elapsed if elapsed > 0 else 0.0
+
+    @staticmethod
+    def _matches(key, name, labels):
+        return key[0] == name and all(dict(key[1]).get(k) == v for k, v in labels.items())
+
+    def to_prometheus(self):
+        """ Exports measurements in Prometheus text format. Timings are exported as summaries (_count and _sum).
+
+        :rtype: str
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            timings = sorted(self._timings.items())
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            metric = PROMETHEUS_PREFIX + name
+            if metric not in typed:
+                typed.add(metric)
+                lines += ["# HELP {0} {1}".format(metric, METRICS.get(name, name)), "# TYPE {0} counter".format(metric)]
+            lines.append("{0}{1} {2}".format(metric, _format_labels(labels), value))
+        for (name, labels), (timing_count, timing_sum, _) in timings:
+            metric = PROMETHEUS_PREFIX + name
+            if metric not in typed:
+                typed.add(metric)
+                lines += ["# HELP {0} {1}".format(metric, METRICS.get(name, name)), "# TYPE {0} summary".format(metric)]
+            lines.append("{0}_count{1} {2}".format(metric, _format_labels(labels), timing_count))
+            lines.append("{0}_sum{1} {2!r}".format(metric, _format_labels(labels), timing_sum))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port=9100, host=""):
+        """ Serves measurements for Prometheus scraper in background thread
+
+        :param port: Port to listen on
+        :param host: Address to listen on, all interfaces if empty
+        :type port: int
+        :type host: str
+        :return: Running HTTP server, stop it with shutdown()
+        :rtype: HTTPServer
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                log.debug(format % args)
+
+            def do_GET(self):
+                body = registry.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        httpd = HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return httpd
+
+
+class StatsdHook(object):
+    """ Hook sending every measurement to StatsD over UDP
+
+    Label values are appended to metric name in order of label names, e.g. status and url_class give
+    trojmiastopl.fetch_seconds.200.offer:120.500|ms.
+    With dogstatsd=True labels are sent as tags instead.
+
+    :Example:
+
+    add_hook(StatsdHook("localhost", 8125))
+    """
+
+    def __init__(self, host="localhost", port=8125, prefix=STATSD_PREFIX, dogstatsd=False):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.dogstatsd = dogstatsd
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def format(self, kind, name, value, labels):
+        """ Formats measurement as StatsD line
+
+        :rtype: str
+        """
+        labels = sorted(labels.items())
+        parts = [self.prefix, name] if self.prefix else [name]
+        if not self.dogstatsd:
+            parts += [str(v) for _, v in labels]
+        if kind == "counter":
+            line = "{0}:{1}|c".format(".".join(parts), value)
+        else:
+            line = "{0}:{1:.3f}|ms".format(".".join(parts), value * 1000)
+        if self.dogstatsd and labels:
+            line += "|#" + ",".join("{0}:{1}".format(k, v) for k, v in labels)
+        return line
+
+    def __call__(self, kind, name, value, labels):
+        try:
+            self._socket.sendto(self.format(kind, name, value, labels).encode("utf-8"), self.address)
+        except (socket.error, OSError) as e:
+            log.debug("StatsD send failed: {0}".format(e))
+
+    def close(self):
+        self._socket.close()
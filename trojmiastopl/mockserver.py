@@ -0,0 +1,364 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+""" Local stand-in for trojmiasto.pl, for load testing the crawler without hammering the real site
+
+python -m trojmiastopl.mockserver --port 8000 --offers 5000 --latency 0.05 --error-rate 0.01
+TROJMIASTOPL_BASE_URL=http://127.0.0.1:8000 python example.py
+"""
+import argparse
+import hashlib
+import logging
+import random
+import re
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl, urlsplit
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl, urlsplit
+
+log = logging.getLogger(__file__)
+
+OFFER_COUNT = 1000
+OFFERS_PER_PAGE = 30
+FIRST_OFFER_ID = 60000000
+CATEGORY = "nieruchomosci-mam-do-wynajecia"
+
+DISTRICTS = (u"Wrzeszcz", u"Oliwa", u"Przymorze", u"Zaspa", u"Śródmieście", u"Morena", u"Jasień", u"Osowa")
+AMENITIES = (u"balkon", u"winda", u"internet", u"kablówka", u"miejsce parkingowe", u"garaż", u"piwnica", u"taras")
+
+OFFER_PATH_PATTERN = re.compile(r'ogl(\d+)\.html$')
+
+SEARCH_FORM_TEMPLATE = u"""<!DOCTYPE html>
+<html lang="pl">
+<head><meta charset="utf-8"><title>Wyniki wyszukiwania</title></head>
+<body>
+<form><select class="nice-select-tsi" name="sort">
+<option value="">Sortuj</option>
+<option value="{url}">Najnowsze</option>
+</select></form>
+</body>
+</html>
+"""
+
+SEARCH_PAGE_TEMPLATE = u"""<!DOCTYPE html>
+<html lang="pl">
+<head><meta charset="utf-8"><title>Mieszkania do wynajęcia - ogloszenia.trojmiasto.pl</title></head>
+<body>
+<form><select class="nice-select-tsi" name="sort">
+<option value="">Sortuj</option>
+<option value="{url}">Najnowsze</option>
+</select></form>
+<div class="list-header"><h1>Mieszkania do wynajęcia</h1>
+<span class="results-count">Znaleziono {result_count} ogłoszeń</span></div>
+<div class="list">
+{items}
+</div>
+<div class="navi-pages">{pages}</div>
+</body>
+</html>
+"""
+
+SEARCH_ITEM_TEMPLATE = u"""<div class="ogl-item">
+<div class="ogl-head"><a href="{url}" class="ogl-link"><h2>{title}</h2></a></div>
+<div class="ogl-params"><span class="ogl-price">{price} zł</span>
+<span class="ogl-surface">{surface} m<sup>2</sup></span>
+<span class="ogl-location">Gdańsk, {district}</span>
+</div>
+</div>"""
+
+OFFER_PAGE_TEMPLATE = u"""<!DOCTYPE html>
+<html lang="pl">
+<head><meta charset="utf-8"><title>{title} - ogloszenia.trojmiasto.pl</title></head>
+<body>
+<div id="content">
+<div class="title-wrap">
+<h1 id="ogl-title">
+{title}
+</h1>
+</div>
+<div id="gallery">
+<a class="fancybox" href="{base_url}/ogloszenia/foto/{offer_id}_1.jpg"><img src="t1.jpg"></a>
+<a class="fancybox" href="{base_url}/ogloszenia/foto/{offer_id}_2.jpg"><img src="t2.jpg"></a>
+</div>
+<div class="ogl-description">
+{title}. Mieszkanie do wynajęcia w dzielnicy {district}, {rooms} pokoje, {surface} m2. Opłaty w cenie.
+</div>
+<div id="sidebar">
+<div class="cena"><span class="dt">Cena</span><span class="dd">{price} zł</span></div>
+<div class="kaucja"><span class="dt">Kaucja</span><span class="dd">{price} zł</span></div>
+<div class="powierzchnia"><span class="dt">Powierzchnia</span>
+<span class="dd">{surface} <span>m<sup>2</sup></span></span></div>
+<div class="rodzaj_nieruchomosci"><span class="dt">Rodzaj</span><span class="dd"> Mieszkanie </span></div>
+<div class="l_pokoi"><span class="dt">Liczba pokoi</span><span class="dd">{rooms}</span></div>
+<div class="pietro"><span class="dt">Piętro</span><span class="dd">{floor}</span></div>
+<div class="l_pieter"><span class="dt">Liczba pięter</span><span class="dd">{floor_count}</span></div>
+<div class="dostepne_od"><span class="dt">Dostępne od</span><span class="dd"> od zaraz </span></div>
+<div class="umeblowane"><span class="dt">Umeblowane</span><span class="dd">tak</span></div>
+<div class="address"><span class="dt">Adres</span>
+<span class="dd">Gdańsk&nbsp;<a href="/dzielnica/{district}">{district}</a><br/>ul.&nbsp;Testowa {offer_number}</span>
+</div>
+<div class="description">
+<div class="typ_ogrzewania"><span class="dt">Ogrzewanie</span><span class="dd"> miejskie </span></div>
+<h3>Dodatkowe informacje</h3>
+<p>{amenities}</p>
+</div>
+<ul class="ogl-info-wrap">
+<li>numer ogłoszenia: <span>{offer_id}</span></li>
+<li>data wprowadzenia: <span>{day} września 2017</span></li>
+<li>ostatnia aktualizacja: <span>{day} września 2017</span></li>
+</ul>
+</div>
+<div class="contact-box"><p class="name"> Jan Kowalski </p></div>
+</div>
+</body>
+</html>
+"""
+
+
+def get_offer_details(offer_id):
+    """ Generates details of synthetic offer, always the same for given id
+
+    :param offer_id: Offer id
+    :type offer_id: int
+    :return: Values used in offer and search page templates
+    :rtype: dict
+    """
+    generator = random.Random(offer_id)
+    rooms = generator.randint(1, 4)
+    floor_count = generator.randint(1, 10)
+    district = generator.choice(DISTRICTS)
+    return {
+        "offer_id": offer_id,
+        "offer_number": offer_id % 100 + 1,
+        "title": u"Mieszkanie {0} pokoje {1}".format(rooms, district),
+        "price": generator.randrange(1200, 5000, 50),
+        "surface": rooms * 15 + generator.randint(5, 20),
+        "rooms": rooms,
+        "floor": generator.randint(0, floor_count),
+        "floor_count": floor_count,
+        "district": district,
+        "amenities": u", ".join(generator.sample(AMENITIES, generator.randint(1, len(AMENITIES)))),
+        "day": generator.randint(1, 28),
+    }
+
+
+class MockServer(object):
+    """ HTTP server imitating trojmiasto.pl search engine, search pages and offer pages
+
+    Serves generated offers, so it scales to any number of them without keeping pages in memory. Supports POST
+    to /szukaj/ used by :meth:`utils.get_url_for_filters` and ?strona=N pagination of search pages. Every other
+    url is treated as search page, urls ending with oglN.html as offer pages.
+
+    :Example:
+
+    with MockServer(offer_count=5000, latency=0.05, error_rate=0.01) as server:
+        utils.set_base_url(server.url)
+        offers = get_category("nieruchomosci-mam-do-wynajecia", "Gdańsk", data_wprow="3d")
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, offer_count=OFFER_COUNT, offers_per_page=OFFERS_PER_PAGE,
+                 latency=0.0, error_rate=0.0, offer_pages=None, seed=None):
+        """
+        :param host: Address to listen on
+        :param port: Port to listen on, free port is chosen if 0
+        :param offer_count: Number of offers found by every search
+        :param offers_per_page: Number of offers on one search page
+        :param latency: Delay of every response in seconds
+        :param error_rate: Fraction of requests answered with 503 Service Unavailable
+        :param offer_pages: Recorded offer page bodies, served in turn instead of generated offer pages
+        :param seed: Seed of random errors
+        :type host: str
+        :type port: int
+        :type offer_count: int
+        :type offers_per_page: int
+        :type latency: float
+        :type error_rate: float
+        :type offer_pages: list
+        :type seed: int
+        """
+        self.offer_count = offer_count
+        self.offers_per_page = offers_per_page
+        self.latency = latency
+        self.error_rate = error_rate
+        self.offer_pages = offer_pages
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._stats = {"search": 0, "results": 0, "offer": 0, "errors": 0}
+        self._thread = None
+        self.httpd = _ThreadingHTTPServer((host, port), _RequestHandler)
+        self.httpd.mock = self
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return "http://{0}:{1}".format(host, port)
+
+    @property
+    def page_count(self):
+        return max(1, -(-self.offer_count // self.offers_per_page))
+
+    def start(self):
+        """ Starts serving in background thread
+
+        :return: Server
+        :rtype: MockServer
+        """
+        self._thread = threading.Thread(target=self.httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stops server and closes its socket """
+        if self._thread is not None:
+            self.httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stats(self):
+        """ Returns number of served search engine requests, search result pages, offer pages and errors
+
+        :rtype: dict
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, kind):
+        with self._lock:
+            self._stats[kind] += 1
+
+    def _should_fail(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def get_results_url(self, payload):
+        """ Creates search page url for search engine payload, the same for the same filters
+
+        :param payload: POST key and argument pairs
+        :type payload: list
+        :rtype: str
+        """
+        key = u"&".join(u"{0}={1}".format(k, v) for k, v in sorted(payload))
+        return "{0}/{1}/s,{2}.html".format(self.url, CATEGORY, hashlib.sha1(key.encode("utf-8")).hexdigest()[:12])
+
+    def render_search_form(self, payload):
+        return SEARCH_FORM_TEMPLATE.format(url=self.get_results_url(payload))
+
+    def render_search_page(self, path, page):
+        first = page * self.offers_per_page
+        offer_ids = range(FIRST_OFFER_ID + first, FIRST_OFFER_ID + min(first + self.offers_per_page, self.offer_count))
+        items = []
+        for offer_id in offer_ids:
+            details = get_offer_details(offer_id)
+            details["url"] = "{0}/{1}/mieszkanie-ogl{2}.html".format(self.url, CATEGORY, offer_id)
+            items.append(SEARCH_ITEM_TEMPLATE.format(**details))
+        # Like on trojmiasto.pl - first, last and nearby pages only
+        pages = sorted({0, self.page_count - 1} | set(range(max(0, page - 2), min(self.page_count, page + 3))))
+        links = u" ".join(u'<a href="?strona={0}">{1}</a>'.format(number, number + 1) for number in pages)
+        return SEARCH_PAGE_TEMPLATE.format(
+            url=self.url + path, result_count=self.offer_count, items=u"\n".join(items), pages=links
+        )
+
+    def render_offer_page(self, offer_id):
+        if not FIRST_OFFER_ID <= offer_id < FIRST_OFFER_ID + self.offer_count:
+            return
+        if self.offer_pages:
+            return self.offer_pages[(offer_id - FIRST_OFFER_ID) % len(self.offer_pages)]
+        return OFFER_PAGE_TEMPLATE.format(base_url=self.url, **get_offer_details(offer_id))
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, with Nagle algorithm keep-alive responses would wait for delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+    def _respond(self, status, body=u""):
+        if not isinstance(body, bytes):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, render):
+        mock = self.server.mock
+        if mock.latency:
+            time.sleep(mock.latency)
+        if mock._should_fail():
+            mock._count("errors")
+            self._respond(503, u"Service Unavailable")
+            return
+        status, body = render(mock)
+        self._respond(status, body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        payload = parse_qsl(self.rfile.read(length).decode("utf-8"))
+
+        def render(mock):
+            if urlsplit(self.path).path.rstrip("/") != "/szukaj":
+                return 404, u"Not Found"
+            mock._count("search")
+            return 200, mock.render_search_form(payload)
+
+        self._handle(render)
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+
+        def render(mock):
+            match = OFFER_PATH_PATTERN.search(parts.path)
+            if match is not None:
+                body = mock.render_offer_page(int(match.group(1)))
+                if body is None:
+                    return 404, u"Not Found"
+                mock._count("offer")
+                return 200, body
+            page = int(dict(parse_qsl(parts.query)).get("strona", 0))
+            if not 0 <= page < mock.page_count:
+                return 404, u"Not Found"
+            mock._count("results")
+            return 200, mock.render_search_page(parts.path, page)
+
+        self._handle(render)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--offers", type=int, default=OFFER_COUNT)
+    parser.add_argument("--per-page", type=int, default=OFFERS_PER_PAGE)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+    server = MockServer(args.host, args.port, args.offers, args.per_page, args.latency, args.error_rate, seed=args.seed)
+    log.info("Serving {0} offers on {1}".format(args.offers, server.url))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.httpd.server_close()
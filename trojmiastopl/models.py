@@ -0,0 +1,163 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import datetime as dt
+
+try:
+    from sys import intern
+except ImportError:
+    pass
+
+from trojmiastopl.amenities import AMENITY_KEYWORDS
+
+# Amenities returned by :meth:`offer.get_additional_information`, in order of their bit in Offer.amenities
+AMENITIES = tuple(AMENITY_KEYWORDS)
+AMENITY_FLAGS = {name: 1 << i for i, name in enumerate(AMENITIES)}
+
+
+def pack_amenities(additional):
+    """ Packs amenities into bit flags
+
+    :param additional: Additional info, see :meth:`offer.get_additional_information`
+    :type additional: dict
+    :return: Bit flags, see AMENITY_FLAGS
+    :rtype: int
+    """
+    flags = 0
+    for name, flag in AMENITY_FLAGS.items():
+        if additional.get(name):
+            flags |= flag
+    return flags
+
+
+def unpack_amenities(flags):
+    """ Unpacks bit flags into amenities
+
+    :param flags: Bit flags, see AMENITY_FLAGS
+    :type flags: int
+    :return: Amenity name to bool
+    :rtype: dict
+    """
+    return {name: bool(flags & flag) for name, flag in AMENITY_FLAGS.items()}
+
+
+def _intern(value):
+    return intern(value) if isinstance(value, str) else value
+
+
+class Offer(object):
+    """ Compact offer record
+
+    Holds the same information as dictionary returned by :meth:`offer.parse_offer` using a fraction of its memory:
+    attributes are stored in slots, amenities are packed into bit flags, repeated strings (city, district, type,
+    heating) are interned and derived values (price per surface, readable dates) are computed on access.
+    """
+
+    __slots__ = (
+        "title", "offer_id", "type", "address", "voivodeship", "city", "district", "price", "deposit", "surface",
+        "floor", "floor_count", "rooms", "built_date", "available_from", "furniture", "heating", "amenities",
+        "poster_name", "date_added", "date_updated", "url", "description", "images",
+    )
+
+    currency = "PLN"
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+        for name in ("type", "voivodeship", "city", "district", "heating", "available_from"):
+            setattr(self, name, _intern(getattr(self, name)))
+        self.amenities = self.amenities or 0
+        self.images = tuple(self.images or ())
+
+    @classmethod
+    def from_dict(cls, offer):
+        """ Creates record from offer dictionary
+
+        :param offer: Offer details, see :meth:`offer.parse_offer`
+        :type offer: dict
+        :return: Offer record
+        :rtype: Offer
+        """
+        fields = {name: offer.get(name) for name in cls.__slots__}
+        additional = offer.get("additional") or {}
+        fields["heating"] = additional.get("heating")
+        fields["amenities"] = pack_amenities(additional)
+        return cls(**fields)
+
+    @property
+    def price_per_surface(self):
+        return round(self.price / self.surface) if self.surface else None
+
+    @property
+    def additional(self):
+        additional = {"heating": self.heating}
+        additional.update(unpack_amenities(self.amenities))
+        return additional
+
+    def has(self, amenity):
+        """ Checks if offer has amenity
+
+        :param amenity: One of AMENITIES
+        :type amenity: str
+        :rtype: bool
+        """
+        return bool(self.amenities & AMENITY_FLAGS[amenity])
+
+    def to_dict(self):
+        """ Converts record to dictionary in format returned by :meth:`offer.parse_offer`
+
+        :return: Offer details
+        :rtype: dict
+        """
+        return {
+            "title": self.title,
+            "offer_id": self.offer_id,
+            "type": self.type,
+            "address": self.address,
+            "voivodeship": self.voivodeship,
+            "city": self.city,
+            "district": self.district,
+            "price": self.price,
+            "currency": self.currency,
+            "deposit": self.deposit,
+            "surface": self.surface,
+            "price/surface": self.price_per_surface,
+            "floor": self.floor,
+            "floor_count": self.floor_count,
+            "rooms": self.rooms,
+            "built_date": self.built_date,
+            "available_from": self.available_from,
+            "furniture": self.furniture,
+            "additional": self.additional,
+            "poster_name": self.poster_name,
+            "date_added": self.date_added,
+            "date_updated": self.date_updated,
+            "date_added_readable": dt.datetime.fromtimestamp(self.date_added).isoformat()
+            if self.date_added is not None else None,
+            "date_updated_readable": dt.datetime.fromtimestamp(self.date_updated).isoformat()
+            if self.date_updated else None,
+            "url": self.url,
+            "description": self.description,
+            "images": list(self.images),
+        }
+
+    def __eq__(self, other):
+        if not isinstance(other, Offer):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return "Offer(offer_id={0!r}, title={1!r}, price={2!r})".format(self.offer_id, self.title, self.price)
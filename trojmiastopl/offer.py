@@ -4,11 +4,19 @@
 import datetime as dt
 import logging
 import re
+from collections import OrderedDict
 
 import requests
-from bs4 import BeautifulSoup
+from bs4 import Tag
 
-from trojmiastopl.utils import get_content_for_url
+from trojmiastopl import metrics
+from trojmiastopl.amenities import AMENITY_MATCHER
+from trojmiastopl.utils import get_content_for_url, get_revalidation_cache, get_soup
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
 try:
     from __builtin__ import unicode
@@ -28,7 +36,10 @@ def get_title(offer_markup):
 
     :except: Returns None when couldn't find title of offer page.
     """
-    html_parser = BeautifulSoup(offer_markup, "html.parser")
+    return _get_title(get_soup(offer_markup))
+
+
+def _get_title(html_parser):
     try:
         return html_parser.find(id="ogl-title").text.strip()
     except AttributeError:
@@ -43,7 +54,12 @@ def get_img_url(offer_markup):
     :return: Images of offer in list
     :rtype: list
     """
-    html_parser = BeautifulSoup(offer_markup, "html.parser")
+    return _get_img_url(get_soup(offer_markup))
+
+
+def _get_img_url(html_parser):
+    if html_parser is None:
+        return []
     images = html_parser.find_all(class_="fancybox")
     output = []
     for img in images:
@@ -59,7 +75,18 @@ def parse_region(offer_markup):
     :return: Region of offer
     :rtype: dict
     """
-    html_parser = BeautifulSoup(offer_markup, "html.parser")
+    return _parse_region(get_soup(offer_markup))
+
+
+def _find_link(element):
+    if not isinstance(element, Tag):
+        return
+    if element.name == "a":
+        return element
+    return element.find("a")
+
+
+def _parse_region(html_parser):
     parsed_address = html_parser.find(class_="address").find(class_="dd").contents
     output = {"voivodeship": "Pomorskie", "city": None, "district": None}
     output["city"] = str(parsed_address[0]).replace("\xa0", "")
@@ -67,8 +94,7 @@ def parse_region(offer_markup):
     if len(parsed_address) == 1:
         output["address"] = output["city"]
         return output
-    district_parser = BeautifulSoup(str(parsed_address[1]), "html.parser")
-    district = district_parser.find("a")
+    district = _find_link(parsed_address[1])
     # City, district, street
     if district is not None and len(parsed_address) > 2:
         output["district"] = district.text
@@ -139,8 +165,11 @@ def parse_dates_and_id(offer_markup):
     :return: Date added and date updated if found and offer id (id, added, updated)
     :rtype: dict
     """
-    html_parser = BeautifulSoup(offer_markup, "html.parser")
-    parsed_details = html_parser.find_all("li")
+    return _parse_dates_and_id(get_soup(offer_markup))
+
+
+def _parse_dates_and_id(html_parser):
+    parsed_details = html_parser.find_all("li") if html_parser is not None else []
     output = {"updated": None}
     for detail in parsed_details:
         if "numer" in detail.text:
@@ -162,7 +191,10 @@ def get_surface(offer_markup):
 
     :except: When there is no offer surface it will return None
     """
-    html_parser = BeautifulSoup(offer_markup, "html.parser")
+    return _get_surface(get_soup(offer_markup))
+
+
+def _get_surface(html_parser):
     try:
         surface = html_parser.sup.parent.previous_sibling
         return float(surface.replace("m2", "").strip().replace(",", ".").replace(" ", ""))
@@ -178,7 +210,10 @@ def get_apartment_type(offer_markup):
     :return: Apartment type
     :rtype: str
     """
-    html_parser = BeautifulSoup(offer_markup, "html.parser")
+    return _get_apartment_type(get_soup(offer_markup))
+
+
+def _get_apartment_type(html_parser):
     return html_parser.find(class_="rodzaj_nieruchomosci").find(class_="dd").text.strip()
 
 
@@ -190,7 +225,10 @@ def get_available_from(offer_markup):
     :return: Available from or None if there is no information
     :rtype: str, None
     """
-    html_parser = BeautifulSoup(offer_markup, "html.parser")
+    return _get_available_from(get_soup(offer_markup))
+
+
+def _get_available_from(html_parser):
     try:
         return html_parser.find(class_="dostepne_od").find(class_="dd").text.strip()
     except AttributeError:
@@ -205,29 +243,20 @@ def get_additional_information(offer_markup):
     :return: Additional info with optional heating type
     :rtype: dict
     """
-    html_parser = BeautifulSoup(offer_markup, "html.parser").find(class_="description")
+    return _get_additional_information(get_soup(offer_markup))
+
+
+def _get_additional_information(html_parser):
+    html_parser = html_parser.find(class_="description")
     additional_info = "".join([
         part.strip()
         for i, part in enumerate(html_parser.text.split('Dodatkowe informacje'))
         if i == 1
     ])
     heating = html_parser.find('div', class_="typ_ogrzewania")
-    return {
-        'heating': heating.find(class_="dd").text.strip() if heating else False,
-        'balcony': 'balkon' in additional_info,
-        'kitchen': 'kuchnia' in additional_info,
-        'terrace': 'taras' in additional_info,
-        'internet': 'internet' in additional_info,
-        'elevator': 'winda' in additional_info,
-        'car_parking': 'parkingowe' in additional_info,
-        'disabled_facilities': 'podjazd' in additional_info,
-        'mezzanine': 'antresola' in additional_info,
-        'basement': 'piwnica' in additional_info,
-        'duplex_apartment': 'dwupoziomowe' in additional_info,
-        'garden': 'ogródek' in additional_info,
-        'garage': 'garaż' in additional_info,
-        'cable_tv': 'kablówka' in additional_info
-    }
+    additional = {'heating': heating.find(class_="dd").text.strip() if heating else False}
+    additional.update(AMENITY_MATCHER.match_dict(additional_info))
+    return additional
 
 
 def parse_description(description_markup):
@@ -238,9 +267,14 @@ def parse_description(description_markup):
     :return: Offer description
     :rtype: str
     """
-    html_parser = BeautifulSoup(description_markup, "html.parser").text
+    return _parse_description(get_soup(description_markup))
+
+
+def _parse_description(html_parser):
+    if html_parser is None:
+        return ""
     # \xa0 means no-break space symbol
-    return html_parser.split("$(function")[0].replace("  ", "").replace("\n", " ").replace("\r", "") \
+    return html_parser.text.split("$(function")[0].replace("  ", "").replace("\n", " ").replace("\r", "") \
         .replace(u'\xa0', u' ').strip()
 
 
@@ -254,7 +288,10 @@ def get_furnished(offer_markup):
 
     :except: If there is no information if offer is furnished it will return None
     """
-    html_parser = BeautifulSoup(offer_markup, "html.parser")
+    return _get_furnished(get_soup(offer_markup))
+
+
+def _get_furnished(html_parser):
     try:
         furniture = html_parser.find(class_="umeblowane").text
         if "tak" in furniture:
@@ -273,7 +310,10 @@ def parse_flat_data(offer_markup):
     total count of floors in building
     :rtype: dict
     """
-    html_parser = BeautifulSoup(offer_markup, "html.parser")
+    return _parse_flat_data(get_soup(offer_markup))
+
+
+def _parse_flat_data(html_parser):
     flat_data = {"pietro": None, "l_pokoi": None, "rok_budowy": None, "l_pieter": None, "cena": None, "kaucja": None}
     for element in list(flat_data.keys()):
         current = html_parser.find(class_=element)
@@ -293,8 +333,11 @@ def parse_poster_name(contact_markup):
     :return: Poster name
     :rtype: str
     """
-    html_parser = BeautifulSoup(contact_markup, "html.parser")
-    poster_name = html_parser.find(class_="name")
+    return _parse_poster_name(get_soup(contact_markup))
+
+
+def _parse_poster_name(html_parser):
+    poster_name = html_parser.find(class_="name") if html_parser is not None else None
     if poster_name is not None:
         poster_name = poster_name.text.strip()
     else:
@@ -302,62 +345,255 @@ def parse_poster_name(contact_markup):
     return poster_name
 
 
-def parse_offer(url):
+def _extract(name, extractor, element):
+    started = metrics.start()
+    value = extractor(element)
+    metrics.stop(started, "extract_seconds", extractor=name)
+    return value
+
+
+# Page sections passed to extractors, found in offer page tree
+_SECTIONS = {
+    "title-wrap": {"class_": "title-wrap"},
+    "gallery": {"id": "gallery"},
+    "ogl-info-wrap": {"class_": "ogl-info-wrap"},
+    "ogl-description": {"class_": "ogl-description"},
+    "sidebar": {"id": "sidebar"},
+    "contact-box": {"class_": "contact-box"},
+}
+
+# Extractor name: section and function, each extractor runs at most once per offer
+_EXTRACTORS = {
+    "title": ("title-wrap", _get_title),
+    "images": ("gallery", _get_img_url),
+    "dates_and_id": ("ogl-info-wrap", _parse_dates_and_id),
+    "description": ("ogl-description", _parse_description),
+    "surface": ("sidebar", _get_surface),
+    "flat_data": ("sidebar", _parse_flat_data),
+    "region": ("sidebar", _parse_region),
+    "apartment_type": ("sidebar", _get_apartment_type),
+    "available_from": ("sidebar", _get_available_from),
+    "furnished": ("sidebar", _get_furnished),
+    "additional_information": ("sidebar", _get_additional_information),
+    "poster_name": ("contact-box", _parse_poster_name),
+}
+
+
+def _get_price_per_surface(offer):
+    surface = offer["surface"]
+    return round(offer["price"] / surface) if surface else None
+
+
+def _get_readable_date(timestamp):
+    return dt.datetime.fromtimestamp(timestamp).isoformat() if timestamp else None
+
+
+# Offer fields in order of :meth:`parse_offer` dictionary and how to compute them
+OFFER_FIELDS = OrderedDict([
+    ("title", lambda offer: offer.extract("title")),
+    ("offer_id", lambda offer: offer.extract("dates_and_id")["id"]),
+    ("type", lambda offer: offer.extract("apartment_type")),
+    ("address", lambda offer: offer.extract("region")["address"]),
+    ("voivodeship", lambda offer: offer.extract("region")["voivodeship"]),
+    ("city", lambda offer: offer.extract("region")["city"]),
+    ("district", lambda offer: offer.extract("region")["district"]),
+    ("price", lambda offer: offer.extract("flat_data")["cena"]),
+    ("currency", lambda offer: "PLN"),
+    ("deposit", lambda offer: offer.extract("flat_data")["kaucja"]),
+    ("surface", lambda offer: offer.extract("surface")),
+    ("price/surface", _get_price_per_surface),
+    ("floor", lambda offer: offer.extract("flat_data")["pietro"]),
+    ("floor_count", lambda offer: offer.extract("flat_data")["l_pieter"]),
+    ("rooms", lambda offer: offer.extract("flat_data")["l_pokoi"]),
+    ("built_date", lambda offer: offer.extract("flat_data")["rok_budowy"]),
+    ("available_from", lambda offer: offer.extract("available_from")),
+    ("furniture", lambda offer: offer.extract("furnished")),
+    ("additional", lambda offer: offer.extract("additional_information")),
+    ("poster_name", lambda offer: offer.extract("poster_name")),
+    ("date_added", lambda offer: offer.extract("dates_and_id")["added"]),
+    ("date_updated", lambda offer: offer.extract("dates_and_id")["updated"]),
+    ("date_added_readable", lambda offer: dt.datetime.fromtimestamp(offer["date_added"]).isoformat()),
+    ("date_updated_readable", lambda offer: _get_readable_date(offer["date_updated"])),
+    ("url", lambda offer: offer.url),
+    ("description", lambda offer: offer.extract("description")),
+    ("images", lambda offer: offer.extract("images")),
+])
+
+
+class LazyOffer(Mapping):
+    """ Read-only offer view computing fields on first access
+
+    Behaves like dictionary returned by :meth:`parse_offer`, but page is parsed only when first field is read
+    and every field is extracted only when it's needed, then remembered. Consumers reading a few fields (e.g.
+    price watching) skip most of extraction cost.
+
+    :Example:
+
+    offer = get_lazy_offer(url)
+    if offer is not None and offer["price"] < 2000:
+        save(offer.to_dict())
+    """
+
+    def __init__(self, page, url=None):
+        """
+        :param page: Offer page markup or already parsed tree
+        :param url: Url of offer page
+        :type page: str, bytes, bs4.BeautifulSoup
+        :type url: str
+        """
+        self.url = url
+        self._page = page
+        self._tree = None
+        self._sections = {}
+        self._extracted = {}
+        self._values = {}
+
+    @property
+    def tree(self):
+        """ Parsed offer page """
+        if self._tree is None:
+            self._tree = self._page if isinstance(self._page, Tag) else _extract("tree", get_soup, self._page)
+            self._page = None
+        return self._tree
+
+    @property
+    def is_available(self):
+        """ Checks if offer page contains offer, pages of deleted offers don't have title """
+        return self["title"] is not None
+
+    def _get_section(self, name):
+        if name not in self._sections:
+            self._sections[name] = self.tree.find(**_SECTIONS[name])
+        return self._sections[name]
+
+    def extract(self, name):
+        """ Runs extractor once and returns its result, see _EXTRACTORS for names
+
+        :param name: Extractor name
+        :type name: str
+        """
+        if name not in self._extracted:
+            section, extractor = _EXTRACTORS[name]
+            self._extracted[name] = _extract(name, extractor, self._get_section(section))
+        return self._extracted[name]
+
+    def __getitem__(self, field):
+        if field not in self._values:
+            if field not in OFFER_FIELDS:
+                raise KeyError(field)
+            self._values[field] = OFFER_FIELDS[field](self)
+        return self._values[field]
+
+    def __iter__(self):
+        return iter(OFFER_FIELDS)
+
+    def __len__(self):
+        return len(OFFER_FIELDS)
+
+    def to_dict(self, fields=None):
+        """ Computes fields and returns them as dictionary
+
+        :param fields: Names of fields, see OFFER_FIELDS. Every field if not given.
+        :type fields: iterable
+        :rtype: dict
+        """
+        return {field: self[field] for field in (fields if fields is not None else OFFER_FIELDS)}
+
+    def __repr__(self):
+        return "LazyOffer(url={0!r}, computed={1!r})".format(self.url, sorted(self._values))
+
+
+def parse_offer_tree(html_parser, url=None, fields=None):
+    """ Extracts all offer details from already parsed offer page
+
+    Every field is read from the same tree, so the page is parsed only once.
+
+    :param html_parser: Parsed offer page
+    :param url: Url of current offer page
+    :param fields: Names of fields to extract, see OFFER_FIELDS. Only extractors needed for them are run.
+    :type html_parser: bs4.BeautifulSoup
+    :type url: str
+    :type fields: iterable
+    :return: Dictionary with all offer details (or only fields) or None if offer is not available anymore
+    :rtype: dict, None
+    """
+    offer = LazyOffer(html_parser, url)
+    if not offer.is_available:
+        log.warning("Offer {0} is not available anymore.".format(url))
+        return
+    return offer.to_dict(fields)
+
+
+def parse_offer_markup(markup, url=None, fields=None):
+    """ Parses data from offer page markup
+
+    :param markup: Offer page markup
+    :param url: Url of current offer page
+    :param fields: Names of fields to extract, see OFFER_FIELDS
+    :type markup: str, bytes
+    :type url: str
+    :type fields: iterable
+    :return: Dictionary with all offer details (or only fields) or None if offer is not available anymore
+    :rtype: dict, None
+    """
+    started = metrics.start()
+    offer = parse_offer_tree(_extract("tree", get_soup, markup), url, fields)
+    if started is not None:
+        metrics.stop(started, "parse_seconds", page="offer")
+        metrics.count("pages_total", page="offer")
+        if offer is not None:
+            metrics.count("offers_total")
+    return offer
+
+
+def get_lazy_offer(url, session=None):
+    """ Loads offer page, fields are parsed on access. See :class:`LazyOffer`
+
+    :param url: Url of current offer page
+    :param session: HTTP session, shared session is used if not given
+    :type url: str
+    :type session: requests.Session
+    :return: Offer view or None if offer is not available anymore
+    :rtype: LazyOffer, None
+    """
+    log.debug(url)
+    offer = LazyOffer(get_content_for_url(url, session).content, url)
+    if not offer.is_available:
+        log.warning("Offer {0} is not available anymore.".format(url))
+        return
+    return offer
+
+
+def parse_offer(url, session=None, fields=None):
     """ Parses data from offer page url
 
     :param url: Url of current offer page
+    :param session: HTTP session, shared session is used if not given
+    :param fields: Names of fields to extract, see OFFER_FIELDS. Extractors not needed for them are skipped.
     :type url: str
-    :return: Dictionary with all offer details
+    :type session: requests.Session
+    :type fields: iterable
+    :return: Dictionary with all offer details (or only fields)
     :rtype: dict
 
     :except: If there is no offer title anymore - offer got deleted.
+
+    If conditional requests are enabled (see :meth:`utils.configure_revalidation`) and offer page was not modified
+    since it was parsed last time, previous result is returned without parsing. Results with fields are not
+    remembered for revalidation.
     """
     log.debug(url)
-    response = get_content_for_url(url)
+    revalidation_cache = get_revalidation_cache() if fields is None else None
+    previous = revalidation_cache.get_result(url) if revalidation_cache is not None else None
+    response = get_content_for_url(url, session, revalidate=previous is not None)
     if response is None:
         raise requests.HTTPError
-    html_parser = BeautifulSoup(response.content, "html.parser")
-    offer_content = str(html_parser.find(class_="title-wrap"))
-    title = get_title(offer_content)
-    if title is None:
-        log.warning("Offer {0} is not available anymore.".format(url))
-        return
-    images = get_img_url(str(html_parser.find(id="gallery")))
-    contact_content = str(html_parser.find(class_="contact-box"))
-    date_details = str(html_parser.find(class_="ogl-info-wrap"))
-    dates_id = parse_dates_and_id(date_details)
-    description = parse_description(str(html_parser.find(class_="ogl-description")))
-    offer_content = str(html_parser.find(id="sidebar"))
-    surface = get_surface(offer_content)
-    flat_data = parse_flat_data(offer_content)
-    address = parse_region(offer_content)
-    return {
-        "title": title,
-        "offer_id": dates_id["id"],
-        "type": get_apartment_type(offer_content),
-        "address": address["address"],
-        "voivodeship": address["voivodeship"],
-        "city": address["city"],
-        "district": address["district"],
-        "price": flat_data["cena"],
-        "currency": "PLN",
-        "deposit": flat_data["kaucja"],
-        "surface": surface,
-        "price/surface": round(flat_data["cena"] / surface) if surface else None,
-        "floor": flat_data["pietro"],
-        "floor_count": flat_data["l_pieter"],
-        "rooms": flat_data["l_pokoi"],
-        "built_date": flat_data["rok_budowy"],
-        "available_from": get_available_from(offer_content),
-        "furniture": get_furnished(offer_content),
-        "additional": get_additional_information(offer_content),
-        "poster_name": parse_poster_name(contact_content),
-        "date_added": dates_id["added"],
-        "date_updated": dates_id["updated"],
-        "date_added_readable": dt.datetime.fromtimestamp(dates_id["added"]).isoformat(),
-        "date_updated_readable": dt.datetime.fromtimestamp(dates_id["updated"]).isoformat()
-        if dates_id["updated"] else None,
-        "url": url,
-        "description": description,
-        "images": images
-    }
+    if response.status_code == 304:
+        log.debug("Offer {0} was not modified".format(url))
+        if metrics.is_enabled():
+            metrics.count("not_modified_total")
+        return previous
+    offer = parse_offer_markup(response.content, url, fields)
+    if revalidation_cache is not None:
+        revalidation_cache.set_result(url, offer)
+    return offer
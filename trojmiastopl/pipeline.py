@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from trojmiastopl import utils
+from trojmiastopl.offer import parse_offer_markup
+from trojmiastopl.utils import get_content_for_url
+
+log = logging.getLogger(__file__)
+
+FETCH_WORKERS = 8
+MAX_PENDING = 64
+
+
+def _fetch_markup(url):
+    return get_content_for_url(url).content
+
+
+def parse_offer_markup_with_backend(markup, url, parser_backend):
+    """ Parses offer markup with given parser backend, for use in worker processes which don't inherit
+    backend selected in parent process
+
+    :param markup: Offer page markup
+    :param url: Offer url
+    :param parser_backend: Parser backend, see :meth:`utils.set_parser_backend`
+    :type markup: str
+    :type url: str
+    :type parser_backend: str
+    :return: Offer dictionary, see :meth:`offer.parse_offer_markup`
+    :rtype: dict, None
+    """
+    utils.set_parser_backend(parser_backend)
+    return parse_offer_markup(markup, url)
+
+
+def _copy_result(source, target):
+    exception = source.exception()
+    if exception is not None:
+        target.set_exception(exception)
+    else:
+        target.set_result(source.result())
+
+
+def _submit(url, fetch_pool, parse_pool):
+    result = Future()
+
+    def on_fetched(fetch_future):
+        try:
+            markup = fetch_future.result()
+            parse_future = parse_pool.submit(parse_offer_markup_with_backend, markup, url, utils.PARSER_BACKEND)
+        except Exception as e:
+            result.set_exception(e)
+            return
+        parse_future.add_done_callback(lambda future: _copy_result(future, result))
+
+    fetch_pool.submit(_fetch_markup, url).add_done_callback(on_fetched)
+    return url, result
+
+
+def _get_offer(url, result):
+    try:
+        return result.result()
+    except Exception as e:
+        log.warning("Offer {0} failed: {1}".format(url, e))
+
+
+def _pop_done(pending, ordered):
+    if ordered:
+        return [pending.popleft()]
+    finished, _ = wait([result for _, result in pending], return_when=FIRST_COMPLETED)
+    done = [item for item in pending if item[1] in finished]
+    for item in done:
+        pending.remove(item)
+    return done
+
+
+def parse_offers(urls, fetch_workers=FETCH_WORKERS, parse_workers=None, ordered=False, max_pending=MAX_PENDING):
+    """ Fetches and parses offers, downloading in threads and parsing raw pages in separate processes
+
+    Parsing is CPU-bound, so running it in a process pool uses every core instead of one. At most max_pending
+    offers are fetched or parsed at once - urls are consumed lazily, so they can come from a generator
+    like :meth:`category.iter_category`. Offers which are not available anymore or failed are skipped.
+
+    :Example:
+
+    for offer in parse_offers(iter_category("nieruchomosci-mam-do-wynajecia", "Gdańsk"), parse_workers=16):
+        save(offer)
+
+    :param urls: Offer urls
+    :param fetch_workers: Number of download threads
+    :param parse_workers: Number of parsing processes, number of cores if not given
+    :param ordered: Yield offers in order of urls instead of order of completion
+    :param max_pending: Maximum number of offers being fetched or parsed at once
+    :type urls: iterable
+    :type fetch_workers: int
+    :type parse_workers: int
+    :type ordered: bool
+    :type max_pending: int
+    :return: Generator of offer dictionaries, see :meth offer.parse_offer for reference
+    :rtype: generator
+    """
+    with ThreadPoolExecutor(fetch_workers) as fetch_pool, ProcessPoolExecutor(parse_workers) as parse_pool:
+        pending = deque()
+        for url in urls:
+            if not url:
+                continue
+            pending.append(_submit(url, fetch_pool, parse_pool))
+            while len(pending) >= max_pending:
+                for item in _pop_done(pending, ordered):
+                    offer = _get_offer(*item)
+                    if offer is not None:
+                        yield offer
+        while pending:
+            for item in _pop_done(pending, ordered):
+                offer = _get_offer(*item)
+                if offer is not None:
+                    yield offer
@@ -0,0 +1,280 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+
+from trojmiastopl.cache import OFFER_URL_PATTERN
+
+log = logging.getLogger(__file__)
+
+clock = getattr(time, "monotonic", time.time)
+
+ENDPOINTS = ("search", "listing", "offer")
+
+# Requests per second: initial, minimal and maximal rate of every endpoint
+ENDPOINT_RATES = {
+    "search": (1.0, 0.1, 2.0),  # search engine POST, used once per search
+    "listing": (2.0, 0.2, 5.0),
+    "offer": (5.0, 0.5, 20.0),
+}
+GLOBAL_RATE = (5.0, 0.5, 20.0)
+
+THROTTLE_STATUSES = (429, 503)
+BACKOFF = 0.5
+INCREASE = 0.1
+LATENCY_FACTOR = 2.0
+LATENCY_BACKOFF = 0.9
+COOLDOWN = 1.0
+
+
+def get_endpoint(url, method="GET"):
+    """ Classifies request for rate limiting purposes
+
+    :param url: Website url
+    :param method: HTTP method
+    :type url: str
+    :type method: str
+    :return: "search" for search engine POST, "offer" for offer pages, "listing" for search result pages
+    :rtype: str
+    """
+    if method.upper() == "POST":
+        return "search"
+    if OFFER_URL_PATTERN.search(url):
+        return "offer"
+    return "listing"
+
+
+class TokenBucket(object):
+    """ Thread-safe token bucket
+
+    Tokens are added at rate per second, up to burst. Requests reserve tokens in order they arrive, so waiting
+    callers are served first come, first served.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1.0, rate))
+        self._tokens = self.burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _pause(self, seconds, now):
+        self._refill(now)
+        self._tokens = min(self._tokens, -seconds * self.rate)
+
+    def set_rate(self, rate):
+        """ Changes rate, tokens gathered so far are kept
+
+        :param rate: Tokens per second
+        :type rate: float
+        """
+        with self._lock:
+            self._refill(clock())
+            self.rate = float(rate)
+
+    def reserve(self, tokens=1):
+        """ Takes tokens, possibly in advance
+
+        :param tokens: Number of tokens
+        :type tokens: int
+        :return: Seconds caller has to wait before using reserved tokens
+        :rtype: float
+        """
+        with self._lock:
+            self._refill(clock())
+            self._tokens -= tokens
+            return max(0.0, -self._tokens / self.rate)
+
+    def pause(self, seconds):
+        """ Stops giving tokens for given time, e.g. when server asks to retry later
+
+        :param seconds: Pause length
+        :type seconds: float
+        """
+        with self._lock:
+            self._pause(seconds, clock())
+
+    def acquire(self, tokens=1):
+        """ Waits until tokens are available and takes them
+
+        :param tokens: Number of tokens
+        :type tokens: int
+        """
+        delay = self.reserve(tokens)
+        if delay:
+            time.sleep(delay)
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    """ Token bucket adjusting its rate to server responses
+
+    Rate is cut by backoff factor on throttling responses (429, 503), by latency_backoff when average latency grows
+    above latency_factor times the lowest average seen, and grows by increase on every other response (AIMD).
+    Decreases are at most one per cooldown seconds, so a burst of concurrent failures counts once.
+    """
+
+    def __init__(self, rate, min_rate=None, max_rate=None, burst=None, backoff=BACKOFF, increase=INCREASE,
+                 latency_factor=LATENCY_FACTOR, latency_backoff=LATENCY_BACKOFF, cooldown=COOLDOWN):
+        super(AdaptiveTokenBucket, self).__init__(rate, burst)
+        self.min_rate = float(min_rate if min_rate is not None else rate)
+        self.max_rate = float(max_rate if max_rate is not None else rate)
+        self.backoff = backoff
+        self.increase = increase
+        self.latency_factor = latency_factor
+        self.latency_backoff = latency_backoff
+        self.cooldown = cooldown
+        self.latency = None
+        self.base_latency = None
+        self._decreased = None
+
+    def _decrease(self, factor, now):
+        if self._decreased is not None and now - self._decreased < self.cooldown:
+            return
+        self._decreased = now
+        self._refill(now)
+        self.rate = max(self.min_rate, self.rate * factor)
+        log.info("Request rate decreased to {0:.2f}/s".format(self.rate))
+
+    def update(self, status, latency=None, retry_after=None):
+        """ Adjusts rate to server response
+
+        :param status: HTTP status code
+        :param latency: Response time in seconds
+        :param retry_after: Seconds to wait requested by server (Retry-After header)
+        :type status: int
+        :type latency: float
+        :type retry_after: float
+        """
+        with self._lock:
+            now = clock()
+            if status in THROTTLE_STATUSES:
+                self._decrease(self.backoff, now)
+                if retry_after:
+                    self._pause(retry_after, now)
+                return
+            if latency is not None:
+                self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+                # Baseline slowly follows lasting changes, so rate doesn't stay low forever after server got slower
+                self.base_latency = min((self.base_latency or self.latency) * 1.01, self.latency)
+                if self.latency > self.base_latency * self.latency_factor:
+                    self._decrease(self.latency_backoff, now)
+                    return
+            self._refill(now)
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+class RateLimiter(object):
+    """ Politeness scheduler shared by every thread and asyncio task
+
+    Every request takes a token from global bucket and from bucket of its endpoint (see :meth:`get_endpoint`),
+    both adapting to responses. Budgets are (initial, minimal, maximal) requests per second.
+
+    :Example:
+
+    limiter = RateLimiter(global_rate=(10, 1, 30), offer=(8, 1, 25))
+    limiter.acquire("offer")
+    limiter.update("offer", response.status_code, latency)
+    """
+
+    def __init__(self, global_rate=GLOBAL_RATE, **endpoint_rates):
+        """
+        :param global_rate: Budget of all requests
+        :param endpoint_rates: Budgets of "search", "listing" and "offer" endpoints, defaults in ENDPOINT_RATES
+        :type global_rate: tuple
+        :type endpoint_rates: tuple
+        """
+        unknown = set(endpoint_rates) - set(ENDPOINTS)
+        if unknown:
+            raise ValueError("Unknown endpoints {0}, choose from {1}".format(sorted(unknown), ENDPOINTS))
+        self.global_bucket = AdaptiveTokenBucket(*global_rate)
+        self.buckets = {
+            endpoint: AdaptiveTokenBucket(*endpoint_rates.get(endpoint, ENDPOINT_RATES[endpoint]))
+            for endpoint in ENDPOINTS
+        }
+
+    def reserve(self, endpoint):
+        """ Reserves request slot without blocking, for asyncio callers
+
+        :param endpoint: Endpoint name
+        :type endpoint: str
+        :return: Seconds to wait before sending request
+        :rtype: float
+        """
+        return max(self.global_bucket.reserve(), self.buckets[endpoint].reserve())
+
+    def acquire(self, endpoint):
+        """ Waits until request to endpoint can be sent
+
+        :param endpoint: Endpoint name
+        :type endpoint: str
+        """
+        delay = self.reserve(endpoint)
+        if delay:
+            time.sleep(delay)
+
+    def update(self, endpoint, status, latency=None, retry_after=None):
+        """ Adjusts rates to server response, see :meth:`AdaptiveTokenBucket.update`
+
+        :param endpoint: Endpoint name
+        :param status: HTTP status code
+        :param latency: Response time in seconds
+        :param retry_after: Seconds to wait requested by server
+        :type endpoint: str
+        :type status: int
+        :type latency: float
+        :type retry_after: float
+        """
+        self.global_bucket.update(status, latency, retry_after)
+        self.buckets[endpoint].update(status, latency, retry_after)
+
+    def update_from_response(self, endpoint, response, latency=None):
+        """ Adjusts rates to requests response, including throttled attempts retried by the session
+
+        :param endpoint: Endpoint name
+        :param response: Response
+        :param latency: Response time in seconds
+        :type endpoint: str
+        :type response: requests.Response
+        :type latency: float
+        """
+        retries = getattr(getattr(response, "raw", None), "retries", None)
+        history = getattr(retries, "history", None)
+        if not isinstance(history, tuple):
+            history = ()
+        for attempt in history:
+            if attempt.status in THROTTLE_STATUSES:
+                self.update(endpoint, attempt.status)
+        # Latency of retried request includes backoff sleeps, it says nothing about server load
+        latency = latency if not history else None
+        self.update(endpoint, response.status_code, latency, get_retry_after(response.headers))
+
+    def rates(self):
+        """ Returns current rates
+
+        :return: Requests per second of "global" and every endpoint
+        :rtype: dict
+        """
+        rates = {endpoint: bucket.rate for endpoint, bucket in self.buckets.items()}
+        rates["global"] = self.global_bucket.rate
+        return rates
+
+
+def get_retry_after(headers):
+    """ Reads Retry-After header given in seconds
+
+    :param headers: Response headers
+    :type headers: dict
+    :return: Seconds or None if header is missing or is a date
+    :rtype: float, None
+    """
+    value = headers.get("Retry-After")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return
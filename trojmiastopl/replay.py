@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from trojmiastopl import utils
+from trojmiastopl.category import parse_result_page
+from trojmiastopl.pipeline import parse_offer_markup_with_backend
+
+log = logging.getLogger(__file__)
+
+CHUNK_SIZE = 256
+
+
+def _parse_offer_page(page, parser_backend):
+    url, _, body = page
+    try:
+        return parse_offer_markup_with_backend(body, url, parser_backend)
+    except Exception as e:
+        log.warning("Offer {0} failed: {1}".format(url, e))
+
+
+def replay_offers(archive, since=None, until=None, latest=False, parse_workers=1):
+    """ Parses archived offer pages again, without network access
+
+    Use it after parser fix to reprocess already downloaded offers. With parse_workers other than 1, pages are
+    parsed in a process pool, in chunks so archive is not loaded into memory at once.
+
+    :Example:
+
+    archive = PageArchive("/var/lib/trojmiastopl/archive")
+    for offer in replay_offers(archive, since=time.time() - 30 * 24 * 60 * 60, parse_workers=None):
+        save(offer)
+
+    :param archive: Page archive, see :class:`archive.PageArchive`
+    :param since: Reparse pages fetched at or after this timestamp
+    :param until: Reparse pages fetched before this timestamp
+    :param latest: Reparse only latest version of every offer
+    :param parse_workers: Number of parsing processes, number of cores if None
+    :type archive: trojmiastopl.archive.PageArchive
+    :type since: float
+    :type until: float
+    :type latest: bool
+    :type parse_workers: int
+    :return: Generator of offer dictionaries, see :meth offer.parse_offer for reference. Offers which were not
+    available anymore or failed are skipped.
+    :rtype: generator
+    """
+    pages = archive.iter_pages("offer", since, until, latest)
+    if parse_workers == 1:
+        for page in pages:
+            offer = _parse_offer_page(page, utils.PARSER_BACKEND)
+            if offer is not None:
+                yield offer
+        return
+    with ProcessPoolExecutor(parse_workers) as pool:
+        chunk = list(islice(pages, CHUNK_SIZE))
+        while chunk:
+            offers = pool.map(_parse_offer_page, chunk, [utils.PARSER_BACKEND] * len(chunk), chunksize=16)
+            chunk = list(islice(pages, CHUNK_SIZE))
+            for offer in offers:
+                if offer is not None:
+                    yield offer
+
+
+def replay_result_pages(archive, since=None, until=None, latest=False):
+    """ Parses archived search pages again, without network access
+
+    :param archive: Page archive, see :class:`archive.PageArchive`
+    :param since: Reparse pages fetched at or after this timestamp
+    :param until: Reparse pages fetched before this timestamp
+    :param latest: Reparse only latest version of every search page
+    :type archive: trojmiastopl.archive.PageArchive
+    :type since: float
+    :type until: float
+    :type latest: bool
+    :return: Generator of search page details, see :meth category.parse_result_page. Additionally contains url and
+    fetched (timestamp).
+    :rtype: generator
+    """
+    for url, fetched, body in archive.iter_pages("search", since, until, latest):
+        result_page = parse_result_page(body)
+        result_page["url"] = url
+        result_page["fetched"] = fetched
+        yield result_page
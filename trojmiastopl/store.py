@@ -0,0 +1,270 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from trojmiastopl.models import AMENITY_FLAGS, pack_amenities
+
+log = logging.getLogger(__file__)
+
+BATCH_SIZE = 500
+
+# Offer fields stored in their own columns, so they can be queried and indexed
+COLUMNS = (
+    ("url", "TEXT"),
+    ("title", "TEXT"),
+    ("type", "TEXT"),
+    ("voivodeship", "TEXT"),
+    ("city", "TEXT"),
+    ("district", "TEXT"),
+    ("address", "TEXT"),
+    ("price", "INTEGER"),
+    ("deposit", "INTEGER"),
+    ("surface", "REAL"),
+    ("floor", "INTEGER"),
+    ("floor_count", "INTEGER"),
+    ("rooms", "INTEGER"),
+    ("built_date", "INTEGER"),
+    ("furniture", "INTEGER"),
+    ("date_added", "INTEGER"),
+    ("date_updated", "INTEGER"),
+)
+COLUMN_NAMES = tuple(name for name, _ in COLUMNS)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS offers (
+    offer_id TEXT PRIMARY KEY,
+    {columns},
+    amenities INTEGER NOT NULL DEFAULT 0,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS offers_city_district ON offers (city, district);
+CREATE INDEX IF NOT EXISTS offers_city_rooms_price ON offers (city, rooms, price);
+CREATE INDEX IF NOT EXISTS offers_price ON offers (price);
+CREATE INDEX IF NOT EXISTS offers_surface ON offers (surface);
+CREATE INDEX IF NOT EXISTS offers_date_added ON offers (date_added);
+CREATE TABLE IF NOT EXISTS offer_history (
+    offer_id TEXT NOT NULL,
+    recorded REAL NOT NULL,
+    price INTEGER,
+    deposit INTEGER,
+    date_updated INTEGER
+);
+CREATE INDEX IF NOT EXISTS offer_history_offer ON offer_history (offer_id, recorded);
+""".format(columns=",\n    ".join("{0} {1}".format(name, kind) for name, kind in COLUMNS))
+
+# Fields which can be queried with exact value or (from, to) range
+QUERY_FIELDS = COLUMN_NAMES + ("offer_id", "first_seen", "last_seen")
+
+
+class OfferStore(object):
+    """ Local SQLite database of offers with price history
+
+    Offers are upserted by offer_id. Queried fields are kept in indexed columns, whole offer dictionary
+    is kept as json. Every change of price, deposit or update date is recorded in history.
+
+    :Example:
+
+    with OfferStore("offers.db") as store:
+        store.add_from(pipeline.parse_offers(iter_category("nieruchomosci-mam-do-wynajecia", "Gdańsk")))
+        cheap = store.query(city="Gdańsk", rooms=(2, 3), price=(None, 3000), order_by="price")
+    """
+
+    def __init__(self, path=":memory:"):
+        """
+        :param path: Database file path, database is kept in memory if not given
+        :type path: str
+        """
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM offers").fetchone()[0]
+
+    def __contains__(self, offer_id):
+        with self._lock:
+            row = self._connection.execute("SELECT 1 FROM offers WHERE offer_id = ?", (offer_id,)).fetchone()
+        return row is not None
+
+    def close(self):
+        """ Closes database """
+        self._connection.close()
+
+    def _upsert(self, offer, now):
+        offer = dict(offer)
+        offer_id = offer["offer_id"]
+        values = [offer.get(name) for name in COLUMN_NAMES]
+        amenities = pack_amenities(offer.get("additional") or {})
+        data = json.dumps(offer, ensure_ascii=False, sort_keys=True)
+        previous = self._connection.execute(
+            "SELECT price, deposit, date_updated FROM offers WHERE offer_id = ?", (offer_id,)
+        ).fetchone()
+        if previous is None:
+            self._connection.execute(
+                "INSERT INTO offers (offer_id, {0}, amenities, first_seen, last_seen, data) VALUES ({1})".format(
+                    ", ".join(COLUMN_NAMES), ", ".join("?" * (len(COLUMN_NAMES) + 5))
+                ),
+                [offer_id] + values + [amenities, now, now, data],
+            )
+        else:
+            self._connection.execute(
+                "UPDATE offers SET {0}, amenities = ?, last_seen = ?, data = ? WHERE offer_id = ?".format(
+                    ", ".join("{0} = ?".format(name) for name in COLUMN_NAMES)
+                ),
+                values + [amenities, now, data, offer_id],
+            )
+        current = (offer.get("price"), offer.get("deposit"), offer.get("date_updated"))
+        if previous is None or tuple(previous) != current:
+            self._connection.execute(
+                "INSERT INTO offer_history (offer_id, recorded, price, deposit, date_updated) VALUES (?, ?, ?, ?, ?)",
+                (offer_id,) + (now,) + current,
+            )
+            return True
+        return False
+
+    def upsert(self, offer):
+        """ Inserts or updates offer
+
+        :param offer: Offer details, see :meth:`offer.parse_offer`
+        :type offer: dict
+        :return: True if offer is new or its price, deposit or update date changed
+        :rtype: bool
+        """
+        return self.upsert_many([offer]) == 1
+
+    def upsert_many(self, offers):
+        """ Inserts or updates offers in one transaction
+
+        :param offers: Offer dictionaries, None (offers not available anymore) are skipped
+        :type offers: iterable
+        :return: Number of new or changed offers
+        :rtype: int
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            return sum(self._upsert(offer, now) for offer in offers if offer is not None)
+
+    def add_from(self, offers, batch_size=BATCH_SIZE):
+        """ Stores offers as they come, e.g. from :meth:`pipeline.parse_offers`, writing one transaction per batch
+
+        :param offers: Offer dictionaries
+        :param batch_size: Number of offers written in one transaction
+        :type offers: iterable
+        :type batch_size: int
+        :return: Number of new or changed offers
+        :rtype: int
+        """
+        changed = 0
+        batch = []
+        for offer in offers:
+            batch.append(offer)
+            if len(batch) >= batch_size:
+                changed += self.upsert_many(batch)
+                batch = []
+        return changed + self.upsert_many(batch)
+
+    def get(self, offer_id):
+        """ Returns stored offer
+
+        :param offer_id: Offer id
+        :type offer_id: str
+        :return: Offer dictionary or None if it's not stored
+        :rtype: dict, None
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT data FROM offers WHERE offer_id = ?", (offer_id,)).fetchone()
+        return json.loads(row["data"]) if row is not None else None
+
+    def delete(self, offer_id):
+        """ Removes offer and its history
+
+        :param offer_id: Offer id
+        :type offer_id: str
+        """
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM offers WHERE offer_id = ?", (offer_id,))
+            self._connection.execute("DELETE FROM offer_history WHERE offer_id = ?", (offer_id,))
+
+    def history(self, offer_id):
+        """ Returns recorded prices of offer, oldest first
+
+        :param offer_id: Offer id
+        :type offer_id: str
+        :return: Dictionaries with recorded (timestamp), price, deposit and date_updated
+        :rtype: list
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT recorded, price, deposit, date_updated FROM offer_history WHERE offer_id = ? "
+                "ORDER BY recorded, rowid", (offer_id,)
+            ).fetchall()
+        return [dict(zip(row.keys(), row)) for row in rows]
+
+    def query(self, order_by=None, limit=None, amenities=None, **filters):
+        """ Finds stored offers
+
+        :Example:
+
+        store.query(city="Gdańsk", rooms=(2, 3), price=(None, 3000), amenities=["balcony"], order_by="-date_added")
+
+        :param order_by: Field to sort by, descending if prefixed with "-"
+        :param limit: Maximum number of offers
+        :param amenities: Amenities every offer must have, see trojmiastopl.models.AMENITIES
+        :param filters: Field name (see QUERY_FIELDS) and exact value or (from, to) range, None meaning unbounded
+        :type order_by: str
+        :type limit: int
+        :type amenities: list
+        :type filters: dict
+        :return: Offer dictionaries
+        :rtype: list
+        """
+        conditions, parameters = [], []
+        for field, value in sorted(filters.items()):
+            if field not in QUERY_FIELDS:
+                raise ValueError("Unknown field {0}, choose from {1}".format(field, QUERY_FIELDS))
+            if isinstance(value, tuple):
+                start, end = value
+                if start is not None:
+                    conditions.append("{0} >= ?".format(field))
+                    parameters.append(start)
+                if end is not None:
+                    conditions.append("{0} <= ?".format(field))
+                    parameters.append(end)
+            else:
+                conditions.append("{0} = ?".format(field))
+                parameters.append(value)
+        if amenities:
+            flags = sum(AMENITY_FLAGS[amenity] for amenity in set(amenities))
+            conditions.append("amenities & ? = ?")
+            parameters += [flags, flags]
+        sql = "SELECT data FROM offers"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        if order_by is not None:
+            field = order_by.lstrip("-")
+            if field not in QUERY_FIELDS:
+                raise ValueError("Unknown field {0}, choose from {1}".format(field, QUERY_FIELDS))
+            sql += " ORDER BY {0} {1}".format(field, "DESC" if order_by.startswith("-") else "ASC")
+        if limit is not None:
+            sql += " LIMIT ?"
+            parameters.append(limit)
+        with self._lock:
+            rows = self._connection.execute(sql, parameters).fetchall()
+        return [json.loads(row["data"]) for row in rows]
@@ -2,16 +2,241 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import os
+import re
 
 import requests
 from bs4 import BeautifulSoup
-from scrapper_helpers.utils import caching, get_random_user_agent, key_sha1
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from scrapper_helpers.utils import get_random_user_agent
 
-from trojmiastopl import BASE_URL
+import trojmiastopl
+from trojmiastopl import metrics
+from trojmiastopl.archive import PageArchive
+from trojmiastopl.cache import ResponseCache, RevalidationCache, UrlCache, get_url_class
+from trojmiastopl.ratelimit import RateLimiter, get_endpoint
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+try:
+    import lxml
+except ImportError:
+    lxml = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
 
 log = logging.getLogger(__file__)
 
+# Can point to other server, e.g. trojmiastopl.mockserver, with TROJMIASTOPL_BASE_URL environmental variable
+BASE_URL = trojmiastopl.BASE_URL
 SEARCH_URL = "https://ogloszenia.trojmiasto.pl/szukaj/"
+if "TROJMIASTOPL_BASE_URL" in os.environ:
+    SEARCH_URL = BASE_URL + "/szukaj/"
+
+POOL_SIZE = 10
+RETRIES = 3
+BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+TIMEOUT = 30
+
+_session = None
+
+URL_CACHE_PATH = os.environ.get("TROJMIASTOPL_URL_CACHE")
+OFFLINE_URLS = bool(os.environ.get("TROJMIASTOPL_OFFLINE_URLS"))
+
+# Known search url parts, in order used by trojmiasto.pl search engine
+URL_SLUGS = (
+    ("rodzaj_nieruchomosci", "wi"),
+    ("cena[]", "ai"),
+    ("data_wprow", "dw"),
+    ("s", "s"),
+)
+
+_url_cache = None
+
+RESPONSE_CACHE_DIR = os.environ.get("TROJMIASTOPL_CACHE_DIR", "/var/tmp/trojmiastopl/")
+
+_response_cache = ResponseCache(path=RESPONSE_CACHE_DIR) if os.environ.get("DEBUG") else None
+
+_revalidation_cache = None
+
+_rate_limiter = None
+
+_archive = None
+
+OFFER_ID_PATTERN = re.compile(r'ogl(\d+)\.html')
+
+PARSER_BACKENDS = ("html.parser", "lxml", "selectolax")
+
+
+def _resolve_parser_backend(backend):
+    if backend not in PARSER_BACKENDS:
+        raise ValueError("Unknown parser backend {0}. Available: {1}".format(backend, ", ".join(PARSER_BACKENDS)))
+    if backend == "lxml" and lxml is None:
+        log.warning("lxml is not installed, falling back to html.parser")
+        return "html.parser"
+    if backend == "selectolax" and LexborHTMLParser is None:
+        log.warning("selectolax is not installed, falling back to html.parser")
+        return "html.parser"
+    return backend
+
+
+PARSER_BACKEND = _resolve_parser_backend(os.environ.get("TROJMIASTOPL_PARSER", "html.parser"))
+
+
+def set_parser_backend(backend):
+    """ Sets parser backend used by every markup parsing function
+
+    Available backends:
+
+    * "html.parser" - python built-in parser, always available. Search pages are read in one streaming pass
+      without building a tree, see :meth:`listing.parse_listing_page`
+    * "lxml" - BeautifulSoup with lxml tree builder, requires lxml
+    * "selectolax" - lexbor CSS selectors for search pages, lxml BeautifulSoup (if available) for offer pages,
+      requires selectolax
+
+    Default backend can be set with TROJMIASTOPL_PARSER environmental variable. If library required by backend is
+    missing, html.parser is used instead and a warning is logged once.
+
+    :param backend: One of PARSER_BACKENDS
+    :type backend: str
+    """
+    global PARSER_BACKEND
+    PARSER_BACKEND = _resolve_parser_backend(backend)
+
+
+def get_parser_backend():
+    """ Returns parser backend which will be used
+
+    :return: One of PARSER_BACKENDS, html.parser if library required by selected backend is missing
+    :rtype: str
+    """
+    return PARSER_BACKEND
+
+
+def get_soup(markup):
+    """ Parses markup with BeautifulSoup using tree builder of current parser backend
+
+    :param markup: Website markup
+    :type markup: str, bytes
+    :return: Parsed markup
+    :rtype: bs4.BeautifulSoup
+    """
+    if get_parser_backend() != "html.parser" and lxml is not None:
+        return BeautifulSoup(markup, "lxml")
+    return BeautifulSoup(markup, "html.parser")
+
+
+def get_selector_tree(markup):
+    """ Parses markup with selectolax if it is the current parser backend
+
+    :param markup: Website markup
+    :type markup: str, bytes
+    :return: Lexbor tree or None if selectolax backend is not used
+    :rtype: selectolax.lexbor.LexborHTMLParser, None
+    """
+    if get_parser_backend() == "selectolax":
+        return LexborHTMLParser(markup)
+
+
+def create_session(pool_size=POOL_SIZE, retries=RETRIES, backoff_factor=BACKOFF_FACTOR):
+    """ Creates HTTP session with connection pool and retries
+
+    Connections are kept alive and reused between requests. Requests ending with one of RETRY_STATUSES
+    or connection error are retried with exponential backoff.
+
+    :param pool_size: Number of connections kept open per host
+    :param retries: Number of retries
+    :param backoff_factor: Backoff factor, n-th retry waits backoff_factor * 2 ** (n - 1) seconds
+    :type pool_size: int
+    :type retries: int
+    :type backoff_factor: float
+    :return: HTTP session
+    :rtype: requests.Session
+    """
+    retry_options = {
+        "total": retries,
+        "backoff_factor": backoff_factor,
+        "status_forcelist": RETRY_STATUSES,
+        "raise_on_status": False,
+    }
+    try:
+        retry = Retry(allowed_methods=None, **retry_options)
+    except TypeError:
+        retry = Retry(method_whitelist=False, **retry_options)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def configure_session(pool_size=POOL_SIZE, retries=RETRIES, backoff_factor=BACKOFF_FACTOR, timeout=TIMEOUT):
+    """ Replaces shared HTTP session used by every request
+
+    :param pool_size: Number of connections kept open per host
+    :param retries: Number of retries
+    :param backoff_factor: Backoff factor, n-th retry waits backoff_factor * 2 ** (n - 1) seconds
+    :param timeout: Connect and read timeout in seconds
+    :type pool_size: int
+    :type retries: int
+    :type backoff_factor: float
+    :type timeout: float
+    :return: New shared HTTP session
+    :rtype: requests.Session
+    """
+    global _session, TIMEOUT
+    TIMEOUT = timeout
+    _session = create_session(pool_size, retries, backoff_factor)
+    return _session
+
+
+def set_base_url(base_url, search_url=None):
+    """ Points every request to other server, e.g. :class:`trojmiastopl.mockserver.MockServer`
+
+    Search urls cached in memory are dropped, as they belong to previous server.
+
+    :param base_url: Server address, e.g. "http://127.0.0.1:8000"
+    :param search_url: Search engine address, base_url + "/szukaj/" if not given
+    :type base_url: str
+    :type search_url: str
+    """
+    global BASE_URL, SEARCH_URL, _url_cache
+    BASE_URL = base_url.rstrip("/")
+    SEARCH_URL = search_url or BASE_URL + "/szukaj/"
+    _url_cache = None
+
+
+def get_session():
+    """ Returns shared HTTP session, creating it with default options on first use
+
+    :return: Shared HTTP session
+    :rtype: requests.Session
+    """
+    global _session
+    if _session is None:
+        _session = create_session()
+    return _session
+
+
+def get_offer_id(url):
+    """ Reads offer id from offer url
+
+    :param url: Offer url
+    :type url: str
+    :return: Offer id or None if url doesn't contain it
+    :rtype: str, None
+    """
+    match = OFFER_ID_PATTERN.search(url)
+    if match is not None:
+        return match.group(1)
 
 
 def decode_type(filter_value):
@@ -55,75 +280,375 @@ def decode_category_name(category):
     return available.get(category, 100)
 
 
-def get_url_for_filters(payload):
+def parse_url_for_filters(markup):
+    """ Reads url generated by trojmiasto.pl search engine from search response markup
+
+    :param markup: Search engine response markup
+    :type markup: str, bytes
+    :return: Url generated by trojmiasto.pl search engine
+    :rtype: str
+    """
+    tree = get_selector_tree(markup)
+    if tree is not None:
+        return tree.css_first(".nice-select-tsi").css_first("option").next.next.attributes["value"]
+    html_parser = get_soup(markup)
+    url = html_parser.find(class_="nice-select-tsi").find("option").next_sibling.next_sibling.attrs["value"]
+    return url
+
+
+def get_url_for_filters(payload, session=None):
     """ Parses url from trojmiasto.pl search engine using POST method for given payload of data
 
     :param payload: Tuple of tuples containing POST key and argument
+    :param session: HTTP session, shared session is used if not given
     :type payload: tuple
+    :type session: requests.Session
     :return: Url generated by trojmiasto.pl search engine
     :rtype: str
     """
-    response = requests.post(SEARCH_URL, payload, headers={'User-Agent': get_random_user_agent()})
-    html_parser = BeautifulSoup(response.content, "html.parser")
-    url = html_parser.find(class_="nice-select-tsi").find("option").next_sibling.next_sibling.attrs["value"]
-    return url
+    session = session or get_session()
+    response = _send(session.post, "POST", SEARCH_URL, payload, headers={'User-Agent': get_random_user_agent()},
+                     timeout=TIMEOUT)
+    return parse_url_for_filters(response.content)
+
 
+def get_search_payload(category, region=None, **filters):
+    """ Creates POST payload for trojmiasto.pl search engine
 
-def get_url(category, region=None, **filters):
+    :param category: Search category
+    :param region: Search region
+    :param filters: Dictionary with additional filters. See :meth:'trojmiastopl.get_category' for reference
+    :type category: str
+    :type region: str
+    :type filters: dict
+    :return: Tuple of tuples containing POST key and argument
+    :rtype: tuple
+    """
+    category_id = decode_category_name(category)
+    if region is not None:
+        payload = (("id_kat", category_id), ("s", region))
+    else:
+        payload = (("id_kat", category_id),)
+    for k, v in filters.items():
+        if isinstance(v, tuple):
+            start = v[0] if v[0] is not None else 0
+            if v[1] is None:
+                payload += (k, start),
+                continue
+            payload += (k, start), (k, v[1])
+            continue
+        elif "offer_type" == k:
+            v = decode_type(v)
+            k = "rodzaj_nieruchomosci"
+        elif "data_wprow" == k:
+            available = ["1d", "3d", "1w", "2w"]
+            if v not in available:
+                continue
+        payload += (k, v),
+    return payload
+
+
+def configure_cache(max_bytes=None, path=None, ttls=None):
+    """ Enables response cache used by :meth:`get_content_for_url`
+
+    Cache is disabled by default, unless DEBUG environmental variable is set.
+
+    :param max_bytes: Maximum size of bodies kept in memory, see trojmiastopl.cache.RESPONSE_CACHE_MAX_BYTES
+    :param path: Directory for compressed bodies, bodies are kept only in memory if not given
+    :param ttls: Expiration time in seconds per url class, see trojmiastopl.cache.RESPONSE_CACHE_TTLS
+    :type max_bytes: int
+    :type path: str
+    :type ttls: dict
+    :return: New response cache
+    :rtype: trojmiastopl.cache.ResponseCache
+    """
+    global _response_cache
+    options = {"path": path, "ttls": ttls}
+    if max_bytes is not None:
+        options["max_bytes"] = max_bytes
+    _response_cache = ResponseCache(**options)
+    return _response_cache
+
+
+def disable_cache():
+    """ Disables response cache """
+    global _response_cache
+    _response_cache = None
+
+
+def get_response_cache():
+    """ Returns response cache
+
+    :return: Response cache or None if it's disabled
+    :rtype: trojmiastopl.cache.ResponseCache, None
+    """
+    return _response_cache
+
+
+def configure_revalidation(max_entries=None):
+    """ Enables conditional requests for recently fetched urls
+
+    ETag and Last-Modified validators of responses are remembered and sent back with requests made with
+    revalidate=True. :meth:`offer.parse_offer` returns last parsed result when offer was not modified.
+
+    :param max_entries: Maximum number of remembered urls, see trojmiastopl.cache.REVALIDATION_MAX_ENTRIES
+    :type max_entries: int
+    :return: New revalidation cache
+    :rtype: trojmiastopl.cache.RevalidationCache
+    """
+    global _revalidation_cache
+    _revalidation_cache = RevalidationCache(max_entries) if max_entries is not None else RevalidationCache()
+    return _revalidation_cache
+
+
+def disable_revalidation():
+    """ Disables conditional requests """
+    global _revalidation_cache
+    _revalidation_cache = None
+
+
+def get_revalidation_cache():
+    """ Returns revalidation cache
+
+    :return: Revalidation cache or None if conditional requests are disabled
+    :rtype: trojmiastopl.cache.RevalidationCache, None
+    """
+    return _revalidation_cache
+
+
+def configure_archive(path, **options):
+    """ Enables archiving raw body of every page downloaded by :meth:`get_content_for_url`
+
+    Archive is opened as its single writer. Archived pages can be parsed again without network access, also while
+    crawler is running, see :mod:`trojmiastopl.replay`.
+
+    :param path: Archive directory
+    :param options: See :class:`trojmiastopl.archive.PageArchive`
+    :type path: str
+    :return: New page archive
+    :rtype: trojmiastopl.archive.PageArchive
+    """
+    global _archive
+    if _archive is not None:
+        _archive.close()
+    _archive = PageArchive(path, "w", **options)
+    return _archive
+
+
+def disable_archive():
+    """ Disables archiving downloaded pages """
+    global _archive
+    if _archive is not None:
+        _archive.close()
+    _archive = None
+
+
+def get_archive():
+    """ Returns page archive
+
+    :return: Page archive or None if archiving is disabled
+    :rtype: trojmiastopl.archive.PageArchive, None
+    """
+    return _archive
+
+
+def configure_rate_limit(global_rate=None, **endpoint_rates):
+    """ Enables adaptive rate limiting of every request, shared by all threads and asyncio tasks
+
+    Rates start at initial value, grow while server answers quickly and drop on 429/503 responses and growing
+    latency, within given bounds. See :class:`trojmiastopl.ratelimit.RateLimiter`.
+
+    :Example:
+
+    configure_rate_limit(global_rate=(10, 1, 30), offer=(8, 1, 25))
+
+    :param global_rate: (initial, minimal, maximal) requests per second of all requests
+    :param endpoint_rates: (initial, minimal, maximal) requests per second of "search" (search engine POST),
+    "listing" (search result pages) and "offer" (offer pages), see trojmiastopl.ratelimit.ENDPOINT_RATES
+    :type global_rate: tuple
+    :type endpoint_rates: tuple
+    :return: New rate limiter
+    :rtype: trojmiastopl.ratelimit.RateLimiter
+    """
+    global _rate_limiter
+    if global_rate is not None:
+        _rate_limiter = RateLimiter(global_rate, **endpoint_rates)
+    else:
+        _rate_limiter = RateLimiter(**endpoint_rates)
+    return _rate_limiter
+
+
+def disable_rate_limit():
+    """ Disables rate limiting """
+    global _rate_limiter
+    _rate_limiter = None
+
+
+def get_rate_limiter():
+    """ Returns rate limiter
+
+    :return: Rate limiter or None if rate limiting is disabled
+    :rtype: trojmiastopl.ratelimit.RateLimiter, None
+    """
+    return _rate_limiter
+
+
+def _send(send, method, url, *args, **kwargs):
+    rate_limiter = _rate_limiter
+    if rate_limiter is not None:
+        endpoint = get_endpoint(url, method)
+        rate_limiter.acquire(endpoint)
+    elif not metrics.is_enabled():
+        return send(url, *args, **kwargs)
+    started = metrics.clock()
+    response = send(url, *args, **kwargs)
+    latency = metrics.clock() - started
+    if rate_limiter is not None:
+        rate_limiter.update_from_response(endpoint, response, latency)
+    if metrics.is_enabled():
+        url_class = get_url_class(url)
+        metrics.timing("fetch_seconds", latency, url_class=url_class, status=response.status_code)
+        metrics.count("fetch_bytes_total", len(response.content), url_class=url_class)
+    return response
+
+
+def get_url_cache():
+    """ Returns cache of urls resolved by search engine
+
+    Cache is kept in memory. It is persisted to json file if TROJMIASTOPL_URL_CACHE environmental variable is set.
+
+    :return: Url cache
+    :rtype: trojmiastopl.cache.UrlCache
+    """
+    global _url_cache
+    if _url_cache is None:
+        _url_cache = UrlCache(URL_CACHE_PATH)
+    return _url_cache
+
+
+def build_url_for_payload(category, payload):
+    """ Builds search url without contacting search engine, using known url slugs
+
+    Offline building is used by :meth:`get_known_url` only if TROJMIASTOPL_OFFLINE_URLS environmental variable is set.
+
+    :param category: Search category
+    :param payload: Tuple of tuples containing POST key and argument, see :meth:`get_search_payload`
+    :type category: str
+    :type payload: tuple
+    :return: Search url or None if payload contains filter without known slug
+    :rtype: str, None
+    """
+    values = {}
+    for k, v in payload:
+        if k != "id_kat":
+            values.setdefault(k, []).append(v if isinstance(v, type(u"")) else str(v))
+    slugs = dict(URL_SLUGS)
+    if any(k not in slugs for k in values):
+        return
+    parts = []
+    for k, slug in URL_SLUGS:
+        if k not in values:
+            continue
+        if k.endswith("[]"):
+            value = "_".join(values[k]) if len(values[k]) > 1 else "{0}_".format(values[k][0])
+        else:
+            value = quote(values[k][0].encode("utf-8"))
+        parts += [slug, value]
+    return "{0}/{1}/{2}.html".format(BASE_URL, category, ",".join(parts))
+
+
+def get_known_url(category, payload):
+    """ Returns url for search payload without contacting search engine
+
+    Url is built locally when offline urls are enabled and payload allows it, otherwise it is read from url cache.
+
+    :param category: Search category
+    :param payload: Search payload, see :meth:`get_search_payload`
+    :type category: str
+    :type payload: tuple
+    :return: Url or None if search engine has to resolve it
+    :rtype: str, None
+    """
+    if OFFLINE_URLS:
+        offline_url = build_url_for_payload(category, payload)
+        if offline_url is not None:
+            return offline_url
+    return get_url_cache().get(payload, SEARCH_URL)
+
+
+def get_url(category, region=None, session=None, **filters):
     """ Creates url for given parameters
 
     :param category: Search category
     :param region: Search region
+    :param session: HTTP session, shared session is used if not given
     :param filters: Dictionary with additional filters. See :meth:'trojmiastopl.get_category' for reference
     :type category: str
     :type region: str
+    :type session: requests.Session
     :type filters: dict
     :return: Url for given parameters
     :rtype: str
     """
     url = "/".join([BASE_URL, category]) + "/"
-    category_id = decode_category_name(category)
     if filters:
-        if region is not None:
-            payload = (("id_kat", category_id), ("s", region))
-        else:
-            payload = (("id_kat", category_id),)
-        for k, v in filters.items():
-            if isinstance(v, tuple):
-                if v[0] is None:
-                    v[0] = 0
-                if v[1] is None:
-                    payload += (k, v[0]),
-                    continue
-                payload += (k, v[0]), (k, v[1])
-                continue
-            elif "offer_type" == k:
-                v = decode_type(v)
-                k = "rodzaj_nieruchomosci"
-            elif "data_wprow" == k:
-                available = ["1d", "3d", "1w", "2w"]
-                if v not in available:
-                    continue
-            payload += (k, v),
+        payload = get_search_payload(category, region, **filters)
+        known_url = get_known_url(category, payload)
+        if known_url is not None:
+            return known_url
         try:
-            url = get_url_for_filters(payload)
+            url = get_url_for_filters(payload, session)
         except (AttributeError, requests.HTTPError):
             raise requests.HTTPError
+        get_url_cache().set(payload, url, SEARCH_URL)
     elif region is not None:
         url += "s,{0}.html".format(region)
     return url
 
 
-@caching(key_func=key_sha1)
-def get_content_for_url(url):
+def _get_cached_response(url, body):
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response._content = body
+    return response
+
+
+def get_content_for_url(url, session=None, revalidate=False):
     """ Connects with given url
 
-    If environmental variable DEBUG is True it will cache response for url in /var/temp directory
+    If response cache is enabled, body is served from cache when available. See :meth:`configure_cache`.
 
     :param url: Website url
+    :param session: HTTP session, shared session is used if not given
+    :param revalidate: Send conditional request if validators for url are known, see :meth:`configure_revalidation`.
+    Caller must handle 304 Not Modified response without body.
     :type url: str
+    :type session: requests.Session
+    :type revalidate: bool
     :return: Response for requested url
     """
-    response = requests.get(url, headers={'User-Agent': get_random_user_agent()})
+    session = session or get_session()
+    response_cache = _response_cache
+    if response_cache is not None:
+        body = response_cache.get(url)
+        if metrics.is_enabled():
+            metrics.count("cache_requests_total", result="miss" if body is None else "hit")
+        if body is not None:
+            return _get_cached_response(url, body)
+    headers = {'User-Agent': get_random_user_agent()}
+    revalidation_cache = _revalidation_cache
+    if revalidate and revalidation_cache is not None:
+        headers.update(revalidation_cache.get_headers(url))
+    response = _send(session.get, "GET", url, headers=headers, timeout=TIMEOUT)
     response.raise_for_status()
+    if response.status_code == 304:
+        return response
+    if revalidation_cache is not None:
+        revalidation_cache.update(url, response)
+    if response_cache is not None:
+        response_cache.set(url, response.content)
+    archive = _archive
+    if archive is not None:
+        archive.write(url, response.content)
     return response